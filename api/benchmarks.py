@@ -0,0 +1,174 @@
+import io
+import time
+
+from django.core.cache import caches
+from django.db import connection
+from django.urls import reverse
+from PIL import Image
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .membership import local_cache
+from .models import Chat, FriendRequest
+from .sync import encode_sync_cursor
+from . import seeding
+
+# QUERY BUDGET BENCHMARKS FOR THE REST ENDPOINTS
+# A DATASET IS SEEDED AROUND ONE USER AND EVERY ENDPOINT IN api/urls.py IS CALLED ONCE AS THAT USER
+# THE QUERY COUNT OF AN ENDPOINT MUST NOT DEPEND ON THE SIZE OF THE DATASET, ONLY ON THE REQUEST
+
+BENCH_PASSWORD = "benchmark-password"
+
+# MAXIMUM NUMBER OF QUERIES PER ENDPOINT, INCLUDING THE ONE THAT AUTHENTICATES THE USER
+# MEASURED INSIDE A TEST TRANSACTION, SO THE SAVEPOINTS OF ATOMIC BLOCKS ARE COUNTED TOO
+QUERY_BUDGETS = {
+	"token_obtain_pair": 1,
+	"token_refresh": 1,
+	"friend_list": 2,
+	"friend_list_create": 9,
+	"friend_request_list": 2,
+	"friend_request": 2,
+	"friend_request_accept": 14,
+	"chat_list_create_group": 3,
+	"chat_list_create_group_page": 3,
+	"chat_list_create_group_create": 8,
+	"ind_chat": 14,
+	"chat_detail": 4,
+	"chat_detail_add_member": 11,
+	"chat_detail_leave": 6,
+	"message_list": 4,
+	"message_list_page": 4,
+	"sync": 4,
+	"message_search": 5,
+	"message_list_create": 11,
+	"create_user": 1,
+	"user_search": 2,
+	"upload_profile_pic": 3,
+}
+
+
+# RECORDS THE NUMBER OF QUERIES RUN ON A CONNECTION AND THE TIME SPENT IN THEM, IT IS NOT CAPPED LIKE CONNECTION.QUERIES
+class QueryRecorder:
+
+	def __init__(self):
+		self.count = 0
+		self.time = 0.0
+
+	def __call__(self, execute, sql, params, many, context):
+		start = time.perf_counter()
+		try:
+			return execute(sql, params, many, context)
+		finally:
+			self.time += time.perf_counter() - start
+			self.count += 1
+
+
+# SEEDS THE DATASET, EVERY COLLECTION AROUND THE BENCHMARK USER GROWS LINEARLY WITH SCALE
+def seed(scale):
+	user = seeding.create_users(["bench_user"], password=BENCH_PASSWORD)[0]
+	# A STORED NAME IS ENOUGH FOR THE PROFILE PICTURE URL OF THE TOKEN REFRESH
+	user.profile_picture = "profilepics/bench_user.png"
+	user.save()
+
+	friends = seeding.create_users([f"bench_friend_{i}" for i in range(30 * scale)])
+	strangers = seeding.create_users([f"bench_stranger_{i}" for i in range(10 * scale + 2)])
+	seeding.create_friendships((user.id, friend.id) for friend in friends)
+	seeding.create_friend_requests((stranger.id, user.id) for stranger in strangers[:10 * scale])
+
+	# EVERY FRIEND BUT THE LAST ONE HAS AN INDIVIDUAL CHAT WITH THE USER
+	direct_chats = seeding.create_direct_chats((user.id, friend.id) for friend in friends[:-1])
+	group_chats = seeding.create_group_chats(
+		(f"bench_group_{i}", [user.id] + [friend.id for friend in friends[i * 10 % len(friends):][:9 * scale]])
+		for i in range(5 * scale)
+	)
+	chats = direct_chats + group_chats
+	seeding.create_messages((chat, member_ids, 20 * scale) for chat, member_ids in chats)
+
+	group, group_member_ids = group_chats[0]
+	return {
+		"user": user,
+		"token": str(RefreshToken.for_user(user).access_token),
+		"refresh": str(RefreshToken.for_user(user)),
+		"friend_without_chat": friends[-1],
+		"friends_outside_group": [friend for friend in friends if friend.id not in group_member_ids][:5 * scale],
+		"stranger": strangers[-1],
+		"friend_request": FriendRequest.objects.filter(user_receiver=user).first(),
+		"friend_request_to_accept": FriendRequest.objects.filter(user_receiver=user).last(),
+		"direct_chat": direct_chats[0][0],
+		"group_chat": group,
+		"group_to_leave": group_chats[-1][0],
+		# A CLIENT THAT MISSED THE LAST FIVE MESSAGES OF EVERY CHAT
+		"sync_cursor": encode_sync_cursor({f"{chat.id}": chat.last_seq - 5 for chat in Chat.objects.filter(chat_for_member__member=user)}, None),
+	}
+
+def small_png():
+	image = io.BytesIO()
+	Image.new("RGB", (8, 8)).save(image, "PNG")
+	image.seek(0)
+	image.name = "avatar.png"
+	return image
+
+# THE ENDPOINT CALLS, READS FIRST AND THEN THE ONES THAT CHANGE THE DATASET
+# EACH ONE IS (NAME, METHOD, URL, DATA, AUTHENTICATED)
+def endpoint_calls(context):
+	user = context["user"]
+	direct_chat = context["direct_chat"].id
+	group_chat = context["group_chat"].id
+	return [
+		("token_obtain_pair", "post", reverse("token_obtain_pair"), {"username": user.username, "password": BENCH_PASSWORD}, False),
+		("token_refresh", "post", reverse("token_refresh"), {"refresh": context["refresh"]}, False),
+		("friend_list", "get", reverse("friend_list"), None, True),
+		("friend_request_list", "get", reverse("friend_request_list"), None, True),
+		("friend_request", "get", reverse("friend_request", args=(context["friend_request"].id,)), None, True),
+		("user_search", "get", reverse("user_search") + "?q=bench_", None, True),
+		("chat_list_create_group", "get", reverse("chat_list_create_group"), None, True),
+		("chat_list_create_group_page", "get", reverse("chat_list_create_group") + "?limit=20", None, True),
+		("chat_detail", "get", reverse("chat_detail", args=(group_chat,)), None, True),
+		("message_list", "get", reverse("message_list", args=(direct_chat,)), None, True),
+		("message_list_page", "get", reverse("message_list", args=(direct_chat,)) + "?limit=50", None, True),
+		("sync", "post", reverse("sync"), {"cursor": context["sync_cursor"]}, True),
+		("message_search", "get", reverse("message_search") + "?q=message+bench_group_0", None, True),
+		("friend_list_create", "post", reverse("friend_list"), {"friend": context["stranger"].username}, True),
+		("friend_request_accept", "post", reverse("friend_request", args=(context["friend_request_to_accept"].id,)), {"accepted": True}, True),
+		("chat_list_create_group_create", "post", reverse("chat_list_create_group"), {"group_name": "bench_new_group"}, True),
+		("ind_chat", "post", reverse("ind_chat"), {"friend_name": context["friend_without_chat"].username}, True),
+		("chat_detail_add_member", "post", reverse("chat_detail", args=(group_chat,)), {"friends": [{"friend": friend.username} for friend in context["friends_outside_group"]]}, True),
+		("chat_detail_leave", "delete", reverse("chat_detail", args=(context["group_to_leave"].id,)), None, True),
+		("message_list_create", "post", reverse("message_list", args=(direct_chat,)), {"content": "benchmark"}, True),
+		("create_user", "post", reverse("create_user"), {"email": "bench@bench.com", "username": "bench_signup", "password": BENCH_PASSWORD}, False),
+		("upload_profile_pic", "put", reverse("upload_profile_pic"), {"profile_pic": small_png()}, True),
+	]
+
+# EMPTIES EVERY CACHE SO EACH CALL IS MEASURED ON ITS COLD PATH
+def clear_caches():
+	for cache in caches.all():
+		cache.clear()
+	local_cache.clear()
+
+# CALLS EVERY ENDPOINT ONCE AND RETURNS ITS MEASUREMENTS, THE DATASET MUST ALREADY BE SEEDED
+def run_benchmarks(context):
+	client = APIClient()
+	report = {}
+	for name, method, url, data, authenticated in endpoint_calls(context):
+		headers = {"HTTP_AUTHORIZATION": f"JWT {context['token']}"} if authenticated else {}
+		format = "multipart" if method == "put" else "json"
+		clear_caches()
+		recorder = QueryRecorder()
+		start = time.perf_counter()
+		with connection.execute_wrapper(recorder):
+			response = getattr(client, method)(url, data, format=format, secure=True, **headers)
+		wall_time = time.perf_counter() - start
+		report[name] = {
+			"method": method.upper(),
+			"url": url,
+			"status": response.status_code,
+			"queries": recorder.count,
+			"query_budget": QUERY_BUDGETS[name],
+			"sql_time_ms": round(recorder.time * 1000, 3),
+			"wall_time_ms": round(wall_time * 1000, 3),
+		}
+	return report
+
+# RETURNS THE ENDPOINTS OF A REPORT THAT WENT OVER THEIR QUERY BUDGET
+def over_budget(report):
+	return {name: result for name, result in report.items() if result["queries"] > result["query_budget"]}
@@ -0,0 +1,66 @@
+from django.conf import settings
+from django.db.models import Q
+
+from .membership import LocalCache
+from .models import Message
+
+# IDEMPOTENT MESSAGE SUBMISSION
+# A CLIENT MAY SEND A CLIENT_ID WITH A MESSAGE, A RETRY WITH THE SAME CLIENT_ID GETS THE ORIGINAL MESSAGE BACK
+# WITHOUT A SECOND INSERT OR A SECOND FAN OUT
+# THE MESSAGES OF THE LAST MESSAGE_DEDUP_TTL SECONDS ARE KEPT IN MEMORY, SO A FAST RETRY IS ANSWERED WITHOUT THE DATABASE
+# AN OLDER ONE IS FOUND WHEN THE MESSAGES ARE SAVED, AND THE (AUTHOR, CLIENT_ID) CONSTRAINT CATCHES WHAT IS LEFT
+
+CLIENT_ID_MAX_LENGTH = Message._meta.get_field('client_id').max_length
+
+# (AUTHOR, CLIENT_ID) -> MESSAGE, THE MESSAGE MAY STILL BE WAITING IN THE WRITE BEHIND BUFFER (ITS SEQ IS THEN NONE)
+recent_messages = LocalCache(settings.MESSAGE_DEDUP_SIZE, settings.MESSAGE_DEDUP_TTL)
+
+
+def dedup_key(author_id, client_id):
+	return f"{author_id}:{client_id}"
+
+def is_valid_client_id(client_id):
+	return isinstance(client_id, str) and 0 < len(client_id) <= CLIENT_ID_MAX_LENGTH
+
+# RETURNS THE RECENT MESSAGE OF THE AUTHOR WITH THAT CLIENT_ID, NONE IF THERE IS NONE IN MEMORY
+def recent(author_id, client_id):
+	return recent_messages.get(dedup_key(author_id, client_id))
+
+def remember(messages):
+	for message in messages:
+		if message.client_id:
+			recent_messages.set(dedup_key(message.author_id, message.client_id), message)
+
+# A MESSAGE THAT COULD NOT BE SAVED MUST NOT ANSWER ITS RETRIES
+def forget(messages):
+	for message in messages:
+		if message.client_id and recent(message.author_id, message.client_id) is message:
+			recent_messages.delete(dedup_key(message.author_id, message.client_id))
+
+# FINDS THE MESSAGES ABOUT TO BE SAVED THAT ALREADY EXIST, ONE QUERY AND ONLY IF ONE OF THEM HAS A CLIENT_ID
+# RETURNS {ID OF THE DUPLICATE: ORIGINAL MESSAGE}, A CLIENT_ID REPEATED IN THE SAME BATCH POINTS TO ITS FIRST MESSAGE
+def find_duplicates(messages):
+	keyed = [message for message in messages if message.client_id]
+	if not keyed:
+		return {}
+	client_ids = {}
+	for message in keyed:
+		client_ids.setdefault(message.author_id, set()).add(message.client_id)
+	condition = Q()
+	for author_id, ids in client_ids.items():
+		condition |= Q(author_id=author_id, client_id__in=ids)
+	originals = {(message.author_id, message.client_id): message for message in Message.objects.filter(condition)}
+
+	duplicates = {}
+	for message in keyed:
+		original = originals.setdefault((message.author_id, message.client_id), message)
+		if original is not message:
+			duplicates[message.id] = original
+	return duplicates
+
+# THE SAVED MESSAGE OF THE AUTHOR WITH THAT CLIENT_ID, FROM MEMORY OR FROM THE DATABASE
+def find_original(author_id, client_id):
+	original = recent(author_id, client_id)
+	if original is None:
+		original = Message.objects.filter(author_id=author_id, client_id=client_id).first()
+	return original
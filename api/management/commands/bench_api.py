@@ -0,0 +1,47 @@
+import json
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import override_settings
+
+from api.benchmarks import seed, run_benchmarks, over_budget
+
+
+class Command(BaseCommand):
+	help = (
+		"Query budget benchmarks for every REST endpoint. Seeds a throwaway test database at the given scale, "
+		"calls each endpoint once and reports its query count, SQL time and wall time. "
+		"Fails when an endpoint goes over its query budget."
+	)
+
+	def add_arguments(self, parser):
+		parser.add_argument('--scale', type=int, default=50, help="Dataset size multiplier, 50 seeds about 2000 users and 50000 messages")
+		parser.add_argument('--report', help="Path of the JSON report, printed to stdout if omitted")
+		parser.add_argument('--no-budget', action='store_true', help="Only report, never fail on a query budget")
+
+	def handle(self, *args, **options):
+		old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+		try:
+			# THE PROFILE PICTURE UPLOAD MUST NOT WRITE INTO THE REAL MEDIA ROOT
+			# THE BUDGETS ARE MEASURED INSIDE A TRANSACTION, LIKE IN THE TEST SUITE
+			with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root), transaction.atomic():
+				context = seed(options['scale'])
+				report = run_benchmarks(context)
+				transaction.set_rollback(True)
+		finally:
+			connection.creation.destroy_test_db(old_name, verbosity=0)
+
+		report = {"scale": options['scale'], "vendor": connection.vendor, "endpoints": report}
+		if options['report']:
+			with open(options['report'], 'w') as report_file:
+				json.dump(report, report_file, indent=2, sort_keys=True)
+		else:
+			self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
+
+		for name, result in report["endpoints"].items():
+			self.stderr.write(f"{name:<32}{result['status']:<6}{result['queries']:>4}/{result['query_budget']:<4}{result['sql_time_ms']:>10.2f}ms sql{result['wall_time_ms']:>10.2f}ms wall")
+
+		exceeded = over_budget(report["endpoints"])
+		if exceeded and not options['no_budget']:
+			raise CommandError(f"Over the query budget: {', '.join(exceeded)}")
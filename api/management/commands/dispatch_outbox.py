@@ -0,0 +1,30 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+from asgiref.sync import async_to_sync
+
+from api.outbox import OutboxDispatcher
+
+
+class Command(BaseCommand):
+	help = (
+		"Sends the real time events of the outbox to the channel layer. "
+		"Needed when the HTTP workers are not ASGI workers with OUTBOX_DISPATCH_IN_WORKER enabled."
+	)
+
+	def add_arguments(self, parser):
+		parser.add_argument('--once', action='store_true', help="Send what is waiting and exit")
+
+	def handle(self, *args, **options):
+		dispatcher = OutboxDispatcher.from_settings()
+		if options['once']:
+			async_to_sync(dispatcher.drain)()
+			return
+		async_to_sync(self.run)(dispatcher)
+
+	async def run(self, dispatcher):
+		dispatcher.start()
+		try:
+			await dispatcher.task
+		except asyncio.CancelledError:
+			await dispatcher.stop()
@@ -0,0 +1,163 @@
+import bisect
+import itertools
+import random
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from users.models import CustomUser
+from api import seeding
+
+
+# CUMULATIVE WEIGHTS OF THE USERS FOR THE FRIENDSHIP GRAPH
+# UNIFORM GIVES EVERYONE ABOUT THE SAME NUMBER OF FRIENDS, POWERLAW A FEW HUBS AND A LONG TAIL
+def degree_weights(count, distribution, exponent, rng):
+	if distribution == "uniform":
+		weights = (1.0 for _ in range(count))
+	else:
+		weights = (rng.paretovariate(exponent - 1) for _ in range(count))
+	return list(itertools.accumulate(weights))
+
+# SPLITS TOTAL MESSAGES BETWEEN COUNT CHATS FOLLOWING A ZIPF LAW, THE RANKS ARE SHUFFLED
+def zipf_counts(total, count, skew, rng):
+	if not count:
+		return []
+	weights = [1 / rank ** skew for rank in range(1, count + 1)]
+	scale = total / sum(weights)
+	counts = [int(weight * scale) for weight in weights]
+	for rank in range(total - sum(counts)):
+		counts[rank % count] += 1
+	rng.shuffle(counts)
+	return counts
+
+def chunks(iterable, size):
+	iterator = iter(iterable)
+	while True:
+		chunk = list(itertools.islice(iterator, size))
+		if not chunk:
+			return
+		yield chunk
+
+
+class Command(BaseCommand):
+	help = (
+		"Generates a synthetic dataset of users, friendships, individual and group chats and message histories "
+		"with batched bulk inserts, e.g. `python manage.py generate_dataset --users 100000 --messages 10000000`."
+	)
+
+	def add_arguments(self, parser):
+		parser.add_argument('--users', type=int, default=1000)
+		parser.add_argument('--prefix', default="user", help="Username prefix, the users are named <prefix>_<n>")
+		parser.add_argument('--password', help="Password of every user, unusable if omitted")
+		parser.add_argument('--friends', type=float, default=20, help="Average number of friends per user")
+		parser.add_argument('--degree', choices=["uniform", "powerlaw"], default="powerlaw", help="Distribution of the number of friends")
+		parser.add_argument('--degree-exponent', type=float, default=2.5, help="Exponent of the power law degree distribution, above 2")
+		parser.add_argument('--dm-ratio', type=float, default=0.3, help="Fraction of the friendships with an individual chat")
+		parser.add_argument('--groups', type=int, default=100, help="Number of group chats")
+		parser.add_argument('--group-size', type=int, nargs=2, default=[3, 50], metavar=("MIN", "MAX"), help="Bounds of the members per group chat")
+		parser.add_argument('--messages', type=int, default=100000, help="Total number of messages")
+		parser.add_argument('--message-skew', type=float, default=1.1, help="Zipf exponent of the messages per chat, 0 for an even split")
+		parser.add_argument('--days', type=float, default=30, help="The histories span this many days up to now")
+		parser.add_argument('--batch-size', type=int, default=seeding.BATCH_SIZE)
+		parser.add_argument('--seed', type=int, default=0)
+
+	# EVERY CHUNK IS ITS OWN TRANSACTION, AN INTERRUPTED RUN KEEPS WHAT IT ALREADY WROTE
+	def handle(self, *args, **options):
+		if options['users'] < 2:
+			raise CommandError("At least two users are needed")
+		if options['degree'] == "powerlaw" and options['degree_exponent'] <= 2:
+			raise CommandError("The degree exponent must be above 2")
+		min_size, max_size = options['group_size']
+		if not 2 <= min_size <= max_size <= options['users']:
+			raise CommandError("The group size bounds must be between 2 and the number of users")
+		if CustomUser.objects.filter(username__startswith=f"{options['prefix']}_").exists():
+			raise CommandError(f"There already are users named {options['prefix']}_<n>, pick another --prefix")
+
+		self.rng = random.Random(options['seed'])
+		self.batch_size = options['batch_size']
+		self.start = time.perf_counter()
+
+		user_ids = self.create_users(options)
+		dm_pairs = self.create_friendships(user_ids, options)
+		group_specs = self.group_specs(user_ids, options)
+		self.create_chats(user_ids, dm_pairs, group_specs, options)
+
+	def log(self, text):
+		self.stdout.write(f"[{time.perf_counter() - self.start:8.1f}s] {text}")
+
+	def create_users(self, options):
+		user_ids = []
+		for chunk in chunks(range(options['users']), self.batch_size):
+			with transaction.atomic():
+				users = seeding.create_users((f"{options['prefix']}_{i}" for i in chunk), password=options['password'], batch_size=self.batch_size)
+				user_ids.extend(user.id for user in users)
+		self.log(f"{len(user_ids)} users")
+		return user_ids
+
+	# CHUNG LU GRAPH, THE ENDS OF EVERY EDGE ARE DRAWN IN PROPORTION TO THE WEIGHTS OF THE USERS
+	# SELF LOOPS ARE DROPPED AND REPEATED EDGES ARE IGNORED BY THE INSERT, SO THE AVERAGE COMES OUT SLIGHTLY LOWER
+	# RETURNS THE USER INDEX PAIRS THAT ALSO GET AN INDIVIDUAL CHAT
+	def create_friendships(self, user_ids, options):
+		cumulative = degree_weights(len(user_ids), options['degree'], options['degree_exponent'], self.rng)
+		total_weight = cumulative[-1]
+		edges = int(len(user_ids) * options['friends'] / 2)
+
+		def draw():
+			return bisect.bisect(cumulative, self.rng.random() * total_weight)
+
+		dm_pairs = []
+		dm_keys = set()
+		for chunk in chunks(range(edges), self.batch_size):
+			pairs = []
+			for _ in chunk:
+				first, second = sorted((draw(), draw()))
+				if first == second:
+					continue
+				pairs.append((user_ids[first], user_ids[second]))
+				key = first * len(user_ids) + second
+				if key not in dm_keys and self.rng.random() < options['dm_ratio']:
+					dm_keys.add(key)
+					dm_pairs.append((first, second))
+			with transaction.atomic():
+				seeding.create_friendships(pairs, batch_size=self.batch_size)
+		self.log(f"about {edges} friendships")
+		return dm_pairs
+
+	# RETURNS THE MEMBER INDEXES OF EVERY GROUP CHAT, THE SIZES ARE SKEWED TOWARDS THE MINIMUM
+	def group_specs(self, user_ids, options):
+		min_size, max_size = options['group_size']
+		specs = []
+		for _ in range(options['groups']):
+			size = min(max_size, int(min_size * self.rng.paretovariate(1.5)))
+			specs.append(self.rng.sample(range(len(user_ids)), size))
+		return specs
+
+	# CREATES THE CHATS AND THEIR HISTORIES ONE CHUNK AT A TIME, THE MESSAGE COUNTS ARE DRAWN UPFRONT FOR ALL OF THEM
+	def create_chats(self, user_ids, dm_pairs, group_specs, options):
+		counts = zipf_counts(options['messages'], len(dm_pairs) + len(group_specs), options['message_skew'], self.rng)
+		span = timedelta(days=options['days'])
+		start = timezone.now() - span
+		messages = 0
+
+		dm_counts, group_counts = counts[:len(dm_pairs)], counts[len(dm_pairs):]
+		for chunk in chunks(zip(dm_pairs, dm_counts), self.batch_size):
+			with transaction.atomic():
+				chats = seeding.create_direct_chats(((user_ids[first], user_ids[second]) for (first, second), count in chunk), batch_size=self.batch_size)
+				histories = ((chat, member_ids, count) for (chat, member_ids), (pair, count) in zip(chats, chunk))
+				messages += seeding.create_messages(histories, start=start, span=span, batch_size=self.batch_size)
+		self.log(f"{len(dm_pairs)} individual chats")
+
+		for i, chunk in enumerate(chunks(zip(group_specs, group_counts), self.batch_size)):
+			offset = i * self.batch_size
+			with transaction.atomic():
+				chats = seeding.create_group_chats(
+					((f"group_{offset + j}", [user_ids[member] for member in members]) for j, (members, count) in enumerate(chunk)),
+					batch_size=self.batch_size,
+				)
+				histories = ((chat, member_ids, count) for (chat, member_ids), (members, count) in zip(chats, chunk))
+				messages += seeding.create_messages(histories, start=start, span=span, batch_size=self.batch_size)
+		self.log(f"{len(group_specs)} group chats")
+		self.log(f"{messages} messages")
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.models import Message, MessageTerm
+from api.search import index_messages
+
+
+class Command(BaseCommand):
+	help = (
+		"Rebuilds the message search index from Message.content. "
+		"Needed after changing the tokenizer, the messages written before the index existed are indexed by migration 0016."
+	)
+
+	def add_arguments(self, parser):
+		parser.add_argument('--chat', help="Only rebuild the index of this chat")
+		parser.add_argument('--batch-size', type=int, default=5000)
+
+	def handle(self, *args, **options):
+		messages = Message.objects.only('id', 'chat', 'content').order_by('chat', 'seq')
+		if options['chat']:
+			messages = messages.filter(chat=options['chat'])
+
+		# EACH BATCH REPLACES THE TERMS OF ITS MESSAGES IN ITS OWN TRANSACTION
+		# SEARCH KEEPS WORKING DURING THE REBUILD AND A LARGE REBUILD DOES NOT HOLD ONE LONG TRANSACTION
+		batch_size = options['batch_size']
+		batch = []
+		total = 0
+		for message in messages.iterator(chunk_size=batch_size):
+			batch.append(message)
+			if len(batch) >= batch_size:
+				total += self.index(batch, batch_size)
+				batch = []
+		total += self.index(batch, batch_size)
+		self.stdout.write(f"Indexed {total} messages")
+
+	def index(self, messages, batch_size):
+		with transaction.atomic():
+			MessageTerm.objects.filter(message__in=[message.id for message in messages]).delete()
+			index_messages(messages, batch_size)
+		return len(messages)
@@ -0,0 +1,106 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+# IN PROCESS LRU CACHE WITH A TTL, THE FIRST TIER OF THE MEMBERSHIP CACHE
+class LocalCache:
+
+	def __init__(self, max_entries, ttl):
+		self.max_entries = max_entries
+		self.ttl = ttl
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, key):
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is None:
+				return None
+			if entry[0] <= time.monotonic():
+				del self.entries[key]
+				return None
+			self.entries.move_to_end(key)
+			return entry[1]
+
+	def set(self, key, value):
+		with self.lock:
+			self.entries[key] = (time.monotonic() + self.ttl, value)
+			self.entries.move_to_end(key)
+			while len(self.entries) > self.max_entries:
+				self.entries.popitem(last=False)
+
+	def delete(self, key):
+		with self.lock:
+			self.entries.pop(key, None)
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+
+
+# MEMBERSHIP CACHE, USER -> CHAT IDS AND CHAT -> MEMBER IDS, ALL IDS ARE STRINGS
+# THE FIRST TIER LIVES IN THE WORKER, THE SECOND ONE IS THE DJANGO CACHE NAMED BY CHAT_MEMBERSHIP_CACHE
+# THE SECOND TIER IS SHARED (REDIS) SO AN INVALIDATION REACHES EVERY WORKER, THE FIRST ONE EXPIRES AFTER CHAT_MEMBERSHIP_LOCAL_TTL
+local_cache = LocalCache(settings.CHAT_MEMBERSHIP_LOCAL_SIZE, settings.CHAT_MEMBERSHIP_LOCAL_TTL)
+
+def shared_cache():
+	return caches[settings.CHAT_MEMBERSHIP_CACHE]
+
+def user_key(user_id):
+	return f"membership:user:{user_id}"
+
+def chat_key(chat_id):
+	return f"membership:chat:{chat_id}"
+
+# LOOKS A KEY UP IN BOTH TIERS, RUNS THE QUERY AND FILLS THEM ON A MISS
+def load(key, query):
+	value = local_cache.get(key)
+	if value is not None:
+		return value
+	value = shared_cache().get(key)
+	if value is None:
+		value = frozenset(f"{id}" for id in query())
+		shared_cache().set(key, value, settings.CHAT_MEMBERSHIP_TTL)
+	local_cache.set(key, value)
+	return value
+
+# THE CACHED_ FUNCTIONS ONLY READ THE IN PROCESS TIER AND RETURN NONE ON A MISS
+# THEY NEVER DO I/O SO THEY ARE SAFE TO CALL FROM ASYNC CODE
+def cached_user_chat_ids(user_id):
+	return local_cache.get(user_key(user_id))
+
+def cached_chat_member_ids(chat_id):
+	return local_cache.get(chat_key(chat_id))
+
+# RETURNS THE IDS OF THE CHATS OF A USER
+def get_user_chat_ids(user_id):
+	# IMPORTED HERE BECAUSE THE MODELS INVALIDATE THIS CACHE
+	from .models import ChatMember
+	return load(user_key(user_id), lambda: ChatMember.objects.filter(member=user_id).values_list('chat', flat=True))
+
+# RETURNS THE IDS OF THE MEMBERS OF A CHAT
+def get_chat_member_ids(chat_id):
+	from .models import ChatMember
+	return load(chat_key(chat_id), lambda: ChatMember.objects.filter(chat=chat_id).values_list('member', flat=True))
+
+def is_chat_member(user_id, chat_id):
+	return f"{chat_id}" in get_user_chat_ids(user_id)
+
+# DROPS THE CACHED CHATS OF A USER, CALLED WHENEVER THE USER JOINS OR LEAVES A CHAT
+def invalidate_user(user_id):
+	local_cache.delete(user_key(user_id))
+	shared_cache().delete(user_key(user_id))
+
+# DROPS THE CACHED MEMBERS OF A CHAT, CALLED WHENEVER SOMEONE JOINS OR LEAVES IT
+def invalidate_chat(chat_id):
+	local_cache.delete(chat_key(chat_id))
+	shared_cache().delete(chat_key(chat_id))
+
+# INVALIDATES BOTH SIDES OF A MEMBERSHIP CHANGE
+def invalidate_membership(user_id, chat_id):
+	invalidate_user(user_id)
+	invalidate_chat(chat_id)
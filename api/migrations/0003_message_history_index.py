@@ -0,0 +1,19 @@
+# Generated by Django 3.2.7 on 2026-10-18 16:23
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat', 'date_sent', 'id'], name='message_history_idx'),
+        ),
+    ]
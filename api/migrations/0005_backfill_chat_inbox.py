@@ -0,0 +1,32 @@
+# Generated by Django 3.2.7 on 2026-10-18 16:24
+
+from django.db import migrations
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Substr
+
+PREVIEW_LENGTH = 100
+
+
+# FILLS THE INBOX FIELDS OF EVERY CHAT FROM ITS NEWEST MESSAGE
+def backfill_chat_inbox(apps, schema_editor):
+	Chat = apps.get_model('api', 'Chat')
+	Message = apps.get_model('api', 'Message')
+
+	newest = Message.objects.filter(chat=OuterRef('pk')).order_by('-date_sent', '-id')
+	Chat.objects.filter(id__in=Message.objects.values('chat')).update(
+		last_message=Subquery(newest.values('id')[:1]),
+		last_message_author=Subquery(newest.values('author')[:1]),
+		last_message_preview=Substr(Subquery(newest.values('content')[:1]), 1, PREVIEW_LENGTH),
+		modified_at=Subquery(newest.values('date_sent')[:1]),
+	)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_chat_inbox'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_chat_inbox, migrations.RunPython.noop),
+    ]
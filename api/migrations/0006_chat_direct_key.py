@@ -0,0 +1,18 @@
+# Generated by Django 3.2.7 on 2026-10-18 16:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_backfill_chat_inbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='direct_key',
+            field=models.CharField(blank=True, default=None, max_length=73, null=True, unique=True),
+        ),
+    ]
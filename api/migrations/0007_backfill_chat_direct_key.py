@@ -0,0 +1,39 @@
+# Generated by Django 3.2.7 on 2026-10-18 16:27
+
+from collections import defaultdict
+
+from django.db import migrations
+
+
+# SETS THE DIRECT KEY OF EVERY INDIVIDUAL CHAT WITH TWO MEMBERS
+# IF A PAIR ALREADY HAS SEVERAL CHATS ONLY THE FIRST ONE GETS THE KEY
+def backfill_direct_key(apps, schema_editor):
+	Chat = apps.get_model('api', 'Chat')
+	ChatMember = apps.get_model('api', 'ChatMember')
+
+	members = defaultdict(list)
+	for chat_id, member_id in ChatMember.objects.filter(chat__group_chat=False).order_by('chat').values_list('chat', 'member'):
+		members[chat_id].append(f"{member_id}")
+
+	chats = []
+	used_keys = set()
+	for chat_id, member_ids in members.items():
+		if len(member_ids) != 2:
+			continue
+		direct_key = ":".join(sorted(member_ids))
+		if direct_key in used_keys:
+			continue
+		used_keys.add(direct_key)
+		chats.append(Chat(id=chat_id, direct_key=direct_key))
+	Chat.objects.bulk_update(chats, ['direct_key'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_chat_direct_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_direct_key, migrations.RunPython.noop),
+    ]
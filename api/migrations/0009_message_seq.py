@@ -0,0 +1,23 @@
+# Generated by Django 3.2.7 on 2026-10-18 16:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_outbox_event'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='last_seq',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.BigIntegerField(null=True),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.2.7 on 2026-10-18 16:45
+
+from django.db import migrations
+
+BATCH_SIZE = 1000
+
+
+# NUMBERS THE MESSAGES OF EVERY CHAT BY (DATE_SENT, ID) AND SETS THE LAST SEQ OF THE CHAT
+# THE MESSAGES ARE STREAMED IN HISTORY INDEX ORDER SO MEMORY DOES NOT GROW WITH THE TABLE
+def backfill_message_seq(apps, schema_editor):
+	Chat = apps.get_model('api', 'Chat')
+	Message = apps.get_model('api', 'Message')
+
+	messages = []
+	last_seqs = {}
+	rows = Message.objects.order_by('chat', 'date_sent', 'id').values_list('id', 'chat').iterator(chunk_size=BATCH_SIZE)
+	for id, chat_id in rows:
+		seq = last_seqs.get(chat_id, 0) + 1
+		last_seqs[chat_id] = seq
+		messages.append(Message(id=id, seq=seq))
+		if len(messages) >= BATCH_SIZE:
+			Message.objects.bulk_update(messages, ['seq'])
+			messages = []
+	Message.objects.bulk_update(messages, ['seq'])
+
+	chats = [Chat(id=chat_id, last_seq=seq) for chat_id, seq in last_seqs.items()]
+	Chat.objects.bulk_update(chats, ['last_seq'], batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_message_seq'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_message_seq, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 3.2.7 on 2026-10-18 16:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_backfill_message_seq'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='seq',
+            field=models.BigIntegerField(),
+        ),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='message_history_idx',
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('chat', 'seq'), name='message_chat_seq_unique'),
+        ),
+    ]
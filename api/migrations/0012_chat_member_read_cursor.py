@@ -0,0 +1,23 @@
+# Generated by Django 3.2.7 on 2026-10-18 16:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_message_seq_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmember',
+            name='last_read_seq',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chatmember',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
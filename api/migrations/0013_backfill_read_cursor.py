@@ -0,0 +1,25 @@
+# Generated by Django 3.2.7 on 2026-10-18 16:50
+
+from django.db import migrations
+from django.db.models import OuterRef, Subquery
+
+
+# EXISTING MEMBERS START WITH EVERYTHING READ, THERE IS NO READ STATE TO CARRY OVER
+def backfill_read_cursor(apps, schema_editor):
+	Chat = apps.get_model('api', 'Chat')
+	ChatMember = apps.get_model('api', 'ChatMember')
+
+	ChatMember.objects.update(
+		last_read_seq=Subquery(Chat.objects.filter(id=OuterRef('chat')).values('last_seq')[:1]),
+	)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_chat_member_read_cursor'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_read_cursor, migrations.RunPython.noop),
+    ]
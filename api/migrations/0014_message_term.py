@@ -0,0 +1,27 @@
+# Generated by Django 3.2.7 on 2026-10-18 16:52
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_backfill_read_cursor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=32)),
+                ('tf', models.PositiveSmallIntegerField(default=1)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='api.chat')),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='terms', to='api.message')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['term', 'chat'], name='message_term_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.2.7 on 2026-10-18 18:02
+
+from django.db import migrations
+
+from api.search import tokenize, TF_MAX
+
+BATCH_SIZE = 5000
+
+
+# INDEXES THE MESSAGES WRITTEN BEFORE THE SEARCH INDEX EXISTED, THE ONES THAT HAVE TERMS WERE INDEXED WHEN THEY WERE SAVED
+# THE MESSAGES ARE READ AND THE TERMS INSERTED IN BATCHES, SO THEY ARE NEVER ALL IN MEMORY
+def backfill_message_term(apps, schema_editor):
+	Message = apps.get_model('api', 'Message')
+	MessageTerm = apps.get_model('api', 'MessageTerm')
+
+	messages = Message.objects.filter(terms__isnull=True).only('id', 'chat', 'content').order_by()
+	terms = []
+	for message in messages.iterator(chunk_size=BATCH_SIZE):
+		terms.extend(
+			MessageTerm(term=term, message_id=message.id, chat_id=message.chat_id, tf=min(tf, TF_MAX))
+			for term, tf in tokenize(message.content).items()
+		)
+		if len(terms) >= BATCH_SIZE:
+			MessageTerm.objects.bulk_create(terms)
+			terms = []
+	MessageTerm.objects.bulk_create(terms)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_message_client_id'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_message_term, migrations.RunPython.noop),
+    ]
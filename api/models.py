@@ -1,22 +1,66 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, OuterRef, Subquery, Count, Case, When, Value
+from django.db.models.functions import Coalesce, Least
 from django.contrib.auth import get_user_model
 from django.utils import timezone
 import uuid
 
+from .membership import invalidate_membership
+
+# NUMBER OF CHARACTERS OF THE LAST MESSAGE SHOWN IN THE INBOX
+PREVIEW_LENGTH = 100
+
 class Chat(models.Model):
 	id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
 	group_chat = models.BooleanField(default=False)
 	name = models.CharField(max_length=24, default="not_assigned")
+	# CANONICAL KEY OF THE PAIR OF USERS OF AN INDIVIDUAL CHAT, UNIQUE SO THERE IS ONLY ONE CHAT PER PAIR
+	direct_key = models.CharField(max_length=73, unique=True, null=True, blank=True, default=None)
+
+	# INBOX READ MODEL, DENORMALIZED FROM THE NEWEST MESSAGE ON EVERY MESSAGE WRITE
+	last_message = models.ForeignKey('Message', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+	last_message_author = models.ForeignKey(get_user_model(), on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+	last_message_preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True, default="")
+	modified_at = models.DateTimeField(default=timezone.now, db_index=True)
+	# SEQUENCE NUMBER OF THE NEWEST MESSAGE, EVERY MESSAGE GETS THE NEXT ONE
+	last_seq = models.BigIntegerField(default=0)
 
 	def add_member(self, member):
 		if self.chat_for_member.count() >= 2 and not self.group_chat:
 			raise Exception("Too many members in this chat")
 		self.chat_for_member.add(member, bulk=False)
+		# ONLY ONCE THE ROW IS COMMITTED, OTHERWISE A CONCURRENT LOOKUP CAN CACHE THE OLD MEMBERSHIP AGAIN
+		transaction.on_commit(lambda: invalidate_membership(member.member_id, self.id))
+
+	# RESERVES COUNT CONSECUTIVE SEQUENCE NUMBERS OF A CHAT AND RETURNS THE FIRST ONE
+	# THE UPDATE LOCKS THE CHAT ROW UNTIL THE TRANSACTION ENDS, CALL IT IN THE TRANSACTION THAT SAVES THE MESSAGES
+	@classmethod
+	def allocate_seq(cls, chat_id, count=1):
+		cls.objects.filter(id=chat_id).update(last_seq=F('last_seq') + count)
+		return cls.objects.filter(id=chat_id).values_list('last_seq', flat=True).get() - count + 1
+
+	# THE KEY DOES NOT DEPEND ON THE ORDER OF THE USERS
+	@staticmethod
+	def direct_key_for(user, friend):
+		return ":".join(sorted([f"{user.id}", f"{friend.id}"]))
+
+	# UPDATES THE INBOX FIELDS OF THE MESSAGE CHAT, AN OLDER MESSAGE NEVER REPLACES A NEWER ONE
+	@classmethod
+	def record_message(cls, message):
+		cls.objects.filter(id=message.chat_id, modified_at__lte=message.date_sent).update(
+			last_message=message.id,
+			last_message_author=message.author_id,
+			last_message_preview=message.content[:PREVIEW_LENGTH],
+			modified_at=message.date_sent,
+		)
 
 class ChatMember(models.Model):
 	id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
 	chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='chat_for_member')
 	member = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, related_name='chat_member')
+	# SEQ OF THE LAST MESSAGE THE MEMBER READ AND NUMBER OF MESSAGES OF OTHER MEMBERS AFTER IT
+	last_read_seq = models.BigIntegerField(default=0)
+	unread_count = models.PositiveIntegerField(default=0)
 
 	class Meta:
 		unique_together = [['chat', 'member']]
@@ -24,6 +68,35 @@ class ChatMember(models.Model):
 	def __str__(self):
 		return self.member.username
 
+	# EVERY OTHER MEMBER OF THE CHAT HAS COUNT MORE UNREAD MESSAGES, CALLED ON EVERY MESSAGE WRITE
+	@classmethod
+	def add_unread(cls, chat_id, author_id, count=1):
+		cls.objects.filter(chat=chat_id).exclude(member=author_id).update(unread_count=F('unread_count') + count)
+
+	# ADD_UNREAD FOR MANY CHATS IN ONE UPDATE, COUNTS MAPS (CHAT ID, AUTHOR ID) TO THE NUMBER OF NEW MESSAGES
+	# EVERY MEMBER GETS THE NEW MESSAGES OF ITS CHAT MINUS ITS OWN
+	@classmethod
+	def add_unread_counts(cls, counts):
+		totals = {}
+		for (chat_id, author_id), count in counts.items():
+			totals[chat_id] = totals.get(chat_id, 0) + count
+		total = Case(*[When(chat=chat_id, then=Value(count)) for chat_id, count in totals.items()], default=Value(0))
+		own = Case(*[When(chat=chat_id, member=author_id, then=Value(count)) for (chat_id, author_id), count in counts.items()], default=Value(0))
+		cls.objects.filter(chat__in=list(totals)).update(unread_count=F('unread_count') + total - own)
+
+	# MOVES THE READ CURSOR OF A MEMBER FORWARD AND RECOUNTS ITS UNREAD MESSAGES IN THE SAME UPDATE
+	# THE COUNT ONLY SCANS THE (CHAT, SEQ) INDEX AFTER THE NEW CURSOR
+	@classmethod
+	def mark_read(cls, chat_id, member_id, seq):
+		unread = Message.objects.filter(chat=OuterRef('chat'), seq__gt=seq).exclude(author=OuterRef('member'))\
+			.order_by().values('chat').annotate(count=Count('id')).values('count')
+		# A CURSOR PAST THE LAST MESSAGE WOULD MARK THE NEXT ONES AS READ, SO IT STOPS AT THE LAST SEQ OF THE CHAT
+		last_seq = Chat.objects.filter(id=OuterRef('chat')).values('last_seq')[:1]
+		return cls.objects.filter(chat=chat_id, member=member_id, last_read_seq__lt=seq).update(
+			last_read_seq=Least(seq, Subquery(last_seq)),
+			unread_count=Coalesce(Subquery(unread), 0),
+		)
+
 
 class FriendsList(models.Model):
 	owner = models.OneToOneField(get_user_model(), on_delete=models.CASCADE, primary_key=True)
@@ -49,10 +122,36 @@ class Message(models.Model):
 	author = models.ForeignKey(get_user_model(), on_delete=models.SET_NULL, null=True, related_name='author')
 	content = models.TextField()
 	date_sent = models.DateTimeField(auto_now_add=True)
+	# POSITION OF THE MESSAGE IN ITS CHAT, ALLOCATED WITH CHAT.ALLOCATE_SEQ
+	seq = models.BigIntegerField()
+	# OPTIONAL IDEMPOTENCY KEY CHOSEN BY THE CLIENT, A RETRY WITH THE SAME ONE GETS THIS MESSAGE BACK, SEE api/dedup.py
+	client_id = models.CharField(max_length=64, null=True, blank=True)
+
+	class Meta:
+		constraints = [
+			# ALSO THE INDEX OF THE PAGINATED HISTORY AND OF THE SYNC ENDPOINT, SEE api/pagination.py AND api/sync.py
+			models.UniqueConstraint(fields=['chat', 'seq'], name='message_chat_seq_unique'),
+			models.UniqueConstraint(fields=['author', 'client_id'], condition=models.Q(client_id__isnull=False), name='message_author_client_id_unique'),
+		]
 
 	def __str__(self):
 		return self.content
 
+# INVERTED INDEX OF THE MESSAGE CONTENTS, ONE ROW PER (TERM, MESSAGE), SEE api/search.py
+# THE CHAT IS COPIED FROM THE MESSAGE SO A SEARCH IS RESTRICTED TO THE CHATS OF THE USER WITHOUT A JOIN
+class MessageTerm(models.Model):
+	term = models.CharField(max_length=32)
+	message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='terms')
+	chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='+')
+	# NUMBER OF TIMES THE TERM APPEARS IN THE MESSAGE
+	tf = models.PositiveSmallIntegerField(default=1)
+
+	class Meta:
+		indexes = [models.Index(fields=['term', 'chat'], name='message_term_idx')]
+
+	def __str__(self):
+		return self.term
+
 class FriendRequest(models.Model):
 	id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
 	user_sender = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, related_name="sent_by")
@@ -69,3 +168,16 @@ class FriendRequest(models.Model):
 
 	def __str__(self):
 		return f'{self.user_sender} to {self.user_receiver}'
+
+
+# TRANSACTIONAL OUTBOX FOR THE REAL TIME EVENTS, WRITTEN IN THE SAME TRANSACTION AS THE CHANGE THEY ANNOUNCE
+# THE AUTO INCREMENT ID KEEPS THE EVENTS IN ORDER, THE DISPATCHER IN api/outbox.py SENDS AND DELETES THEM
+class OutboxEvent(models.Model):
+	groups = models.JSONField()
+	event = models.JSONField()
+	created_at = models.DateTimeField(default=timezone.now)
+	# A DISPATCHER OWNS THE EVENT UNTIL THEN, IF IT DIES THE EVENT IS PICKED UP AGAIN
+	locked_until = models.DateTimeField(null=True, blank=True, db_index=True)
+
+	def __str__(self):
+		return f'{self.event.get("type")} to {self.groups}'
@@ -0,0 +1,146 @@
+import asyncio
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+
+from .models import OutboxEvent
+
+
+# MICROSECONDS SINCE THE EPOCH, THE SEQ OF THE EVENTS THAT ARE NOT MESSAGES
+def event_seq():
+	return time.time_ns() // 1000
+
+# QUEUES A REAL TIME EVENT FOR THE GIVEN GROUPS
+# CALL IT INSIDE THE TRANSACTION OF THE CHANGE IT ANNOUNCES, A ROLLBACK DROPS THE EVENT AS WELL
+def publish(groups, event):
+	OutboxEvent.objects.create(groups=[f"{group}" for group in groups], event=dict(event, seq=event_seq()))
+	transaction.on_commit(dispatcher.wake)
+
+
+# SENDS THE OUTBOX EVENTS TO THE CHANNEL LAYER
+# EVENTS ARE CLAIMED IN BATCHES BY SETTING LOCKED_UNTIL, SENT AND THEN DELETED, SO DELIVERY IS AT LEAST ONCE
+# THE GROUPS OF A BATCH ARE SENT CONCURRENTLY, THE EVENTS OF ONE GROUP IN ORDER
+# AN EVENT IS NOT CLAIMED WHILE AN OLDER ONE OF ANY OF ITS GROUPS IS LOCKED, SO THE ORDER HOLDS ACROSS DISPATCHERS AND RETRIES
+# IT WAKES UP WHEN A REQUEST COMMITS AN EVENT IN THIS PROCESS AND POLLS FOR THE ONES WRITTEN ELSEWHERE
+class OutboxDispatcher:
+
+	def __init__(self, batch_size, poll_interval, lock_timeout):
+		self.batch_size = batch_size
+		self.poll_interval = poll_interval
+		self.lock_timeout = lock_timeout
+		self.loop = None
+		self.task = None
+
+	@classmethod
+	def from_settings(cls):
+		return cls(
+			batch_size=settings.OUTBOX_BATCH_SIZE,
+			poll_interval=settings.OUTBOX_POLL_INTERVAL,
+			lock_timeout=settings.OUTBOX_LOCK_TIMEOUT,
+		)
+
+	# STARTS THE DISPATCHER TASK ON THE RUNNING EVENT LOOP
+	def start(self):
+		loop = asyncio.get_event_loop()
+		if self.loop is loop and self.task and not self.task.done():
+			return
+		self.loop = loop
+		self.stopping = False
+		self.pending = asyncio.Event()
+		self.task = loop.create_task(self.run())
+
+	# SAFE TO CALL FROM ANY THREAD, DOES NOTHING IF THE DISPATCHER IS NOT RUNNING IN THIS PROCESS
+	def wake(self):
+		loop = self.loop
+		if loop is None or loop.is_closed() or not self.task or self.task.done():
+			return
+		loop.call_soon_threadsafe(self.pending.set)
+
+	async def run(self):
+		while not self.stopping:
+			self.pending.clear()
+			try:
+				sent = await self.dispatch()
+			except Exception as e:
+				print(e)
+				sent = 0
+			# A FULL BATCH MEANS THERE IS PROBABLY MORE WAITING
+			if sent < self.batch_size and not self.stopping:
+				try:
+					await asyncio.wait_for(self.pending.wait(), self.poll_interval)
+				except asyncio.TimeoutError:
+					pass
+
+	# SENDS ONE BATCH, RETURNS THE NUMBER OF EVENTS CLAIMED
+	async def dispatch(self):
+		events = await sync_to_async(self.claim)()
+		if not events:
+			return 0
+		by_group = {}
+		for id, groups, event in events:
+			for group in groups:
+				by_group.setdefault(group, []).append((id, event))
+
+		channel_layer = get_channel_layer()
+		failed = set()
+
+		async def send_group(group, group_events):
+			for id, event in group_events:
+				try:
+					await channel_layer.group_send(group, event)
+				except Exception as e:
+					print(e)
+					# THE REST OF THE GROUP WAITS FOR THE RETRY SO IT STAYS IN ORDER
+					failed.update(id for id, event in group_events)
+					return
+
+		await asyncio.gather(*[send_group(group, group_events) for group, group_events in by_group.items()])
+		# FAILED EVENTS STAY LOCKED AND ARE RETRIED ONCE THE LOCK EXPIRES
+		await sync_to_async(self.delete)([id for id, groups, event in events if id not in failed])
+		return len(events)
+
+	# LOCKS THE OLDEST BATCH OF AVAILABLE EVENTS
+	# AN EVENT THAT IS LOCKED (BEING SENT BY ANOTHER DISPATCHER OR WAITING FOR ITS RETRY) HOLDS BACK THE NEWER EVENTS OF ITS GROUPS
+	# THE SCANNED ROWS ARE LOCKED, SO TWO DISPATCHERS CLAIM ONE AFTER THE OTHER AND EACH SEES WHAT THE OTHER TOOK
+	def claim(self):
+		now = timezone.now()
+		with transaction.atomic():
+			rows = OutboxEvent.objects.select_for_update().order_by('id').values_list('id', 'groups', 'event', 'locked_until')[:self.batch_size]
+			held = set()
+			events = []
+			for id, groups, event, locked_until in rows:
+				if (locked_until and locked_until >= now) or held.intersection(groups):
+					held.update(groups)
+				else:
+					events.append((id, groups, event))
+			if events:
+				OutboxEvent.objects.filter(id__in=[id for id, groups, event in events]).update(
+					locked_until=now + timedelta(seconds=self.lock_timeout),
+				)
+		return events
+
+	def delete(self, ids):
+		if ids:
+			OutboxEvent.objects.filter(id__in=ids).delete()
+
+	# SENDS EVERYTHING THAT IS AVAILABLE RIGHT NOW
+	async def drain(self):
+		while await self.dispatch():
+			pass
+
+	async def stop(self):
+		if not self.task:
+			return
+		self.stopping = True
+		self.pending.set()
+		await self.task
+		self.task = None
+
+
+# ONE DISPATCHER PER WORKER PROCESS
+dispatcher = OutboxDispatcher.from_settings()
@@ -0,0 +1,70 @@
+import base64
+import uuid
+from datetime import datetime
+
+from django.conf import settings
+
+
+# ENCODES A (DATE, ID) PAIR AS AN OPAQUE URL SAFE CURSOR, USED BY THE INBOX
+def encode_cursor(date, id):
+	raw = f"{date.isoformat()}|{id}"
+	return base64.urlsafe_b64encode(raw.encode()).decode()
+
+# DECODES A CURSOR BACK INTO ITS (DATE, ID) PAIR, RAISES VALUEERROR IF IT IS MALFORMED
+def decode_cursor(cursor):
+	try:
+		raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+		date, id = raw.split("|")
+		return datetime.fromisoformat(date), uuid.UUID(id)
+	except Exception:
+		raise ValueError("Invalid cursor")
+
+# RETURNS THE PAGE SIZE REQUESTED BY THE CLIENT, CLAMPED BETWEEN 1 AND THE CONFIGURED MAXIMUM
+def get_page_size(value):
+	if value is None:
+		return settings.MESSAGE_PAGE_SIZE
+	try:
+		value = int(value)
+	except (TypeError, ValueError):
+		raise ValueError("Invalid limit")
+	return max(1, min(value, settings.MESSAGE_MAX_PAGE_SIZE))
+
+# ENCODES A MESSAGE SEQUENCE NUMBER AS AN OPAQUE URL SAFE CURSOR
+def encode_seq_cursor(seq):
+	return base64.urlsafe_b64encode(f"{seq}".encode()).decode()
+
+# DECODES A MESSAGE CURSOR BACK INTO ITS SEQUENCE NUMBER, RAISES VALUEERROR IF IT IS MALFORMED
+def decode_seq_cursor(cursor):
+	try:
+		return int(base64.urlsafe_b64decode(cursor.encode()).decode())
+	except Exception:
+		raise ValueError("Invalid cursor")
+
+# PAGINATES THE MESSAGES OF A CHAT OVER THEIR SEQUENCE NUMBER WITHOUT OFFSETS
+# WITHOUT CURSORS IT RETURNS THE NEWEST PAGE, "BEFORE" WALKS BACK IN HISTORY AND "AFTER" FETCHES NEWER MESSAGES
+# THE ROWS ARE ALWAYS RETURNED IN CHAT ORDER
+def paginate_messages(queryset, before=None, after=None, limit=None):
+	limit = get_page_size(limit)
+
+	if after:
+		queryset = queryset.filter(seq__gt=decode_seq_cursor(after))
+		rows = list(queryset.order_by('seq')[:limit + 1])
+		has_newer = len(rows) > limit
+		rows = rows[:limit]
+		has_older = True
+	else:
+		if before:
+			queryset = queryset.filter(seq__lt=decode_seq_cursor(before))
+		rows = list(queryset.order_by('-seq')[:limit + 1])
+		has_older = len(rows) > limit
+		rows = rows[:limit]
+		rows.reverse()
+		has_newer = bool(before)
+
+	first, last = (rows[0], rows[-1]) if rows else (None, None)
+	return {
+		"messages": rows,
+		"next_before": encode_seq_cursor(first["seq"]) if first and has_older else None,
+		"next_after": encode_seq_cursor(last["seq"]) if last else after,
+		"has_newer": has_newer,
+	}
@@ -1,17 +1,15 @@
 from rest_framework import permissions
 from users.models import CustomUser
 from .models import ChatMember, Chat, FriendsList, Friend
+from .membership import is_chat_member
 
 class IsChatMember(permissions.BasePermission):
 	def has_permission(self, request, view):
 		return True
 
+	# CHECKED AGAINST THE MEMBERSHIP CACHE, NO QUERY WHEN THE USER CHATS ARE CACHED
 	def has_object_permission(self, request, view, object):
-		try:
-			chat_member = ChatMember.objects.get(chat=object, member=request.user)
-		except:
-			return False
-		return True
+		return is_chat_member(request.user.id, object.id)
 
 class IsFriend(permissions.BasePermission):
 	message = 'The user is not in your friends list'
@@ -34,6 +32,6 @@ class IsRequestedUser(permissions.BasePermission):
 		return False
 
 	def has_object_permission(self, request, view, object):
-		if request.user != object.user_receiver:
+		if request.user.id != object.user_receiver_id:
 			return False
 		return True
@@ -0,0 +1,58 @@
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import Friend, FriendsList
+
+
+# SHARED BETWEEN WORKERS, A BUMP MUST REACH EVERY WORKER THAT ANSWERS FOR THE USER
+def roster_cache():
+	return caches[settings.FRIEND_ROSTER_CACHE]
+
+def version_key(user_id):
+	return f"roster:version:{user_id}"
+
+def roster_key(user_id, version):
+	return f"roster:{user_id}:{version}"
+
+# RETURNS THE ROSTER VERSION OF A USER
+# A MISSING COUNTER STARTS FROM THE CLOCK, SO AN EVICTED COUNTER NEVER REPEATS AN OLD VERSION (AND ETAG)
+def get_roster_version(user_id):
+	version = roster_cache().get(version_key(user_id))
+	if version is None:
+		roster_cache().add(version_key(user_id), time.time_ns(), None)
+		version = roster_cache().get(version_key(user_id))
+	return version
+
+# INVALIDATES THE CACHED ROSTERS OF THE GIVEN USERS
+def bump_roster_versions(user_ids):
+	for user_id in user_ids:
+		try:
+			roster_cache().incr(version_key(user_id))
+		except ValueError:
+			roster_cache().set(version_key(user_id), time.time_ns(), None)
+
+def roster_etag(user_id, version):
+	return f'"{user_id}-{version}"'
+
+# BUILDS THE ROSTER OF A USER WITH ONE JOINED QUERY, NONE IF THE USER HAS NO FRIENDS LIST
+def build_roster(user):
+	friends = Friend.objects.filter(friends_list__owner=user).select_related('friend').order_by('friend__username')
+	roster = [{
+		"name":friend.friend.username,
+		"profile_pic":friend.friend.profile_picture_url("small"),
+	} for friend in friends]
+	if not roster and not FriendsList.objects.filter(owner=user).exists():
+		return None
+	return roster
+
+# RETURNS THE ROSTER OF A USER AT THE GIVEN VERSION, CACHED UNDER THAT VERSION
+def get_roster(user, version):
+	key = roster_key(user.id, version)
+	cached = roster_cache().get(key)
+	if cached is not None:
+		return cached["friends"]
+	roster = build_roster(user)
+	roster_cache().set(key, {"friends": roster}, settings.FRIEND_ROSTER_TTL)
+	return roster
@@ -0,0 +1,107 @@
+import base64
+import math
+import re
+import unicodedata
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.db.models import Q, Sum, Count, Case, When, F, IntegerField
+
+from .models import Chat, ChatMember, Message, MessageTerm
+
+# FULL TEXT SEARCH OVER THE MESSAGES OF THE CHATS OF A USER
+# MESSAGE.CONTENT IS SPLIT INTO TERMS WHEN THE MESSAGE IS SAVED AND THE TERMS ARE KEPT IN MESSAGETERM
+# A SEARCH MATCHES THE MESSAGES THAT CONTAIN EVERY TERM OF THE QUERY, RANKED BY TF-IDF
+
+WORD = re.compile(r"\w+")
+TERM_MAX_LENGTH = MessageTerm._meta.get_field('term').max_length
+TF_MAX = 32767
+
+
+# LOWERCASES AND STRIPS THE ACCENTS SO "Canción" AND "cancion" ARE THE SAME TERM
+def normalize(text):
+	text = unicodedata.normalize("NFKD", text.casefold())
+	return "".join(char for char in text if not unicodedata.combining(char))
+
+# RETURNS A COUNTER OF THE TERMS OF A TEXT, ONE LETTER WORDS ARE LEFT OUT
+def tokenize(text):
+	terms = Counter()
+	for word in WORD.findall(normalize(text)):
+		if len(word) > 1:
+			terms[word[:TERM_MAX_LENGTH]] += 1
+	return terms
+
+def message_terms(message):
+	return [
+		MessageTerm(term=term, message_id=message.id, chat_id=message.chat_id, tf=min(tf, TF_MAX))
+		for term, tf in tokenize(message.content).items()
+	]
+
+# INDEXES SAVED MESSAGES WITH ONE BULK INSERT, CALLED ON EVERY WRITE PATH INSIDE THE TRANSACTION THAT SAVES THEM
+def index_messages(messages, batch_size=None):
+	MessageTerm.objects.bulk_create([term for message in messages for term in message_terms(message)], batch_size=batch_size)
+
+
+# ENCODES A (SCORE, MESSAGE ID) PAIR AS AN OPAQUE URL SAFE CURSOR
+def encode_search_cursor(score, id):
+	return base64.urlsafe_b64encode(f"{score}|{id}".encode()).decode()
+
+# DECODES A SEARCH CURSOR BACK INTO ITS (SCORE, MESSAGE ID) PAIR, RAISES VALUEERROR IF IT IS MALFORMED
+def decode_search_cursor(cursor):
+	try:
+		score, id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+		return int(score), uuid.UUID(id)
+	except Exception:
+		raise ValueError("Invalid cursor")
+
+# RETURNS THE PAGE SIZE REQUESTED BY THE CLIENT, CLAMPED BETWEEN 1 AND THE CONFIGURED MAXIMUM
+def get_search_limit(value):
+	if value is None:
+		return settings.SEARCH_PAGE_SIZE
+	try:
+		value = int(value)
+	except (TypeError, ValueError):
+		raise ValueError("Invalid limit")
+	return max(1, min(value, settings.SEARCH_MAX_PAGE_SIZE))
+
+# SEARCHES THE MESSAGES OF THE CHATS OF A USER, OPTIONALLY OF A SINGLE CHAT
+# THE SCORE IS AN INTEGER (TF-IDF TIMES 1000) SO THE (SCORE, ID) KEYSET IS EXACT BETWEEN PAGES
+# THE IDF COMES FROM THE CHATS OF THE USER, SO TERMS THAT ARE RARE IN THEIR CONVERSATIONS RANK FIRST
+def search_messages(user, query, chat_id=None, after=None, limit=None):
+	limit = get_search_limit(limit)
+	after = decode_search_cursor(after) if after else None
+	terms = sorted(tokenize(query))[:settings.SEARCH_MAX_TERMS]
+	result = {"results": [], "next_after": None}
+	if not terms:
+		return result
+
+	chats = ChatMember.objects.filter(member=user)
+	if chat_id:
+		chats = chats.filter(chat=chat_id)
+	postings = MessageTerm.objects.filter(term__in=terms, chat__in=chats.values('chat'))
+
+	# DOCUMENT FREQUENCY OF EACH TERM, A TERM THAT IS NOWHERE MEANS NO MESSAGE HAS THEM ALL
+	frequencies = dict(postings.order_by().values_list('term').annotate(count=Count('id')))
+	if len(frequencies) < len(terms):
+		return result
+	total = Chat.objects.filter(id__in=chats.values('chat')).aggregate(total=Sum('last_seq'))["total"] or 0
+	weights = {term: round(1000 * math.log(1 + total / frequency)) for term, frequency in frequencies.items()}
+
+	ranked = postings.order_by().values('message').annotate(
+		matched=Count('term'),
+		score=Sum(Case(*[When(term=term, then=F('tf') * weight) for term, weight in weights.items()], output_field=IntegerField())),
+	).filter(matched=len(terms))
+	if after:
+		score, id = after
+		ranked = ranked.filter(Q(score__lt=score) | Q(score=score, message__lt=id))
+	ranked = list(ranked.order_by('-score', '-message')[:limit + 1])
+	has_more = len(ranked) > limit
+	ranked = ranked[:limit]
+
+	messages = Message.objects.filter(id__in=[row["message"] for row in ranked]).select_related('author', 'chat')
+	messages = {message.id: message for message in messages}
+	result["results"] = [(messages[row["message"]], row["score"]) for row in ranked if row["message"] in messages]
+	if has_more:
+		result["next_after"] = encode_search_cursor(ranked[-1]["score"], ranked[-1]["message"])
+	return result
@@ -0,0 +1,119 @@
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Substr
+from django.utils import timezone
+
+from users.models import CustomUser
+from .models import Chat, ChatMember, FriendsList, Friend, Message, FriendRequest, PREVIEW_LENGTH
+from .search import index_messages
+
+# BULK INSERT HELPERS TO BUILD LARGE DATASETS FOR BENCHMARKS AND LOCAL INVESTIGATIONS
+# EVERYTHING IS WRITTEN WITH BULK_CREATE IN BATCHES, NOTHING GOES THROUGH THE VIEWS
+
+BATCH_SIZE = 5000
+
+
+# MESSAGE.DATE_SENT IS AUTO_NOW_ADD, THIS LETS THE SEEDER WRITE HISTORIC DATES
+@contextmanager
+def explicit_message_dates():
+	field = Message._meta.get_field('date_sent')
+	field.auto_now_add = False
+	try:
+		yield
+	finally:
+		field.auto_now_add = True
+
+# CREATES USERS WITH THE GIVEN NAMES, ALL SHARING ONE PASSWORD HASH
+def create_users(usernames, password=None, batch_size=BATCH_SIZE):
+	password = make_password(password)
+	users = [CustomUser(username=username, password=password) for username in usernames]
+	CustomUser.objects.bulk_create(users, batch_size=batch_size)
+	return users
+
+# MAKES EVERY (USER ID, USER ID) PAIR FRIENDS IN BOTH DIRECTIONS
+def create_friendships(pairs, batch_size=BATCH_SIZE):
+	pairs = list(pairs)
+	owners = {user_id for pair in pairs for user_id in pair}
+	FriendsList.objects.bulk_create([FriendsList(owner_id=owner) for owner in owners], batch_size=batch_size, ignore_conflicts=True)
+	friends = []
+	for user_id, friend_id in pairs:
+		friends.append(Friend(friends_list_id=user_id, friend_id=friend_id))
+		friends.append(Friend(friends_list_id=friend_id, friend_id=user_id))
+		if len(friends) >= batch_size:
+			Friend.objects.bulk_create(friends, ignore_conflicts=True)
+			friends = []
+	Friend.objects.bulk_create(friends, ignore_conflicts=True)
+
+# CREATES ONE INDIVIDUAL CHAT PER (USER ID, USER ID) PAIR, RETURNS (CHAT, MEMBER IDS) TUPLES
+def create_direct_chats(pairs, batch_size=BATCH_SIZE):
+	chats = []
+	for pair in pairs:
+		direct_key = ":".join(sorted(f"{user_id}" for user_id in pair))
+		chats.append((Chat(group_chat=False, direct_key=direct_key), list(pair)))
+	return save_chats(chats, batch_size)
+
+# CREATES ONE GROUP CHAT PER (NAME, MEMBER IDS) TUPLE, RETURNS (CHAT, MEMBER IDS) TUPLES
+def create_group_chats(groups, batch_size=BATCH_SIZE):
+	chats = [(Chat(group_chat=True, name=name[:24]), list(member_ids)) for name, member_ids in groups]
+	return save_chats(chats, batch_size)
+
+def save_chats(chats, batch_size):
+	Chat.objects.bulk_create([chat for chat, member_ids in chats], batch_size=batch_size)
+	members = [ChatMember(chat=chat, member_id=member_id) for chat, member_ids in chats for member_id in member_ids]
+	ChatMember.objects.bulk_create(members, batch_size=batch_size)
+	return chats
+
+# CREATES A PENDING FRIEND REQUEST PER (SENDER ID, RECEIVER ID) PAIR
+def create_friend_requests(pairs, batch_size=BATCH_SIZE):
+	requests = [FriendRequest(user_sender_id=sender, user_receiver_id=receiver) for sender, receiver in pairs]
+	FriendRequest.objects.bulk_create(requests, batch_size=batch_size, ignore_conflicts=True)
+	return requests
+
+# WRITES THE HISTORY OF EACH CHAT, HISTORIES IS AN ITERABLE OF (CHAT, AUTHOR IDS, MESSAGE COUNT)
+# MESSAGES ARE STREAMED IN BATCHES SO MEMORY DOES NOT GROW WITH THE HISTORY SIZE
+# AUTHORS ROTATE AND THE DATES GO FORWARD FROM START ONE INTERVAL AT A TIME, EVERY BATCH IS INDEXED FOR SEARCH
+# THE INBOX FIELDS AND LAST SEQ ARE FILLED AT THE END
+# WITH A SPAN EVERY HISTORY IS SPREAD EVENLY OVER IT INSTEAD, WHATEVER ITS LENGTH
+def create_messages(histories, start=None, interval=timedelta(seconds=30), batch_size=BATCH_SIZE, span=None):
+	start = start or timezone.now() - timedelta(days=30)
+	batch = []
+	chat_ids = []
+	total = 0
+	with explicit_message_dates():
+		for chat, author_ids, count in histories:
+			if span is not None and count:
+				interval = span / count
+			for i in range(count):
+				message = Message(
+					chat=chat,
+					author_id=author_ids[i % len(author_ids)],
+					content=f"message {i} of {chat.name}",
+					date_sent=start + i * interval,
+					seq=chat.last_seq + i + 1,
+				)
+				batch.append(message)
+				if len(batch) >= batch_size:
+					Message.objects.bulk_create(batch)
+					index_messages(batch, batch_size)
+					total += len(batch)
+					batch = []
+			if count:
+				chat_ids.append(chat.id)
+		Message.objects.bulk_create(batch)
+		index_messages(batch, batch_size)
+		total += len(batch)
+
+	# ONE UPDATE PER BATCH OF CHATS, THE DATABASE PICKS THE NEWEST MESSAGE FROM THE (CHAT, SEQ) INDEX
+	newest = Message.objects.filter(chat=OuterRef('pk')).order_by('-seq')
+	for i in range(0, len(chat_ids), batch_size):
+		Chat.objects.filter(id__in=chat_ids[i:i + batch_size]).update(
+			last_message=Subquery(newest.values('id')[:1]),
+			last_message_author=Subquery(newest.values('author')[:1]),
+			last_message_preview=Substr(Subquery(newest.values('content')[:1]), 1, PREVIEW_LENGTH),
+			modified_at=Subquery(newest.values('date_sent')[:1]),
+			last_seq=Subquery(newest.values('seq')[:1]),
+		)
+	return total
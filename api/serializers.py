@@ -1,5 +1,8 @@
+from django.db import IntegrityError, transaction
 from rest_framework import serializers
 from .models import  Message, Friend, Chat, ChatMember, FriendRequest
+from .search import index_messages
+from .dedup import find_original, remember, is_valid_client_id
 from users.models import CustomUser
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
 from rest_framework_simplejwt.settings import api_settings
@@ -11,14 +14,44 @@ class AddFriendSerializer(serializers.Serializer):
 class MessageSerializer(serializers.ModelSerializer):
 	class Meta:
 		model = Message
-		fields = ('content',)
+		fields = ('content', 'client_id')
 
+	# THE SAME RULE AS THE WEBSOCKET, A BLANK CLIENT_ID WOULD BE SAVED AND COLLIDE WITH THE NEXT BLANK ONE OF THE AUTHOR
+	def validate_client_id(self, value):
+		if value is not None and not is_valid_client_id(value):
+			raise serializers.ValidationError("Invalid client id")
+		return value
+
+	# A CLIENT_ID THE AUTHOR ALREADY USED RETURNS THE ORIGINAL MESSAGE AND SETS SELF.DUPLICATE, NOTHING IS SAVED
 	def save(self, author, chat):
-		message = Message.objects.create(
-			chat=chat,
-			content=self.validated_data["content"],
-			author=author,
-			)
+		client_id = self.validated_data.get("client_id")
+		self.duplicate = False
+		if client_id is not None:
+			original = find_original(author.id, client_id)
+			if original is not None:
+				self.duplicate = True
+				return original
+		try:
+			with transaction.atomic():
+				message = Message.objects.create(
+					chat=chat,
+					content=self.validated_data["content"],
+					author=author,
+					seq=Chat.allocate_seq(chat.id),
+					client_id=client_id,
+					)
+				# KEEPS THE INBOX OF THE CHAT AND THE UNREAD COUNTS OF THE OTHER MEMBERS UP TO DATE
+				Chat.record_message(message)
+				ChatMember.add_unread(chat.id, author.id)
+				index_messages([message])
+		except IntegrityError:
+			# A RETRY RUNNING AT THE SAME TIME SAVED IT FIRST
+			if client_id is None:
+				raise
+			self.duplicate = True
+			return Message.objects.get(author=author, client_id=client_id)
+		remember([message])
+		return message
 
 class ChatSerializer(serializers.ModelSerializer):
 	class Meta:
@@ -28,8 +61,8 @@ class ChatSerializer(serializers.ModelSerializer):
 class IndividualChatSerializer(serializers.Serializer):
 	friend_name = serializers.CharField()
 
-	def save(self):
-		chat = Chat.objects.create(group_chat=False)
+	def save(self, direct_key=None):
+		chat = Chat.objects.create(group_chat=False, direct_key=direct_key)
 		return chat
 
 class GroupChatSerializer(serializers.Serializer):
@@ -78,10 +111,7 @@ class MyTokenObtainPairSerializer(TokenObtainPairSerializer):
 	def get_token(cls, user):
 		token = super(MyTokenObtainPairSerializer, cls).get_token(user)
 		token['name'] = user.username
-		if user.profile_picture:
-			token['profile_pic'] = user.profile_picture.url
-		else:
-			token['profile_pic'] = ""
+		token['profile_pic'] = user.profile_picture_url("small")
 		return token
 
 class MyTokenRefreshPairSerializer(TokenRefreshSerializer):
@@ -92,7 +122,7 @@ class MyTokenRefreshPairSerializer(TokenRefreshSerializer):
 		access = refresh.access_token
 		user_id = access['user_id']
 		user = CustomUser.objects.filter(id=user_id).first()
-		access['profile_pic'] = user.profile_picture.url
+		access['profile_pic'] = user.profile_picture_url("small")
 		data = {'access': str(access)}
 
 		if api_settings.ROTATE_REFRESH_TOKENS:
@@ -0,0 +1,99 @@
+import base64
+import json
+import operator
+import uuid
+from datetime import datetime
+from functools import reduce
+
+from django.conf import settings
+from django.db.models import Q
+
+from .models import ChatMember, Message, FriendRequest
+from .roster import get_roster_version
+
+
+# THE SYNC CURSOR IS URL SAFE BASE64 OF {"c": {CHAT ID: LAST SEQ SEEN}, "f": DATE OF THE NEWEST FRIEND REQUEST SEEN}
+# IT IS OPAQUE FOR THE CLIENT, WHICH SENDS BACK THE ONE IT GOT IN ITS LAST SYNC
+def encode_sync_cursor(chat_seqs, requests_since):
+	raw = {"c": chat_seqs, "f": requests_since.isoformat() if requests_since else None}
+	return base64.urlsafe_b64encode(json.dumps(raw, separators=(",", ":")).encode()).decode()
+
+# DECODES A SYNC CURSOR INTO ITS ({CHAT ID: SEQ}, DATE) PAIR, RAISES VALUEERROR IF IT IS MALFORMED
+def decode_sync_cursor(cursor):
+	try:
+		raw = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+		chat_seqs = {f"{uuid.UUID(chat_id)}": int(seq) for chat_id, seq in raw["c"].items()}
+		requests_since = datetime.fromisoformat(raw["f"]) if raw["f"] else None
+		return chat_seqs, requests_since
+	except Exception:
+		raise ValueError("Invalid cursor")
+
+# RETURNS THE MAXIMUM NUMBER OF MESSAGES AND OF FRIEND REQUESTS PER RESPONSE
+def get_sync_limit(value):
+	if value is None:
+		return settings.SYNC_PAGE_SIZE
+	try:
+		value = int(value)
+	except (TypeError, ValueError):
+		raise ValueError("Invalid limit")
+	return max(1, min(value, settings.SYNC_MAX_PAGE_SIZE))
+
+# MESSAGES OF SEVERAL CHATS IN CHAT AND SEQ ORDER, RANGES IS A LIST OF (CHAT ID, AFTER SEQ, UP TO SEQ)
+# ONE QUERY, EACH RANGE IS A SCAN OF THE (CHAT, SEQ) INDEX
+def messages_in_ranges(ranges):
+	condition = reduce(operator.or_, [Q(chat=chat_id, seq__gt=after, seq__lte=up_to) for chat_id, after, up_to in ranges])
+	return Message.objects.filter(condition).order_by('chat', 'seq')
+
+# COLLECTS EVERYTHING THAT CHANGED FOR A USER SINCE THE CURSOR
+# CHATS THE USER JOINED START AT THEIR CURRENT SEQ, THEIR HISTORY COMES FROM THE MESSAGES ENDPOINT
+# WITHOUT A CURSOR EVERY CHAT IS NEW AND ALL THE PENDING FRIEND REQUESTS ARE RETURNED
+# THE RESPONSE IS BOUNDED, WHEN HAS_MORE IS SET THE CLIENT CALLS AGAIN WITH THE NEW CURSOR
+def sync_changes(user, cursor=None, limit=None):
+	chat_seqs, requests_since = decode_sync_cursor(cursor) if cursor else ({}, None)
+	limit = get_sync_limit(limit)
+
+	memberships = ChatMember.objects.filter(member=user).select_related('chat', 'chat__last_message_author')
+	chats = {f"{chat_member.chat_id}": chat_member.chat for chat_member in memberships}
+	removed_chats = [chat_id for chat_id in chat_seqs if chat_id not in chats]
+	added_chats = [chat_member for chat_member in memberships if f"{chat_member.chat_id}" not in chat_seqs]
+
+	next_seqs = {chat_id: seq for chat_id, seq in chat_seqs.items() if chat_id in chats}
+	for chat_member in added_chats:
+		next_seqs[f"{chat_member.chat_id}"] = chat_member.chat.last_seq
+
+	# THE MOST RECENTLY ACTIVE CHATS GO FIRST WHEN THERE ARE TOO MANY BEHIND
+	behind = [chat for chat_id, chat in chats.items() if chat_id in chat_seqs and chat.last_seq > chat_seqs[chat_id]]
+	behind.sort(key=lambda chat: chat.modified_at, reverse=True)
+	has_more = len(behind) > settings.SYNC_MAX_CHATS
+	behind = behind[:settings.SYNC_MAX_CHATS]
+
+	# THE UPPER BOUND IS THE SEQ READ ABOVE SO A MESSAGE COMMITTED MEANWHILE IS LEFT FOR THE NEXT SYNC
+	messages = []
+	if behind:
+		ranges = [(chat.id, chat_seqs[f"{chat.id}"], chat.last_seq) for chat in behind]
+		messages = list(messages_in_ranges(ranges).values('id', 'chat', 'seq', 'author__username', 'content', 'date_sent')[:limit + 1])
+		if len(messages) > limit:
+			has_more = True
+			messages = messages[:limit]
+		for message in messages:
+			next_seqs[f"{message['chat']}"] = message['seq']
+
+	friend_requests = FriendRequest.objects.filter(user_receiver=user).select_related('user_sender').order_by('date_sent', 'id')
+	if requests_since:
+		friend_requests = friend_requests.filter(date_sent__gt=requests_since)
+	friend_requests = list(friend_requests[:limit + 1])
+	if len(friend_requests) > limit:
+		has_more = True
+		friend_requests = friend_requests[:limit]
+	if friend_requests:
+		requests_since = friend_requests[-1].date_sent
+
+	return {
+		"messages": messages,
+		"added_chats": added_chats,
+		"removed_chats": removed_chats,
+		"friend_requests": friend_requests,
+		"roster_version": get_roster_version(user.id),
+		"has_more": has_more,
+		"cursor": encode_sync_cursor(next_seqs, requests_since),
+	}
@@ -1,11 +1,23 @@
-from django.test import TestCase
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import transaction
+from django.test import TestCase, override_settings
 from django.urls import reverse
 
 from users.models import CustomUser
-from .models import Friend, FriendsList, Chat
+from users import avatars
+from .models import Friend, FriendsList, Chat, ChatMember, FriendRequest, Message, OutboxEvent
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework.test import APIClient
+from .benchmarks import seed, run_benchmarks, over_budget, small_png
+from .dedup import recent_messages
+from .roster import version_key
+from .membership import get_chat_member_ids, shared_cache, chat_key
+import io
+import tempfile
 import uuid
+from unittest import mock
 
 # Create your tests here.
 class AuthenticationSystem(TestCase):
@@ -58,6 +70,27 @@ class AuthenticationSystem(TestCase):
 		)
 		self.assertEqual(response.status_code, 200)
 
+	@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), PROFILE_PICTURE_WORKERS=0)
+	def test_profile_picture_thumbnails(self):
+		token = str(RefreshToken.for_user(self.test_user).access_token)
+		def upload():
+			with self.captureOnCommitCallbacks(execute=True):
+				return APIClient().put(reverse("upload_profile_pic"), {"profile_pic": small_png()}, format="multipart", HTTP_AUTHORIZATION = f"JWT {token}", secure=True)
+
+		response = upload()
+		self.assertEqual(response.status_code, 200)
+		self.test_user.refresh_from_db()
+		self.assertTrue(self.test_user.profile_picture_thumbnails)
+		self.assertTrue(self.test_user.profile_picture_url("small").endswith("_small.webp"))
+		self.assertTrue(self.test_user.profile_picture.storage.exists(avatars.thumbnail_name(self.test_user.profile_picture.name, "small")))
+
+		# THE SAME PICTURE IS STORED ONCE AND REUSES ITS THUMBNAILS
+		name = self.test_user.profile_picture.name
+		response = upload()
+		self.assertEqual(response.data["profile_pics"]["small"], self.test_user.profile_picture_url("small"))
+		self.test_user.refresh_from_db()
+		self.assertEqual(self.test_user.profile_picture.name, name)
+
 
 class FriendSystemTest(TestCase):
 	def setUp(self):
@@ -129,6 +162,22 @@ class FriendSystemTest(TestCase):
 		self.assertEqual(response.status_code, 409)
 		self.assertEqual(response.data, 'test_user has already sent you a friend request')
 
+	def test_user_search_flags_pending_requests(self):
+		self.client.post(reverse("friend_list"), {"friend": "friend_user"}, HTTP_AUTHORIZATION = f'JWT {self.test_user_token}')
+
+		response = self.client.get(reverse("user_search") + "?q=fri", HTTP_AUTHORIZATION = f'JWT {self.test_user_token}')
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual([(user["name"], user["is_friend"], user["request_sent"]) for user in response.data], [("friend_user", False, True)])
+
+		response = self.client.get(reverse("user_search") + "?q=test", HTTP_AUTHORIZATION = f'JWT {self.friend_user_token}')
+		self.assertEqual([(user["name"], user["request_received"]) for user in response.data], [("test_user", True)])
+
+		# THE CALLER IS NEVER IN THE RESULTS AND AN EMPTY PREFIX IS REJECTED
+		response = self.client.get(reverse("user_search") + "?q=test", HTTP_AUTHORIZATION = f'JWT {self.test_user_token}')
+		self.assertEqual(response.data, [])
+		response = self.client.get(reverse("user_search") + "?q=", HTTP_AUTHORIZATION = f'JWT {self.test_user_token}')
+		self.assertEqual(response.status_code, 400)
+
 	def test_add_friend_without_authentication(self):
 		response = self.client.post(
 			reverse("friend_list"),
@@ -430,6 +479,162 @@ class ChatSystemTest(TestCase):
 		self.assertContains(response, f"{self.friend_user}")
 		self.assertContains(response, f"{self.third_friend_user}")
 
+	def test_add_members_reports_each_username(self):
+		response = self.client.post(
+			reverse("chat_list_create_group"),
+			{
+				"group_name": "LOS WACHIKOLEROS",
+			},
+			HTTP_AUTHORIZATION = f"JWT {self.test_user_token}"
+		)
+		chat_id = response.data["id"]
+		friends = [
+			{"friend": "friend_user"},
+			{"friend": "second_friend_user"},
+			{"friend": "ghost_user"},
+			{"friend": "test_user"},
+		]
+		response = APIClient().post(
+			reverse("chat_detail", args=(chat_id,)),
+			{"friends": friends},
+			format = 'json',
+			HTTP_AUTHORIZATION = f"JWT {self.test_user_token}"
+		)
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response.data["added"], ["friend_user"])
+		self.assertEqual(set(response.data["errors"]), {"second_friend_user", "ghost_user", "test_user"})
+		self.assertEqual(ChatMember.objects.filter(chat=chat_id).count(), 2)
+
+		# NOBODY LEFT TO ADD
+		response = APIClient().post(
+			reverse("chat_detail", args=(chat_id,)),
+			{"friends": friends[:2]},
+			format = 'json',
+			HTTP_AUTHORIZATION = f"JWT {self.test_user_token}"
+		)
+		self.assertEqual(response.status_code, 422)
+		self.assertEqual(response.data["added"], [])
+
+	def test_add_members_skips_members_added_concurrently(self):
+		response = self.client.post(
+			reverse("chat_list_create_group"),
+			{
+				"group_name": "LOS WACHIKOLEROS",
+			},
+			HTTP_AUTHORIZATION = f"JWT {self.test_user_token}"
+		)
+		chat_id = response.data["id"]
+		events = OutboxEvent.objects.count()
+
+		# ANOTHER REQUEST ADDS THE FRIEND BETWEEN THE CHECK AND THE INSERT
+		bulk_create = ChatMember.objects.bulk_create
+		def add_concurrently(members, **kwargs):
+			ChatMember.objects.create(chat_id=chat_id, member=self.friend_user)
+			return bulk_create(members, **kwargs)
+
+		with mock.patch.object(ChatMember.objects, "bulk_create", side_effect=add_concurrently):
+			response = APIClient().post(
+				reverse("chat_detail", args=(chat_id,)),
+				{"friends": [{"friend": "friend_user"}]},
+				format = 'json',
+				HTTP_AUTHORIZATION = f"JWT {self.test_user_token}"
+			)
+		self.assertEqual(response.status_code, 422)
+		self.assertEqual(response.data["added"], [])
+		self.assertEqual(response.data["errors"], {"friend_user": "Already a member of the chat"})
+		# THE OTHER REQUEST SENDS ITS OWN NEW.CHAT EVENT
+		self.assertEqual(OutboxEvent.objects.count(), events)
+
+	def test_added_members_start_with_the_history_read(self):
+		response = self.client.post(
+			reverse("chat_list_create_group"),
+			{
+				"group_name": "LOS WACHIKOLEROS",
+			},
+			HTTP_AUTHORIZATION = f"JWT {self.test_user_token}"
+		)
+		chat_id = response.data["id"]
+		for content in ("uno", "dos", "tres"):
+			self.client.post(reverse("message_list", args=(chat_id,)), {"content": content}, HTTP_AUTHORIZATION = f"JWT {self.test_user_token}")
+		APIClient().post(
+			reverse("chat_detail", args=(chat_id,)),
+			{"friends": [{"friend": "friend_user"}]},
+			format = 'json',
+			HTTP_AUTHORIZATION = f"JWT {self.test_user_token}"
+		)
+		member = ChatMember.objects.get(chat=chat_id, member=self.friend_user)
+		self.assertEqual((member.last_read_seq, member.unread_count), (3, 0))
+
+		# ONLY WHAT IS SENT AFTER JOINING IS UNREAD, READING IT DOES NOT COUNT THE OLDER HISTORY
+		self.client.post(reverse("message_list", args=(chat_id,)), {"content": "cuatro"}, HTTP_AUTHORIZATION = f"JWT {self.test_user_token}")
+		member.refresh_from_db()
+		self.assertEqual((member.last_read_seq, member.unread_count), (3, 1))
+		ChatMember.mark_read(chat_id, self.friend_user.id, 3)
+		member.refresh_from_db()
+		self.assertEqual(member.unread_count, 1)
+		ChatMember.mark_read(chat_id, self.friend_user.id, 4)
+		member.refresh_from_db()
+		self.assertEqual((member.last_read_seq, member.unread_count), (4, 0))
+
+	def test_sync_returns_changes_since_cursor(self):
+		response = self.client.post(
+			reverse("ind_chat"),
+			{
+				"friend_name": "friend_user"
+			},
+			HTTP_AUTHORIZATION = f"JWT {self.test_user_token}"
+		)
+		chat_id = f"{response.data['chat_id']}"
+
+		# THE FIRST SYNC ONLY LISTS THE CHATS
+		response = self.client.post(reverse("sync"), {}, HTTP_AUTHORIZATION = f"JWT {self.test_user_token}")
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual([f"{chat['id']}" for chat in response.data["added_chats"]], [chat_id])
+		self.assertEqual(response.data["messages"], [])
+		cursor = response.data["cursor"]
+
+		for content in ("uno", "dos", "tres"):
+			self.client.post(reverse("message_list", args=(chat_id,)), {"content": content}, HTTP_AUTHORIZATION = f"JWT {self.friend_user_token}")
+
+		response = self.client.post(reverse("sync"), {"cursor": cursor, "limit": 2}, HTTP_AUTHORIZATION = f"JWT {self.test_user_token}")
+		self.assertEqual([message["seq"] for message in response.data["messages"]], [1, 2])
+		self.assertTrue(response.data["has_more"])
+		response = self.client.post(reverse("sync"), {"cursor": response.data["cursor"], "limit": 2}, HTTP_AUTHORIZATION = f"JWT {self.test_user_token}")
+		self.assertEqual([message["content"] for message in response.data["messages"]], ["tres"])
+		self.assertFalse(response.data["has_more"])
+		self.assertEqual(response.data["added_chats"], [])
+
+		# LEAVING THE CHAT SHOWS UP AS A REMOVED CHAT
+		cursor = response.data["cursor"]
+		self.client.delete(reverse("chat_detail", args=(chat_id,)), HTTP_AUTHORIZATION = f"JWT {self.test_user_token}")
+		response = self.client.post(reverse("sync"), {"cursor": cursor}, HTTP_AUTHORIZATION = f"JWT {self.test_user_token}")
+		self.assertEqual(response.data["removed_chats"], [chat_id])
+
+		response = self.client.post(reverse("sync"), {"cursor": "not-a-cursor"}, HTTP_AUTHORIZATION = f"JWT {self.test_user_token}")
+		self.assertEqual(response.status_code, 400)
+
+	def test_search_ranks_messages_of_own_chats(self):
+		response = self.client.post(reverse("ind_chat"), {"friend_name": "friend_user"}, HTTP_AUTHORIZATION = f"JWT {self.test_user_token}")
+		chat_id = f"{response.data['chat_id']}"
+		for content in ("Canción nueva", "la canción, otra canción", "nada que ver"):
+			self.client.post(reverse("message_list", args=(chat_id,)), {"content": content}, HTTP_AUTHORIZATION = f"JWT {self.friend_user_token}")
+
+		# ACCENTS AND CASE ARE IGNORED, THE MESSAGE WITH MORE MATCHES GOES FIRST
+		response = self.client.get(reverse("message_search") + "?q=CANCION&limit=1", HTTP_AUTHORIZATION = f"JWT {self.test_user_token}")
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual([result["content"] for result in response.data["results"]], ["la canción, otra canción"])
+		response = self.client.get(reverse("message_search") + f"?q=CANCION&limit=1&after={response.data['next_after']}", HTTP_AUTHORIZATION = f"JWT {self.test_user_token}")
+		self.assertEqual([result["content"] for result in response.data["results"]], ["Canción nueva"])
+		self.assertIsNone(response.data["next_after"])
+
+		# EVERY TERM MUST MATCH
+		response = self.client.get(reverse("message_search") + "?q=cancion nueva", HTTP_AUTHORIZATION = f"JWT {self.test_user_token}")
+		self.assertEqual([result["content"] for result in response.data["results"]], ["Canción nueva"])
+
+		# USERS ONLY FIND MESSAGES OF THEIR OWN CHATS
+		response = self.client.get(reverse("message_search") + "?q=cancion", HTTP_AUTHORIZATION = f"JWT {self.third_friend_user_token}")
+		self.assertEqual(response.data["results"], [])
+
 	def test_message_to_chat(self):
 		response = self.client.post(
 			reverse("ind_chat"),
@@ -476,3 +681,280 @@ class ChatSystemTest(TestCase):
 			HTTP_AUTHORIZATION = f'JWT {self.second_friend_user_token}'
 		)
 		self.assertEqual(response.status_code, 403)
+
+	def test_message_retry_with_client_id_is_not_saved_twice(self):
+		response = self.client.post(
+			reverse("ind_chat"),
+			{
+				"friend_name": "friend_user"
+			},
+			HTTP_AUTHORIZATION = f"JWT {self.test_user_token}"
+		)
+		chat_id = response.data['chat_id']
+		url = reverse("message_list", args=(chat_id,))
+		response = self.client.post(url, {"content": "hola", "client_id": "retry-1"}, HTTP_AUTHORIZATION = f"JWT {self.test_user_token}")
+		self.assertEqual(response.status_code, 201)
+		original = response.data["id"]
+
+		# A FAST RETRY IS ANSWERED FROM MEMORY, A LATE ONE FROM THE DATABASE
+		response = self.client.post(url, {"content": "hola", "client_id": "retry-1"}, HTTP_AUTHORIZATION = f"JWT {self.test_user_token}")
+		self.assertEqual((response.status_code, response.data["id"]), (200, original))
+		recent_messages.clear()
+		response = self.client.post(url, {"content": "hola", "client_id": "retry-1"}, HTTP_AUTHORIZATION = f"JWT {self.test_user_token}")
+		self.assertEqual((response.status_code, response.data["id"]), (200, original))
+		self.assertEqual(Message.objects.filter(chat=chat_id).count(), 1)
+
+		# THE CLIENT_ID IS SCOPED TO ITS AUTHOR
+		response = self.client.post(url, {"content": "hola", "client_id": "retry-1"}, HTTP_AUTHORIZATION = f"JWT {self.friend_user_token}")
+		self.assertEqual(response.status_code, 201)
+
+		# A BLANK CLIENT_ID IS REJECTED LIKE ON THE WEBSOCKET, IT WOULD COLLIDE WITH THE NEXT BLANK ONE
+		for _ in range(2):
+			response = self.client.post(url, {"content": "hola", "client_id": ""}, HTTP_AUTHORIZATION = f"JWT {self.test_user_token}")
+			self.assertEqual(response.status_code, 400)
+		self.assertEqual(Message.objects.filter(chat=chat_id, client_id="").count(), 0)
+
+	def test_membership_cache_is_invalidated_after_commit(self):
+		chat = Chat.objects.create(group_chat=True)
+		self.assertEqual(get_chat_member_ids(chat.id), frozenset())
+		with self.captureOnCommitCallbacks(execute=True):
+			with transaction.atomic():
+				chat.add_member(ChatMember(member=self.friend_user))
+				# ANOTHER WORKER READS THE MEMBERS BEFORE THE COMMIT AND CACHES THE OLD ONES
+				shared_cache().set(chat_key(chat.id), frozenset(), settings.CHAT_MEMBERSHIP_TTL)
+		self.assertEqual(get_chat_member_ids(chat.id), frozenset([f"{self.friend_user.id}"]))
+
+	def test_message_history_pagination(self):
+		response = self.client.post(
+			reverse("ind_chat"),
+			{
+				"friend_name": "friend_user"
+			},
+			HTTP_AUTHORIZATION = f"JWT {self.test_user_token}"
+		)
+		chat_id = response.data['chat_id']
+		for i in range(5):
+			response = self.client.post(
+				reverse("message_list", args=(chat_id,)),
+				{
+					"content": f"message {i}",
+				},
+				HTTP_AUTHORIZATION = f"JWT {self.test_user_token}"
+			)
+			self.assertEqual(response.status_code, 201)
+
+		response = self.client.get(
+			reverse("message_list", args=(chat_id,)),
+			{"limit": 2},
+			HTTP_AUTHORIZATION = f'JWT {self.test_user_token}'
+		)
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual([message["content"] for message in response.data["messages"]], ["message 3", "message 4"])
+		self.assertFalse(response.data["has_newer"])
+
+		response = self.client.get(
+			reverse("message_list", args=(chat_id,)),
+			{"limit": 2, "before": response.data["next_before"]},
+			HTTP_AUTHORIZATION = f'JWT {self.test_user_token}'
+		)
+		self.assertEqual([message["content"] for message in response.data["messages"]], ["message 1", "message 2"])
+		oldest_page = self.client.get(
+			reverse("message_list", args=(chat_id,)),
+			{"limit": 2, "before": response.data["next_before"]},
+			HTTP_AUTHORIZATION = f'JWT {self.test_user_token}'
+		)
+		self.assertEqual([message["content"] for message in oldest_page.data["messages"]], ["message 0"])
+		self.assertIsNone(oldest_page.data["next_before"])
+
+		response = self.client.get(
+			reverse("message_list", args=(chat_id,)),
+			{"limit": 10, "after": oldest_page.data["next_after"]},
+			HTTP_AUTHORIZATION = f'JWT {self.test_user_token}'
+		)
+		self.assertEqual(len(response.data["messages"]), 4)
+
+		response = self.client.get(
+			reverse("message_list", args=(chat_id,)),
+			{"before": "not-a-cursor"},
+			HTTP_AUTHORIZATION = f'JWT {self.test_user_token}'
+		)
+		self.assertEqual(response.status_code, 400)
+
+		# WITHOUT PARAMETERS ONLY THE NEWEST PAGE IS SENT
+		with self.settings(MESSAGE_PAGE_SIZE=3):
+			response = self.client.get(
+				reverse("message_list", args=(chat_id,)),
+				HTTP_AUTHORIZATION = f'JWT {self.test_user_token}'
+			)
+		self.assertEqual([message["content"] for message in response.data["messages"]], ["message 2", "message 3", "message 4"])
+		self.assertIsNotNone(response.data["next_before"])
+
+	def test_chat_list_inbox(self):
+		response = self.client.post(
+			reverse("ind_chat"),
+			{
+				"friend_name": "friend_user"
+			},
+			HTTP_AUTHORIZATION = f"JWT {self.test_user_token}"
+		)
+		individual_chat_id = response.data['chat_id']
+		response = self.client.post(
+			reverse("chat_list_create_group"),
+			{
+				"group_name": "LOS WACHIKOLEROS",
+			},
+			HTTP_AUTHORIZATION = f"JWT {self.test_user_token}"
+		)
+		group_chat_id = response.data['id']
+		self.client.post(
+			reverse("message_list", args=(group_chat_id,)),
+			{
+				"content": "first",
+			},
+			HTTP_AUTHORIZATION = f"JWT {self.test_user_token}"
+		)
+		self.client.post(
+			reverse("message_list", args=(individual_chat_id,)),
+			{
+				"content": "second",
+			},
+			HTTP_AUTHORIZATION = f"JWT {self.friend_user_token}"
+		)
+
+		# AUTHENTICATION, CHAT LIST AND INDIVIDUAL CHAT MEMBERS
+		with self.assertNumQueries(3):
+			response = self.client.get(
+				reverse("chat_list_create_group"),
+				HTTP_AUTHORIZATION = f"JWT {self.test_user_token}"
+			)
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual([chat["last_message"] for chat in response.data["chats"]], ["second", "test_user: first"])
+		self.assertEqual(response.data["chats"][0]["name"], "friend_user")
+		self.assertIsNone(response.data["next_before"])
+
+		# WITHOUT PARAMETERS ONLY THE MOST RECENT PAGE IS SENT
+		with self.settings(MESSAGE_PAGE_SIZE=1):
+			response = self.client.get(
+				reverse("chat_list_create_group"),
+				HTTP_AUTHORIZATION = f"JWT {self.test_user_token}"
+			)
+		self.assertEqual([chat["name"] for chat in response.data["chats"]], ["friend_user"])
+		self.assertIsNotNone(response.data["next_before"])
+
+		response = self.client.get(
+			reverse("chat_list_create_group"),
+			{"limit": 1},
+			HTTP_AUTHORIZATION = f"JWT {self.test_user_token}"
+		)
+		self.assertEqual(len(response.data["chats"]), 1)
+		response = self.client.get(
+			reverse("chat_list_create_group"),
+			{"limit": 1, "before": response.data["next_before"]},
+			HTTP_AUTHORIZATION = f"JWT {self.test_user_token}"
+		)
+		self.assertEqual(response.data["chats"][0]["name"], "LOS WACHIKOLEROS")
+		self.assertIsNone(response.data["next_before"])
+
+	def test_individual_chat_is_unique_per_pair(self):
+		response = self.client.post(
+			reverse("ind_chat"),
+			{
+				"friend_name": "test_user"
+			},
+			HTTP_AUTHORIZATION = f"JWT {self.friend_user_token}"
+		)
+		self.assertEqual(response.status_code, 201)
+		chat = Chat.objects.get(id=response.data["chat_id"])
+		self.assertEqual(chat.direct_key, Chat.direct_key_for(self.test_user, self.friend_user))
+
+		# THE SAME PAIR IN THE OTHER ORDER FINDS THE EXISTING CHAT
+		# AUTHENTICATION, FRIEND LOOKUP, FRIENDSHIP PERMISSION (3) AND ONE DIRECT KEY LOOKUP
+		with self.assertNumQueries(6):
+			response = self.client.post(
+				reverse("ind_chat"),
+				{
+					"friend_name": "friend_user"
+				},
+				HTTP_AUTHORIZATION = f"JWT {self.test_user_token}"
+			)
+		self.assertEqual(response.status_code, 409)
+
+	def test_friend_roster_etag(self):
+		response = self.client.get(
+			reverse("friend_list"),
+			HTTP_AUTHORIZATION = f'JWT {self.test_user_token}'
+		)
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual([friend["name"] for friend in response.data], ["friend_user", "third_friend_user"])
+		etag = response["ETag"]
+
+		# AUTHENTICATION ONLY
+		with self.assertNumQueries(1):
+			response = self.client.get(
+				reverse("friend_list"),
+				HTTP_AUTHORIZATION = f'JWT {self.test_user_token}',
+				HTTP_IF_NONE_MATCH = etag,
+			)
+		self.assertEqual(response.status_code, 304)
+
+		response = self.client.post(
+			reverse("friend_list"),
+			{
+				"friend": "test_user"
+			},
+			HTTP_AUTHORIZATION = f'JWT {self.second_friend_user_token}'
+		)
+		friend_request = FriendRequest.objects.get(user_sender=self.second_friend_user)
+		response = self.client.post(
+			reverse("friend_request", args=(friend_request.id,)),
+			{
+				"accepted": True,
+			},
+			HTTP_AUTHORIZATION = f'JWT {self.test_user_token}',
+		)
+		self.assertEqual(response.status_code, 201)
+
+		# THE VERSION AND THE ROSTERS LIVE IN THE SHARED ROSTER CACHE, NOTHING OF THEM IN THE PER PROCESS DEFAULT ONE
+		self.assertIsNotNone(caches[settings.FRIEND_ROSTER_CACHE].get(version_key(self.test_user.id)))
+		caches["default"].clear()
+		response = self.client.get(
+			reverse("friend_list"),
+			HTTP_AUTHORIZATION = f'JWT {self.test_user_token}',
+			HTTP_IF_NONE_MATCH = etag,
+		)
+		self.assertEqual(response.status_code, 200)
+		self.assertNotEqual(response["ETag"], etag)
+		self.assertContains(response, "second_friend_user")
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class QueryBudgetTest(TestCase):
+	# EVERY ENDPOINT RUNS THE SAME NUMBER OF QUERIES ON A SMALL AND ON A THREE TIMES BIGGER DATASET
+	def test_query_budgets_do_not_grow_with_data(self):
+		reports = []
+		for scale in (1, 3):
+			with transaction.atomic():
+				reports.append(run_benchmarks(seed(scale)))
+				transaction.set_rollback(True)
+
+		small, big = reports
+		for name, result in big.items():
+			self.assertLess(result["status"], 300, name)
+			self.assertEqual(result["queries"], small[name]["queries"], name)
+		self.assertEqual(over_budget(big), {})
+
+
+class GenerateDatasetTest(TestCase):
+	def test_generate_dataset(self):
+		call_command("generate_dataset", users=40, friends=6, groups=4, group_size=[2, 6], messages=500, batch_size=7, stdout=io.StringIO())
+
+		self.assertEqual(CustomUser.objects.filter(username__startswith="user_").count(), 40)
+		self.assertEqual(Message.objects.count(), 500)
+		self.assertEqual(Chat.objects.filter(group_chat=True).count(), 4)
+		# INDIVIDUAL CHATS ARE ONLY CREATED BETWEEN FRIENDS
+		for chat in Chat.objects.filter(group_chat=False):
+			first, second = ChatMember.objects.filter(chat=chat).values_list("member", flat=True)
+			self.assertTrue(Friend.objects.filter(friends_list=first, friend=second).exists())
+		# THE INBOX FIELDS POINT TO THE NEWEST MESSAGE OF EVERY CHAT
+		for chat in Chat.objects.filter(last_message__isnull=False):
+			self.assertEqual(chat.last_message, Message.objects.filter(chat=chat).latest("date_sent"))
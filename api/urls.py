@@ -1,7 +1,8 @@
 from django.urls import path, include
 from .views import FriendListView, MessageListView, IndChatView, ChatListCreateView, ChatDetailAddMemberView, \
 				   FriendRequestListView, FriendRequestDetailView, CustomUserCreate, ObtainTokenPairWithColorView, \
-				   UploadProfilePictureView, RefreshTokenView
+				   UploadProfilePictureView, RefreshTokenView, SyncView, MessageSearchView, \
+				   UserSearchView
 from rest_framework_simplejwt import views as jwt_views
 
 urlpatterns = [
@@ -14,7 +15,10 @@ urlpatterns = [
 	path('friend-request/<uuid:pk>/', FriendRequestDetailView.as_view(), name='friend_request'),
 	path('chats/<uuid:pk>/', ChatDetailAddMemberView.as_view(), name='chat_detail'),
 	path('user/signup/', CustomUserCreate.as_view(), name="create_user"),
+	path('user/search/', UserSearchView.as_view(), name="user_search"),
 
 	path('profile-picture/', UploadProfilePictureView.as_view(), name='upload_profile_pic'),
+	path('messages/search/', MessageSearchView.as_view(), name='message_search'),
 	path('messages/<uuid:pk>/', MessageListView.as_view(), name='message_list'),
+	path('sync/', SyncView.as_view(), name='sync'),
 ]
@@ -1,9 +1,10 @@
 import json
+import uuid
 
+from django.conf import settings
 from django.shortcuts import render
-
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from django.db import IntegrityError, transaction
+from django.db.models import Q, Exists, OuterRef
 
 from rest_framework import generics, status
 from rest_framework.response import Response
@@ -12,8 +13,15 @@ from rest_framework.views import APIView
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
 from users.models import CustomUser
+from users import avatars
 from .permissions import IsChatMember, IsFriend, IsRequestedUser
 from .models import Friend, Message, Chat, FriendsList, ChatMember, FriendRequest
+from .membership import invalidate_membership, invalidate_user, invalidate_chat
+from .outbox import publish
+from .roster import get_roster, get_roster_version, bump_roster_versions, roster_etag
+from .pagination import paginate_messages, get_page_size, encode_cursor, decode_cursor
+from .sync import sync_changes
+from .search import search_messages
 from .serializers import  AddFriendSerializer, MessageSerializer, ChatSerializer, IndividualChatSerializer, GroupChatSerializer,\
  						  AddMemberSerializer, FriendRequestSerializer, AcceptFriendRequestSerializer, CustomUserSerializer, \
 						  MyTokenObtainPairSerializer, ProfilePictureSerializer, RemoveGroupSerializer, MyTokenRefreshPairSerializer
@@ -27,31 +35,23 @@ class FriendListView(generics.ListCreateAPIView):
 
 	# GET METHOD TO RETRIEVE FRIENDS LIST FOR EACH USER
 	def get(self, request):
-		# GETS REQUEST USERS FRIENDS LIST OR 422 RESPONSE
-		try:
-			friends_list = FriendsList.objects.get(owner=request.user)
-		except:
+		# THE ETAG IS THE ROSTER VERSION, AN UNCHANGED ROSTER IS ANSWERED WITH 304 WITHOUT TOUCHING THE DATABASE
+		version = get_roster_version(request.user.id)
+		headers = {"ETag": roster_etag(request.user.id, version), "Cache-Control": "private, no-cache"}
+		if request.headers.get("If-None-Match") == headers["ETag"]:
+			return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+		# GETS REQUEST USERS FRIENDS LIST (CACHED PER VERSION) OR 422 RESPONSE
+		friends_data = get_roster(request.user, version)
+		if friends_data is None:
 			return Response({"UPROCESSABLE ENTITY":"Your friend list is empty", "code":"empty_friends_list"}, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
 
-		# RETRIEVES THE LIST OF FRIEND MODELS LINKES TO THE USERS FRIENDSLIST
-		friends = Friend.objects.filter(friends_list=friends_list)
-
-		# SPLITS THE DATA ONLY TO SHOW FRIEND NAME
-		friends_data = [{"name":friend.friend.username} for friend in friends]
-
-		for i, friend in enumerate(friends):
-			if friend.friend.profile_picture:
-				friends_data[i]["profile_pic"] = friend.friend.profile_picture.url
-			else:
-				friends_data[i]["profile_pic"] = ""
-
-		return Response(data=friends_data, status=status.HTTP_200_OK)
+		return Response(data=friends_data, status=status.HTTP_200_OK, headers=headers)
 
 	# ******* THERE IS NO SERIALIZER VALIDATION *******
 	# CREATE METHOD TO ADD A FRIEND TO A USERS FRIENDS LIST
 	def create(self, request):
 		# CHECKS WHETHER THERE IS A USER WITH THE NAME IN THE DATA OR NOT, 422 IF NOT FOUND
-		channel_layer = get_channel_layer()
 		try:
 			friend_requested = CustomUser.objects.get(username=request.data["friend"])
 		except:
@@ -63,9 +63,10 @@ class FriendListView(generics.ListCreateAPIView):
 			return Response(error_message, status=status.HTTP_409_CONFLICT)
 		# CREATES THE FRIEND REQUEST OBJECT, 409 CONFLICT IF THERE IS AN ISSUE
 		try:
-			friend_request = FriendRequest(user_sender=request.user, user_receiver=friend_requested)
-			friend_request.save()
-			async_to_sync(channel_layer.group_send)(f"{friend_requested.id}", {"type": "friend.request", "request_id":f"{friend_request.id}","user_sender":request.user.username})
+			with transaction.atomic():
+				friend_request = FriendRequest(user_sender=request.user, user_receiver=friend_requested)
+				friend_request.save()
+				publish([friend_requested.id], {"type": "friend.request", "request_id":f"{friend_request.id}","user_sender":request.user.username})
 		except Exception as e:
 			return Response(str(e), status=status.HTTP_409_CONFLICT)
 		# RESPONSE 201 IF EVERYTHING WENT AS EXPECTED
@@ -95,13 +96,13 @@ class FriendRequestListView(generics.ListAPIView):
 
 	# ALLOWS TO SET A QUERYSET WITH THE GIVEN REQUEST AT THE MOMENT
 	def get_queryset(self):
-		return FriendRequest.objects.filter(user_receiver=self.request.user)
+		return FriendRequest.objects.filter(user_receiver=self.request.user).select_related('user_sender')
 
 
 # GETS THE DATA FOR A SPECIFIC FRIEND REQUEST (GET), ALLOWS YOU TO ACCEPT OR REJECT A SPECIFIC REQUEST (POST)
 class FriendRequestDetailView(generics.RetrieveAPIView):
 	permission_classes = (IsRequestedUser,)
-	queryset = FriendRequest.objects.all()
+	queryset = FriendRequest.objects.select_related('user_sender')
 
 	# IN THIS CASE THE FUNCTION ALLOWS TO USE DIFFERENT SERIALIZERS FOR DIFFERENT HTTP METHODS
 	def get_serializer_class(self):
@@ -113,7 +114,6 @@ class FriendRequestDetailView(generics.RetrieveAPIView):
 	# LETS THE USER ACCEPT OR REJECT A FRIEND REQUEST
 	def post(self, request, pk):
 		serializer = AcceptFriendRequestSerializer(data=request.data)
-		channel_layer = get_channel_layer()
 		# VALIDATES SERIALIZER DATA
 		if serializer.is_valid():
 			# CHECKS IF THE GIVEN FRIEND REQUEST EXISTS. 422 IF NOT
@@ -140,12 +140,15 @@ class FriendRequestDetailView(generics.RetrieveAPIView):
 					add_friend_sender = Friend(friends_list=fl_receiver, friend=sender)
 				except:
 					return Response("Friend could not be added", status=status.HTTP_409_CONFLICT)
-				add_friend_receiver.save()
-				add_friend_sender.save()
-				async_to_sync(channel_layer.group_send)(f"{sender.id}", {"type": "request.accepted", "name":f"{receiver.username}"})
-				async_to_sync(channel_layer.group_send)(f"{receiver.id}", {"type": "request.accepted", "name":f"{sender.username}"})
-				# DELETES THE REQUEST IF ACCEPTED
-				friend_request.delete()
+				# THE FRIENDSHIP, ITS EVENTS AND THE DELETION OF THE REQUEST ARE COMMITTED TOGETHER
+				with transaction.atomic():
+					add_friend_receiver.save()
+					add_friend_sender.save()
+					publish([sender.id], {"type": "request.accepted", "name":f"{receiver.username}"})
+					publish([receiver.id], {"type": "request.accepted", "name":f"{sender.username}"})
+					# DELETES THE REQUEST IF ACCEPTED
+					friend_request.delete()
+				bump_roster_versions([sender.id, receiver.id])
 				return Response("Request: Accepted", status=status.HTTP_201_CREATED)
 			# DELETES THE REQUEST IF REJECTED
 			friend_request.delete()
@@ -169,12 +172,29 @@ class MessageListView(APIView):
 		self.check_object_permissions(request, chat)
 		# IF THE CHAT EXISTS SETS THE DATA THAT IS GOING TO SEND
 		if chat:
-			messages = Message.objects.filter(chat=chat)
-			messages = [{'author':message.author.username, 'content':message.content, 'date_sent':message.date_sent} for message in messages]
-			return Response(data=messages, status=status.HTTP_200_OK)
+			# A SINGLE JOINED QUERY, THE AUTHOR NAME COMES WITH EACH ROW
+			messages = Message.objects.filter(chat=chat).values('id', 'seq', 'author__username', 'content', 'date_sent')
+
+			# KEYSET PAGINATION OVER THE SEQUENCE NUMBER, 400 IF A CURSOR OR THE LIMIT IS MALFORMED
+			# WITHOUT PARAMETERS THE NEWEST MESSAGE_PAGE_SIZE MESSAGES ARE SENT, OLDER ONES ARE FETCHED WITH "BEFORE"
+			try:
+				page = paginate_messages(
+					messages,
+					before=request.query_params.get('before'),
+					after=request.query_params.get('after'),
+					limit=request.query_params.get('limit'),
+				)
+			except ValueError as e:
+				return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+			page["messages"] = [self.message_data(message) for message in page["messages"]]
+			return Response(data=page, status=status.HTTP_200_OK)
 
 		return Response("Chat does not exist", status=status.HTTP_400_BAD_REQUEST)
 
+	# SHAPES A MESSAGE ROW FOR THE RESPONSE
+	def message_data(self, message):
+		return {'id':message['id'], 'seq':message['seq'], 'author':message['author__username'], 'content':message['content'], 'date_sent':message['date_sent']}
+
 	# POST METHOD, CREATES MESSAGES FOR A SPECIFIC CHAT
 	def post(self, request, pk):
 		serializer = self.serializer_class(data=request.data)
@@ -190,7 +210,11 @@ class MessageListView(APIView):
 			# CHECKS IF THE USER IS A CHAT MEMBER
 			self.check_object_permissions(request, chat)
 			# SERIALIZES THE DATA
-			serializer.save(request.user, chat)
+			message = serializer.save(request.user, chat)
+			# WITH A CLIENT_ID THE CLIENT GETS THE MESSAGE BACK, THE ORIGINAL ONE WITH 200 IF IT IS A RETRY
+			if message.client_id:
+				data = {'id': message.id, 'seq': message.seq, 'client_id': message.client_id}
+				return Response(data=data, status=status.HTTP_200_OK if serializer.duplicate else status.HTTP_201_CREATED)
 			return Response('Message received', status=status.HTTP_201_CREATED)
 		return Response({'Bad Request': 'Invalid data...'}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -203,17 +227,14 @@ class ChatDetailAddMemberView(APIView):
 		# CHEKS IF THE CHAT EXISTS, IF IT DOES, GETS THE CHAT MAMBERS OF SAID CHAT
 		try:
 			chat = Chat.objects.get(id=pk)
-			chat_members = chat.chat_for_member.all()
+			chat_members = chat.chat_for_member.select_related('member')
 			# MAKES A LIST OF THE MEMBER USERNAMES
 			chat_members_json = []
 			for chat_member in chat_members:
 				member_data = {
 					"name":chat_member.member.username
 				}
-				if chat_member.member.profile_picture:
-					member_data["profile_pic"] = chat_member.member.profile_picture.url
-				else:
-					member_data["profile_pic"] = ""
+				member_data["profile_pic"] = chat_member.member.profile_picture_url("small")
 				chat_members_json.append(member_data)
 		except:
 			return Response("Chat not found", status=status.HTTP_409_CONFLICT)
@@ -224,89 +245,132 @@ class ChatDetailAddMemberView(APIView):
 			"members":chat_members_json,
 		}, status=status.HTTP_200_OK)
 
-	# POST METHOD, ALLOWS YOU TO ADD A MEMBER TO A CHAT
+	# POST METHOD, ALLOWS YOU TO ADD MEMBERS TO A GROUP CHAT
+	# EVERYTHING IS CHECKED AS A SET AND THE NEW MEMBERS ARE INSERTED AND NOTIFIED TOGETHER
 	def post(self, request, pk):
 		# SERIALIZES THE REQUEST DATA
 		serializer = self.serializer_class(data=request.data)
 		# VALIDATES THE SERIALIZED DATA
 		if serializer.is_valid():
-			# CHECKS IF THE CHAT EXISTS, 409 IF NOT
+			# CHECKS IF THE CHAT EXISTS, 422 IF NOT
 			chat = Chat.objects.filter(id=pk).first()
 			if not chat:
 				return Response("Not found: Chat does not exist", status=status.HTTP_422_UNPROCESSABLE_ENTITY)
-			# EXTRACTS THE FRIEND LIST TO BE ADDED
-			friends_names = serializer.data.get("friends")
-			count=0
-			channel_layer = get_channel_layer()
-			for friend in friends_names:
-				try:
-					user = CustomUser.objects.get(username=friend["friend"])
-					member = ChatMember(member=user)
-					chat.add_member(member)
-					async_to_sync(channel_layer.group_send)(f"{member.member.id}", {"type": "new.chat", "chat_id":f"{chat.id}"})
-				except:
-					count += 1
-			if count != 0:
-				if count == len(friends_names):
-					return Response("No friend could be added", status=status.HTTP_422_UNPROCESSABLE_ENTITY)
-				return Response(f"{count} friends could not be added", status=status.HTTP_200_OK)
-			return Response("Members added", status=status.HTTP_200_OK)
+			self.check_object_permissions(request, chat)
+			# EXTRACTS THE FRIEND LIST TO BE ADDED, IN ORDER AND WITHOUT REPEATS
+			friends_names = list(dict.fromkeys(friend["friend"] for friend in serializer.data.get("friends")))
+			users = dict(CustomUser.objects.filter(username__in=friends_names).values_list('username', 'id'))
+			friend_ids = set(Friend.objects.filter(friends_list=request.user.id, friend__in=users.values()).values_list('friend', flat=True))
+			member_ids = set(ChatMember.objects.filter(chat=chat, member__in=users.values()).values_list('member', flat=True))
+
+			added = {}
+			errors = {}
+			for name in friends_names:
+				user_id = users.get(name)
+				if user_id is None:
+					errors[name] = "User not found"
+				elif not chat.group_chat:
+					errors[name] = "Members can only be added to group chats"
+				elif user_id not in friend_ids:
+					errors[name] = "Not in your friends list"
+				elif user_id in member_ids:
+					errors[name] = "Already a member of the chat"
+				else:
+					added[name] = user_id
+
+			if added:
+				with transaction.atomic():
+					# A CONCURRENT REQUEST MAY HAVE ADDED SOMEONE ALREADY, THE UNIQUE PAIR MAKES THAT A NO-OP
+					# THE HISTORY BEFORE JOINING IS NOT UNREAD, THE READ CURSOR STARTS AT THE LAST MESSAGE
+					members = {name: ChatMember(chat=chat, member_id=user_id, last_read_seq=chat.last_seq) for name, user_id in added.items()}
+					ChatMember.objects.bulk_create(members.values(), ignore_conflicts=True)
+					# THE IDS ARE MADE HERE, SO THE ROWS FOUND WITH THEM ARE THE ONES THIS REQUEST INSERTED
+					inserted = set(ChatMember.objects.filter(id__in=[member.id for member in members.values()]).values_list('id', flat=True))
+					for name, member in members.items():
+						if member.id not in inserted:
+							del added[name]
+							errors[name] = "Already a member of the chat"
+					if added:
+						publish(added.values(), {"type": "new.chat", "chat_id":f"{chat.id}"})
+				for user_id in added.values():
+					invalidate_user(user_id)
+				invalidate_chat(chat.id)
+
+			data = {"added": list(added), "errors": errors}
+			if errors and not added:
+				return Response(data, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+			return Response(data, status=status.HTTP_200_OK)
 		return Response({serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
 
 	def delete(self, request, pk):
-		channel_layer = get_channel_layer()
 		try:
 			chat_member = ChatMember.objects.get(member=request.user, chat=pk)
 		except:
 			return Response("You are not a member of the chat", status=status.HTTP_409_CONFLICT)
-		async_to_sync(channel_layer.group_send)(f"{request.user.id}", {"type": "remove.chat", "chat_id":f"{pk}"})
-		chat_member.delete()
+		with transaction.atomic():
+			chat_member.delete()
+			publish([request.user.id], {"type": "remove.chat", "chat_id":f"{pk}"})
+		invalidate_membership(request.user.id, pk)
 		return Response("You are no longer a member of this chat", status=status.HTTP_200_OK)
 
+# SETS THE INBOX DATA OF A CHAT FROM ITS DENORMALIZED FIELDS
+def chat_data(chat_member, friend):
+	chat = chat_member.chat
+	if chat.last_message_id:
+		modified_at = chat.modified_at
+		message = chat.last_message_preview
+	else:
+		message = "No messages yet"
+		modified_at = False
+	# THE UNREAD COUNT IS KEPT UP TO DATE ON EVERY MESSAGE WRITE, NOTHING IS COUNTED HERE
+	read_state = {"unread_count":chat_member.unread_count, "last_read_seq":chat_member.last_read_seq, "last_seq":chat.last_seq}
+	# IF THE CHAT NAME IS NOT THE DATABASE DEFAULT FOR INDIVIDUAL CHAT IT SETS THE CHAT TO GROUP CHAT
+	if chat.name != "not_assigned":
+		if chat.last_message_id:
+			message = f'{chat.last_message_author}: {message}'
+		return {"id":chat.id, "name":chat.name, "last_message":message, "modified_at":modified_at ,"is_group": True, **read_state}
+	# IF THE CHAT NAME IS THE DATABASE DEFAULT SETS THE CHAT AS INDIVIDUAL, NAMED AFTER THE OTHER MEMBER
+	friend_name = friend.username if friend else None
+	profile_pic = (friend.profile_picture_url("small") or None) if friend else None
+	return {"id":chat.id, "name":friend_name, "profile_picture":profile_pic, "last_message":message, "modified_at": modified_at, "is_group": False, **read_state}
+
+# INBOX ENTRIES OF A LIST OF MEMBERSHIPS OF THE USER, THE ONLY OTHER MEMBER OF EVERY INDIVIDUAL CHAT COMES FROM ONE QUERY
+def inbox_entries(user, chat_members):
+	individual_chats = [chat_member.chat_id for chat_member in chat_members if chat_member.chat.name == "not_assigned"]
+	friends = ChatMember.objects.filter(chat__in=individual_chats).exclude(member=user).select_related('member')
+	friends = {chat_member.chat_id: chat_member.member for chat_member in friends}
+	return [chat_data(chat_member, friends.get(chat_member.chat_id)) for chat_member in chat_members]
+
 # CREATE GROUP CHAT AND LIST OF ALL THE CHATS OF A USER
 class ChatListCreateView(APIView):
 	permission_classes = (IsAuthenticated,)
 	serializer_class = GroupChatSerializer
 
 	def get(self, request):
-		data = []
-
-		# GET CHAT LIST OF A SPECIFIC USER
-		chat_list = ChatMember.objects.filter(member=request.user)
-		chat_list = [chat_member.chat for chat_member in chat_list]
+		# GET CHAT LIST OF A SPECIFIC USER, THE INBOX FIELDS AND LAST AUTHOR COME IN THE SAME QUERY
+		chat_list = ChatMember.objects.filter(member=request.user)\
+			.select_related('chat', 'chat__last_message_author')\
+			.order_by('-chat__modified_at', '-chat__id')
 
-		# CHECKS AND ASSIGNS THE NAME OF THE CHATS
-		for chat in chat_list:
-			try:
-				# GETS THE LAST MESSAGE THAT WAS SAVED IN THE CHAT
-				message = Message.objects.filter(chat=chat).order_by('-date_sent')[0]
-			except:
-				message = "No messages yet"
-				modified_at = False
-			# IF THE CHAT NAME IS NOT THE DATABASE DEFAULT FOR INDIVIDUAL CHAT IT SETS THE CHAT TO GROUP CHAT
-			if chat.name != "not_assigned":
-				is_group = True
-				# SETS THE DATA TO BE SEND WHETHER THERE IS A MESSAGE OR NOT
-				if message != "No messages yet":
-					modified_at = message.date_sent
-					message = f'{message.author}: {message.content}'
-				data.append({"id":chat.id, "name":chat.name, "last_message":message, "modified_at":modified_at ,"is_group": is_group})
-			# IF THE CHAT NAME IS THE DATABASE DEFAULT SETS THE CHAT AS INDIVIDUAL
-			else:
-				is_group = False
-				# SETS THE DATA TO BE SEND WHETHER THERE IS A MESSAGE OR NOT
-				if message != "No messages yet":
-					modified_at = message.date_sent
-					message = f'{message.content}'
-				# GETS THE NAME OF THE ONLY OTHER MEMBER IN THE CHAT BESIDES THE USER THAT MADE THE REQUEST
-				friend_name = chat.chat_for_member.all().exclude(member=request.user)[0].member.username
-				profile_pic = chat.chat_for_member.all().exclude(member=request.user)[0].member.profile_picture
-				if not profile_pic:
-					profile_pic = None
-				else:
-					profile_pic = profile_pic.url
-				data.append({"id":chat.id, "name":friend_name, "profile_picture":profile_pic, "last_message":message, "modified_at": modified_at, "is_group": is_group})
-		return Response(data, status=status.HTTP_200_OK)
+		# KEYSET PAGINATION OVER (MODIFIED_AT, ID), 400 IF THE CURSOR OR THE LIMIT IS MALFORMED
+		# WITHOUT PARAMETERS THE MESSAGE_PAGE_SIZE MOST RECENT CHATS ARE SENT, OLDER ONES ARE FETCHED WITH "BEFORE"
+		try:
+			limit = get_page_size(request.query_params.get('limit'))
+			before = request.query_params.get('before')
+			if before:
+				modified_at, id = decode_cursor(before)
+				chat_list = chat_list.filter(Q(chat__modified_at__lt=modified_at) | Q(chat__modified_at=modified_at, chat__id__lt=id))
+		except ValueError as e:
+			return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+		chat_list = list(chat_list[:limit + 1])
+		has_older = len(chat_list) > limit
+		chat_list = chat_list[:limit]
+
+		last = chat_list[-1] if has_older else None
+		return Response({
+			"chats": inbox_entries(request.user, chat_list),
+			"next_before": encode_cursor(last.chat.modified_at, last.chat_id) if last else None,
+		}, status=status.HTTP_200_OK)
 
 	def post(self, request):
 
@@ -323,14 +387,14 @@ class ChatListCreateView(APIView):
 				# IF THERE IS A PROBLEM THE CHAT IS DELETED AND RETURN IS 400
 				chat.delete()
 				return Response({'Internal server error'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-			chat.save()
+			with transaction.atomic():
+				chat.save()
 
-			channel_layer = get_channel_layer()
-			async_to_sync(channel_layer.group_send)(f"{request.user.id}", {"type": "new.chat", "chat_id":f"{chat.id}"})
+				# ESTABLISH THE CREATOR OF THE CHAT AS A MEMBER OF IT
+				chat_member = ChatMember(member=request.user)
+				chat.add_member(chat_member)
 
-			# ESTABLISH THE CREATOR OF THE CHAT AS A MEMBER OF IT
-			chat_member = ChatMember(member=request.user)
-			chat.add_member(chat_member)
+				publish([request.user.id], {"type": "new.chat", "chat_id":f"{chat.id}"})
 
 			return Response(data={"id": chat.id, "name": chat.name, "is_group": chat.group_chat}, status=status.HTTP_201_CREATED)
 		return Response({'Bad Request': 'Invalid data...'}, status=status.HTTP_400_BAD_REQUEST)
@@ -360,38 +424,113 @@ class IndChatView(APIView):
 		if check_matching_column(request.user, friend_member):
 			return Response("A chat already exists", status=status.HTTP_409_CONFLICT)
 
-		chat = chat_serializer.save()
+		# THE UNIQUE DIRECT KEY MAKES A CONCURRENT REQUEST FOR THE SAME PAIR FAIL INSTEAD OF CREATING A SECOND CHAT
+		try:
+			with transaction.atomic():
+				chat = chat_serializer.save(direct_key=Chat.direct_key_for(request.user, friend_member))
 
-		# ADDS FRIEND TO CHAT
-		chat_member = ChatMember(member=friend_member)
-		chat.add_member(chat_member)
+				# ADDS FRIEND TO CHAT
+				chat_member = ChatMember(member=friend_member)
+				chat.add_member(chat_member)
 
-		# ADDS CHAT CREATOR TO CHAT
-		chat_member = ChatMember(member=request.user)
-		chat.add_member(chat_member)
+				# ADDS CHAT CREATOR TO CHAT
+				chat_member = ChatMember(member=request.user)
+				chat.add_member(chat_member)
 
-		channel_layer = get_channel_layer()
-		async_to_sync(channel_layer.group_send)(f"{friend_member.id}", {"type": "new.chat", "chat_id":f"{chat.id}"})
-		async_to_sync(channel_layer.group_send)(f"{request.user.id}", {"type": "new.chat", "chat_id":f"{chat.id}"})
+				publish([friend_member.id, request.user.id], {"type": "new.chat", "chat_id":f"{chat.id}"})
+		except IntegrityError:
+			return Response("A chat already exists", status=status.HTTP_409_CONFLICT)
 
 		return Response(data={"chat_id":chat.id, "is_group": False}, status=status.HTTP_201_CREATED)
 
-# METHOD THAT CHECKS IF A CHAT ALREADY EXITS
+# METHOD THAT CHECKS IF A CHAT ALREADY EXITS, ONE LOOKUP ON THE UNIQUE DIRECT KEY OF THE PAIR
 def check_matching_column(user, friend):
-	# GETS ALL CHAT_MEMBER OBJECTS FOR THE TWO USERS
-	queryset_1 = ChatMember.objects.filter(member=user)
-	queryset_2 = ChatMember.objects.filter(member=friend)
-
-	# MAKES A LIST OF THE CHATS BASED ON THE FIRST QUERYSET
-	chats = [chat_member.chat for chat_member in queryset_1]
-	for chat in chats:
-		# CHECKS IF ANY CHAT IN THE CHATS VIEW EXISTS IN THE SECOND QUERYSET
-		exact_chat = queryset_2.filter(chat=chat)
-		# TRUE IF A CHAT EXISTS
-		if exact_chat:
-			if exact_chat[0].chat.group_chat == False:
-				return exact_chat[0]
-	return None
+	return Chat.objects.filter(direct_key=Chat.direct_key_for(user, friend)).first()
+
+# RETURNS EVERYTHING THAT CHANGED FOR THE USER SINCE ITS LAST SYNC, SEE api/sync.py
+# THE CURSOR TRAVELS IN THE BODY BECAUSE IT GROWS WITH THE NUMBER OF CHATS
+class SyncView(APIView):
+	permission_classes = (IsAuthenticated,)
+
+	def post(self, request):
+		try:
+			changes = sync_changes(request.user, request.data.get("cursor"), request.data.get("limit"))
+		except ValueError as e:
+			return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+		changes["messages"] = [{
+			"id":message["id"],
+			"chat_id":message["chat"],
+			"seq":message["seq"],
+			"author":message["author__username"],
+			"content":message["content"],
+			"date_sent":message["date_sent"],
+		} for message in changes["messages"]]
+		changes["added_chats"] = inbox_entries(request.user, changes["added_chats"])
+		changes["friend_requests"] = FriendRequestSerializer(changes["friend_requests"], many=True).data
+		return Response(changes, status=status.HTTP_200_OK)
+
+# SEARCHES THE MESSAGES OF THE CHATS OF THE USER, ?q= IS THE QUERY AND ?chat= NARROWS IT TO ONE CHAT
+# RESULTS COME BEST FIRST, ?after= IS THE NEXT_AFTER CURSOR OF THE PREVIOUS PAGE
+class MessageSearchView(APIView):
+	permission_classes = (IsAuthenticated,)
+
+	def get(self, request):
+		query = request.query_params.get("q", "")
+		if not query.strip():
+			return Response("A search query is required", status=status.HTTP_400_BAD_REQUEST)
+		try:
+			chat_id = request.query_params.get("chat")
+			page = search_messages(
+				request.user,
+				query,
+				chat_id=uuid.UUID(chat_id) if chat_id else None,
+				after=request.query_params.get("after"),
+				limit=request.query_params.get("limit"),
+			)
+		except ValueError as e:
+			return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+		page["results"] = [{
+			"id":message.id,
+			"chat_id":message.chat_id,
+			"chat_name":message.chat.name if message.chat.group_chat else None,
+			"seq":message.seq,
+			"author":message.author.username if message.author else None,
+			"content":message.content,
+			"date_sent":message.date_sent,
+			"score":score,
+		} for message, score in page["results"]]
+		return Response(page, status=status.HTTP_200_OK)
+
+# USERNAME TYPEAHEAD FOR ADDING FRIENDS AND MEMBERS, ?q= IS THE PREFIX TYPED SO FAR
+# ONE QUERY, THE PREFIX IS A LIKE 'q%' OVER THE UNIQUE INDEX OF THE USERNAME
+# (POSTGRES ALSO CREATES A VARCHAR_PATTERN_OPS INDEX FOR IT) AND THE FRIEND AND REQUEST FLAGS ARE EXISTS SUBQUERIES
+class UserSearchView(APIView):
+	permission_classes = (IsAuthenticated,)
+
+	def get(self, request):
+		prefix = request.query_params.get("q", "")
+		if not prefix:
+			return Response("A search prefix is required", status=status.HTTP_400_BAD_REQUEST)
+		try:
+			limit = max(1, min(int(request.query_params.get("limit", settings.USER_SEARCH_LIMIT)), settings.USER_SEARCH_LIMIT))
+		except ValueError:
+			return Response("Invalid limit", status=status.HTTP_400_BAD_REQUEST)
+
+		users = CustomUser.objects.filter(username__startswith=prefix).exclude(id=request.user.id)\
+			.annotate(
+				is_friend=Exists(Friend.objects.filter(friends_list=request.user.id, friend=OuterRef('pk'))),
+				request_sent=Exists(FriendRequest.objects.filter(user_sender=request.user, user_receiver=OuterRef('pk'))),
+				request_received=Exists(FriendRequest.objects.filter(user_sender=OuterRef('pk'), user_receiver=request.user)),
+			)\
+			.only('username', 'profile_picture', 'profile_picture_thumbnails')\
+			.order_by('username')[:limit]
+		return Response([{
+			"name":user.username,
+			"profile_pic":user.profile_picture_url("small"),
+			"is_friend":user.is_friend,
+			"request_sent":user.request_sent,
+			"request_received":user.request_received,
+		} for user in users], status=status.HTTP_200_OK)
 
 # SIGNUP VIEW FOR USERS
 class CustomUserCreate(APIView):
@@ -428,7 +567,16 @@ class UploadProfilePictureView(APIView):
 		if not serializer.is_valid():
 			return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+		# THE PICTURE IS STORED UNDER ITS CONTENT HASH, A PICTURE THAT WAS ALREADY UPLOADED KEEPS ITS THUMBNAILS
 		user = request.user
-		user.profile_picture=request.FILES['profile_pic']
-		user.save()
-		return Response({"profile_pic": user.profile_picture.url}, status=status.HTTP_200_OK)
+		name = avatars.store(request.FILES['profile_pic'])
+		user.profile_picture.name = name
+		user.profile_picture_thumbnails = avatars.thumbnails_exist(name)
+		user.save(update_fields=['profile_picture', 'profile_picture_thumbnails'])
+
+		# THE NEW PICTURE SHOWS UP IN THE ROSTER OF EVERY USER THAT HAS THIS USER AS A FRIEND, AND AGAIN ONCE ITS THUMBNAILS ARE READY
+		friends_lists = list(Friend.objects.filter(friend=user).values_list('friends_list', flat=True))
+		bump_roster_versions(friends_lists)
+		if not user.profile_picture_thumbnails:
+			transaction.on_commit(lambda: avatars.generate_thumbnails(name, on_ready=lambda: bump_roster_versions(friends_lists)))
+		return Response({"profile_pic": user.profile_picture.url, "profile_pics": user.profile_picture_urls()}, status=status.HTTP_200_OK)
@@ -1,21 +1,50 @@
+from datetime import datetime, timezone
+from urllib.parse import parse_qs
+
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db import transaction
 
 from users.models import CustomUser
-from api.models import Chat, ChatMember, Message
+from api.models import Chat, ChatMember, Message, FriendRequest
+from api.sync import encode_sync_cursor, decode_sync_cursor, messages_in_ranges
+from api.search import index_messages
+from api import dedup
+from api.membership import get_user_chat_ids, get_chat_member_ids, cached_user_chat_ids, cached_chat_member_ids, \
+						   local_cache, user_key, chat_key
 from asgiref.sync import sync_to_async, async_to_sync
 
+import asyncio
 import jwt
 import json
+import logging
+import time
+import uuid
 import requests_async as arequests
 
 from channels.generic.websocket import AsyncWebsocketConsumer
 
+from api.outbox import dispatcher, event_seq
+from .persister import persister, save_messages
+from .reads import read_cursors
+from .replay import chat_events, user_events, record_chat_event, record_user_event, watch_user, unwatch_user
+from .outbound import OutboundQueue, QueueOverflow
+from .presence import presence, merge_diffs
+from . import instrumentation, shutdown
+
+logger = logging.getLogger(__name__)
+
 class ChatConsumer(AsyncWebsocketConsumer):
 	responde = {}
+	chat_names = {}
 	key = settings.SECRET_KEY
 	user = None
 	token = ""
+	counted = False
+	watching = False
+	outbound = None
+	# CLOSE CODE OF A SOCKET THAT FELL TOO FAR BEHIND, THE LAST FRAME IS THE RESUME HINT
+	CLOSE_TOO_SLOW = 4008
 
 	@sync_to_async
 	def get_user_id_from_token(self, token):
@@ -24,10 +53,12 @@ class ChatConsumer(AsyncWebsocketConsumer):
 		return user
 
 	@sync_to_async
-	def get_user_chats(self, id):
-		user_chat_members = ChatMember.objects.filter(member=id)
-		chats = [chat_member.chat for chat_member in user_chat_members]
-		return chats
+	def get_user_chat_ids(self, id):
+		return get_user_chat_ids(id)
+
+	@sync_to_async
+	def get_chat_member_ids(self, chat_id):
+		return get_chat_member_ids(chat_id)
 
 	@sync_to_async
 	def get_user_specific_chat(self, id):
@@ -35,24 +66,75 @@ class ChatConsumer(AsyncWebsocketConsumer):
 		return chat, chat.name
 
 	@sync_to_async
-	def create_message(self, data):
-		record = Message(chat=data['chat'], author=self.user, content=data['message'])
-		record.save()
+	def create_message(self, record):
+		start = time.perf_counter()
+		with transaction.atomic():
+			record.seq = Chat.allocate_seq(record.chat_id)
+			record.save()
+			Chat.record_message(record)
+			ChatMember.add_unread(record.chat_id, record.author_id)
+			index_messages([record])
+		instrumentation.persist_duration.observe(time.perf_counter() - start, mode="direct")
 		return record
 
+	@sync_to_async
+	def create_messages(self, records):
+		start = time.perf_counter()
+		duplicates = save_messages(records)
+		instrumentation.persist_duration.observe(time.perf_counter() - start, mode="direct")
+		instrumentation.persist_batch_size.observe(len(records))
+		return duplicates
+
+	@sync_to_async
+	def get_last_seqs(self, chat_ids):
+		return {f"{id}": seq for id, seq in Chat.objects.filter(id__in=chat_ids).values_list('id', 'last_seq')}
+
+	@sync_to_async
+	def get_missed_messages(self, ranges, limit):
+		return list(messages_in_ranges(ranges).values('chat', 'seq', 'author__username', 'content', 'chat__name', 'chat__group_chat')[:limit])
+
+	@sync_to_async
+	def get_missed_friend_requests(self, since):
+		return list(FriendRequest.objects.filter(user_receiver=self.user, date_sent__gt=since).select_related('user_sender').order_by('date_sent'))
+
+	# EVERY EVENT OF THE SOCKET AND OF THE CHANNEL LAYER GOES THROUGH HERE, SO IT IS COUNTED AND TIMED BY TYPE
+	async def dispatch(self, message):
+		event_type = message["type"].replace(".", "_")
+		start = time.perf_counter()
+		try:
+			await super().dispatch(message)
+		finally:
+			instrumentation.events_total.inc(type=event_type)
+			instrumentation.event_duration.observe(time.perf_counter() - start, type=event_type)
+
 	async def connect(self):
+		start = time.perf_counter()
 		dict_keys = list(self.scope["cookies"])
 		token_count = dict_keys.count("token")
 		if token_count:
 			try:
 				self.user = await self.get_user_id_from_token(self.scope['cookies']['token'])
 				self.token = self.scope['cookies']['token']
-				chats = await self.get_user_chats(self.user.id)
-				chats_ids = [chat.id for chat in chats]
-				for id in chats_ids:
-					await self.channel_layer.group_add(f'{id}', self.channel_name)
+				# WITH PER USER DELIVERY THE USER GROUP IS THE ONLY SUBSCRIPTION
+				if settings.CHAT_DELIVERY_MODE == 'chat_groups':
+					chats_ids = await self.get_user_chat_ids(self.user.id)
+					for id in chats_ids:
+						await self.channel_layer.group_add(f'{id}', self.channel_name)
 				await self.channel_layer.group_add(f"{self.user.id}", self.channel_name)
+				watch_user(f"{self.user.id}", event_seq())
+				self.watching = True
+				# DAPHNE DOES NOT SEND LIFESPAN EVENTS, SO THE FIRST SOCKET STARTS THE OUTBOX DISPATCHER OF THE WORKER
+				# AND HOOKS THE DRAIN OF ITS BUFFERS INTO THE SHUTDOWN OF THE PROCESS
+				if settings.OUTBOX_DISPATCH_IN_WORKER:
+					dispatcher.start()
+				shutdown.install()
 				await self.accept()
+				self.start_outbound()
+				self.counted = True
+				instrumentation.connections.inc()
+				instrumentation.connect_duration.observe(time.perf_counter() - start)
+				await self.announce_presence()
+				await self.replay()
 			except Exception as e:
 				print("entrando 1")
 				await self.accept()
@@ -63,77 +145,432 @@ class ChatConsumer(AsyncWebsocketConsumer):
 			await self.close()
 
 	async def disconnect(self, close_code):
+		if self.counted:
+			self.counted = False
+			instrumentation.connections.dec()
+		if self.outbound is not None:
+			self.outbound.stop()
 		if not self.user:
 			pass
 		else:
-			chats = await self.get_user_chats(self.user.id)
-			chats_ids = [chat.id for chat in chats]
-			for id in chats_ids:
-				await self.channel_layer.group_discard(f'{id}', self.channel_name)
+			await presence.disconnect(self.user.id, self.channel_name)
+			if settings.CHAT_DELIVERY_MODE == 'chat_groups':
+				chats_ids = await self.get_user_chat_ids(self.user.id)
+				for id in chats_ids:
+					await self.channel_layer.group_discard(f'{id}', self.channel_name)
+			await self.channel_layer.group_discard(f"{self.user.id}", self.channel_name)
+			if self.watching:
+				self.watching = False
+				unwatch_user(f"{self.user.id}")
+
+	# EVERYTHING FOR THE CLIENT GOES THROUGH THE SEND QUEUE OF THE SOCKET, SEE chat/outbound.py
+	# THE LAST SEQ WRITTEN PER CHAT (AND OF THE FRIEND REQUEST EVENTS) IS THE RESUME HINT IF THE SOCKET FALLS BEHIND
+	def start_outbound(self):
+		self.sent_seqs = {}
+		self.sent_user_seq = None
+		self.outbound = OutboundQueue(self.write_event, settings.CHAT_OUTBOUND_QUEUE_SIZE, settings.CHAT_OUTBOUND_POLICY)
+
+	def push(self, event, coalesce=None, merge=None):
+		if self.outbound is None:
+			return
+		try:
+			self.outbound.put(event, coalesce, merge)
+		except QueueOverflow:
+			instrumentation.outbound_disconnects.inc()
+			self.outbound.close({
+				'event': 'resume',
+				'cursor': encode_sync_cursor(self.sent_seqs, None),
+				'user_seq': self.sent_user_seq,
+			}, self.close_too_slow)
+
+	async def write_event(self, event):
+		await self.send(text_data=json.dumps(event))
+		if event.get('event') == 'new_message':
+			self.sent_seqs[event['chat_id']] = event['seq']
+		elif event.get('event') in ('new_friend_request', 'friend_request_accepted') and event.get('seq'):
+			self.sent_user_seq = event['seq']
+
+	# THE SOCKET COUNTS AS A DEVICE OF THE USER, IT GETS THE FRIENDS THAT ARE ONLINE AND THEN THE DIFFS, SEE chat/presence.py
+	async def announce_presence(self):
+		await presence.connect(self.user.id, self.channel_name)
+		online = await presence.online_friends(self.user.id)
+		if online:
+			self.push({'event': 'presence', 'online': online, 'offline': []}, "presence", merge_diffs)
+
+	# A DIFF THAT FINDS THE PREVIOUS ONE STILL QUEUED (A SLOW CLIENT) IS MERGED INTO IT
+	async def presence_diff(self, event):
+		self.push({'event': 'presence', 'online': event["online"], 'offline': event["offline"]}, "presence", merge_diffs)
+
+	async def close_too_slow(self):
+		await self.close(code=self.CLOSE_TOO_SLOW)
 
 	async def friend_request(self, event):
-		await self.send(text_data=json.dumps({
+		record_user_event(f"{self.user.id}", event)
+		self.push({
 			'event': 'new_friend_request',
 			'id': event["request_id"],
 			'user_sender': event["user_sender"],
-		}))
+			'seq': event.get("seq"),
+		})
+
+	# THE MEMBERSHIP CHANGE MAY HAVE BEEN MADE BY ANOTHER WORKER, SO THE LOCAL TIER OF THE CACHE IS DROPPED
+	def forget_membership(self, chat_id):
+		local_cache.delete(user_key(self.user.id))
+		local_cache.delete(chat_key(chat_id))
 
 	async def new_chat(self, event):
-		await self.channel_layer.group_add(f'{event["chat_id"]}', self.channel_name)
+		self.forget_membership(event["chat_id"])
+		if settings.CHAT_DELIVERY_MODE == 'chat_groups':
+			await self.channel_layer.group_add(f'{event["chat_id"]}', self.channel_name)
 
 	async def remove_chat(self, event):
-		await self.channel_layer.group_discard(f'{event["chat_id"]}', self.channel_name)
+		self.forget_membership(event["chat_id"])
+		if settings.CHAT_DELIVERY_MODE == 'chat_groups':
+			await self.channel_layer.group_discard(f'{event["chat_id"]}', self.channel_name)
+
+	# MEMBERSHIP CHECK, A MEMORY HIT WHEN THE USER CHATS ARE CACHED IN THIS WORKER
+	async def is_chat_member(self, chat_id):
+		chat_ids = cached_user_chat_ids(self.user.id)
+		if chat_ids is None:
+			chat_ids = await self.get_user_chat_ids(self.user.id)
+		return f"{chat_id}" in chat_ids
+
+	# SENDS AN EVENT TO EVERY MEMBER OF A CHAT
+	# CHAT_GROUPS USES THE CHAT GROUP, USER_GROUPS SENDS TO THE GROUP OF EACH MEMBER
+	async def fan_out(self, chat_id, event):
+		if settings.CHAT_DELIVERY_MODE == 'chat_groups':
+			await self.channel_layer.group_send(f"{chat_id}", event)
+			return
+		member_ids = cached_chat_member_ids(chat_id)
+		if member_ids is None:
+			member_ids = await self.get_chat_member_ids(chat_id)
+		for member_id in member_ids:
+			await self.channel_layer.group_send(f"{member_id}", event)
+
+	# FANS OUT THE SAVED MESSAGES OF ONE CHAT, SEVERAL OF THEM GO IN A SINGLE SEND_MESSAGES EVENT
+	async def deliver(self, chat_id, events, received, mode):
+		for event in events:
+			record_chat_event(event)
+		if len(events) == 1:
+			await self.fan_out(chat_id, events[0])
+		else:
+			await self.fan_out(chat_id, {'type': "send_messages", 'chat_id': chat_id, 'messages': events})
+		instrumentation.fan_out_latency.observe(time.perf_counter() - received, mode=mode)
 
 	async def request_accepted(self, event):
-		await self.send(text_data=json.dumps({
+		record_user_event(f"{self.user.id}", event)
+		self.push({
 			'event': 'friend_request_accepted',
 			'name': event["name"],
-		}))
+			'seq': event.get("seq"),
+		})
 
 	async def send_message(self, res):
 		#print(res)
-		await self.send(text_data=json.dumps({
+		record_chat_event(res)
+		self.push({
 			'event': 'new_message',
 			'chat_id': res["chat_id"],
 			'is_group': res["is_group"],
 			'name': res["name"],
 			'author': res["author"],
             "content": res["message"],
-        }))
+			'seq': res["seq"],
+        })
+
+	async def send_messages(self, event):
+		for message in event["messages"]:
+			await self.send_message(message)
+
+	async def message_failed(self, event):
+		self.push({
+			'type': "error",
+			"message": "Message could not be sent",
+			"chat_id": event["chat_id"],
+			"content": event["message"],
+		})
+
+	# REPLAYS WHAT THE CLIENT MISSED WHILE IT WAS DISCONNECTED
+	# ?cursor= IS THE SYNC CURSOR WITH THE LAST SEQ SEEN PER CHAT, ?user_seq= THE SEQ OF THE LAST FRIEND REQUEST EVENT SEEN
+	# THE SOCKET IS ALREADY SUBSCRIBED, SO AN EVENT MAY ARRIVE BOTH REPLAYED AND LIVE, CLIENTS DROP REPEATED SEQS
+	async def replay(self):
+		params = parse_qs(self.scope.get("query_string", b"").decode())
+		try:
+			if "user_seq" in params:
+				await self.replay_user_events(int(params["user_seq"][0]))
+			if "cursor" in params:
+				chat_seqs = decode_sync_cursor(params["cursor"][0])[0]
+				await self.replay_chat_events(chat_seqs)
+		except ValueError:
+			self.push({
+				'type': "error",
+				"message": "Invalid replay cursor",
+			})
 
+	async def replay_user_events(self, user_seq):
+		events = user_events.since(f"{self.user.id}", user_seq)
+		# THE BUFFER DOES NOT GO BACK THAT FAR, THE PENDING FRIEND REQUESTS ARE IN THE DATABASE
+		if events is None:
+			requests = await self.get_missed_friend_requests(datetime.fromtimestamp(user_seq / 1000000, tz=timezone.utc))
+			events = [{
+				"type": "friend.request",
+				"request_id": f"{request.id}",
+				"user_sender": request.user_sender.username,
+				"seq": int(request.date_sent.timestamp() * 1000000),
+			} for request in requests]
+		for event in events:
+			await getattr(self, event["type"].replace(".", "_"))(event)
+
+	async def replay_chat_events(self, chat_seqs):
+		chat_ids = cached_user_chat_ids(self.user.id)
+		if chat_ids is None:
+			chat_ids = await self.get_user_chat_ids(self.user.id)
+		chat_seqs = {chat_id: seq for chat_id, seq in chat_seqs.items() if chat_id in chat_ids}
+		if not chat_seqs:
+			return
+		last_seqs = await self.get_last_seqs(list(chat_seqs))
+
+		# THE GAP OF A CHAT COMES FROM MEMORY WHEN THE BUFFER HOLDS ALL OF IT, OTHERWISE FROM THE DATABASE
+		missing = []
+		for chat_id, seen in chat_seqs.items():
+			last = last_seqs.get(chat_id, seen)
+			if last <= seen:
+				continue
+			events = chat_events.since(chat_id, seen)
+			if events and events[-1]["seq"] >= last:
+				for event in events:
+					if event["seq"] <= last:
+						await self.send_message(event)
+			else:
+				missing.append((chat_id, seen, last))
+		if not missing:
+			return
+
+		limit = settings.CHAT_REPLAY_MAX_MESSAGES
+		rows = await self.get_missed_messages(missing, limit + 1)
+		if len(rows) > limit:
+			self.push({'event': 'resync'})
+			return
+		for row in rows:
+			await self.send_message({
+				'chat_id': f"{row['chat']}",
+				'is_group': row['chat__group_chat'],
+				'name': row['chat__name'] if row['chat__group_chat'] else row['author__username'],
+				'author': row['author__username'],
+				'message': row['content'],
+				'seq': row['seq'],
+			})
+
+	# CHAT NAMES DO NOT CHANGE ONCE THE CHAT IS CREATED, SO EACH WORKER KEEPS THEM IN MEMORY
+	async def get_chat_name(self, chat_id):
+		name = self.chat_names.get(chat_id)
+		if name is None:
+			chat, name = await self.get_user_specific_chat(chat_id)
+			if len(self.chat_names) >= settings.CHAT_NAME_CACHE_SIZE:
+				self.chat_names.clear()
+			self.chat_names[chat_id] = name
+		return name
+
+	# FRAMES WITHOUT A TYPE ARE CHAT MESSAGES
 	async def receive(self, text_data):
 		text_data_json = json.loads(text_data)
+		handler = {
+			"read": self.receive_read,
+			"batch": self.receive_batch,
+		}.get(text_data_json.get("type"), self.receive_message)
+		await handler(text_data_json)
+
+	# {"type": "read", "chat_id": ..., "seq": ...} MOVES THE READ CURSOR OF THE USER IN THE CHAT
+	# THE CURSOR IS WRITTEN BY THE READ CURSOR FLUSHER, SO FAST SCROLLING ENDS UP IN ONE UPDATE
+	async def receive_read(self, text_data_json):
+		try:
+			chat_id = uuid.UUID(str(text_data_json['chat_id']))
+			seq = int(text_data_json['seq'])
+			if not await self.is_chat_member(chat_id):
+				raise Exception("Not a member of the chat")
+			read_cursors.mark_read(self.user.id, chat_id, seq)
+		except Exception:
+			instrumentation.errors_total.inc(type="read")
+			self.push({
+				'type': "error",
+				"message": "Read cursor could not be updated",
+			})
+
+	# A MESSAGE WITH A CLIENT_ID IS A BATCH OF ONE, SO IT IS DEDUPLICATED AND ACKED
+	async def receive_message(self, text_data_json):
+		if text_data_json.get('client_id') is not None:
+			await self.receive_batch({'messages': [text_data_json]})
+			return
+		received = time.perf_counter()
 		message = text_data_json['message']
 		chat_id = text_data_json['chat_id']
 		is_group = text_data_json['is_group']
 
-		chat, group_name = await self.get_user_specific_chat(chat_id)
-
 		try:
-			data = {"chat":chat, "message":message}
-			record = await self.create_message(data)
-			print(record)
-			if is_group:
-				await self.channel_layer.group_send(str(chat_id), {
+			chat_id = uuid.UUID(str(chat_id))
+			if not await self.is_chat_member(chat_id):
+				raise Exception("Not a member of the chat")
+			group_name = await self.get_chat_name(chat_id)
+			record = Message(chat_id=chat_id, author=self.user, content=message)
+			chat_id = f"{chat_id}"
+			event = {
 				'type': "send_message",
 				'chat_id': chat_id,
-				'is_group': True,
-				'name': group_name,
+				'is_group': bool(is_group),
+				'name': group_name if is_group else self.user.username,
 				'author': self.user.username,
 				'message':message,
-				})
+			}
+
+			mode = "write_behind" if settings.CHAT_WRITE_BEHIND else "direct"
+
+			async def deliver(saved):
+				await self.deliver(chat_id, [dict(event, seq=message.seq) for message in saved], received, mode)
+
+			# WRITE BEHIND, THE MESSAGE IS SAVED IN THE NEXT BATCH AND FANNED OUT ONCE IT HAS ITS SEQUENCE NUMBER
+			if settings.CHAT_WRITE_BEHIND:
+				await persister.enqueue(record, self.channel_name, on_saved=deliver)
 			else:
-				await self.channel_layer.group_send(str(chat_id), {
-				'type': "send_message",
-				'chat_id': chat_id,
-				'is_group': False,
-				'name': self.user.username,
-				'author': self.user.username,
-				'message':message,
-				})
+				await deliver([await self.create_message(record)])
 		except Exception as e:
 			print(e)
-			await self.send(text_data=json.dumps({
+			instrumentation.errors_total.inc(type="message")
+			self.push({
 				'type': "error",
 	            "message": "Message could not be sent",
-	        }))
+	        })
+
+	# {"type": "batch", "messages": [{"client_id": ..., "chat_id": ..., "message": ..., "is_group": ...}, ...]}
+	# THE MESSAGES ARE CHECKED AGAINST ONE MEMBERSHIP LOOKUP, SAVED WITH ONE BULK INSERT AND FANNED OUT WITH ONE EVENT PER CHAT
+	# THE FRAME IS ANSWERED WITH ONE ACK, THE ID AND SEQ OF EVERY SAVED MESSAGE AND THE ERROR OF EVERY REJECTED ONE BY CLIENT_ID
+	# A CLIENT_ID THE USER ALREADY SENT IS ACKED WITH THE ORIGINAL MESSAGE, IT IS NOT SAVED OR FANNED OUT AGAIN (api/dedup.py)
+	async def receive_batch(self, text_data_json):
+		received = time.perf_counter()
+		mode = "write_behind" if settings.CHAT_WRITE_BEHIND else "direct"
+		items = text_data_json.get('messages')
+		if not isinstance(items, list) or not items or len(items) > settings.CHAT_BATCH_MAX_MESSAGES:
+			instrumentation.errors_total.inc(type="batch")
+			self.push({
+				'type': "error",
+				"message": f"A batch carries between 1 and {settings.CHAT_BATCH_MAX_MESSAGES} messages",
+			})
+			return
+
+		chat_ids = cached_user_chat_ids(self.user.id)
+		if chat_ids is None:
+			chat_ids = await self.get_user_chat_ids(self.user.id)
+		records = []
+		events = {}
+		# (CLIENT_ID, MESSAGE) PAIRS OF THE ACK, THE MESSAGE IS THE ORIGINAL ONE FOR A DUPLICATE
+		acked = []
+		errors = []
+		for item in items:
+			client_id = item.get('client_id') if isinstance(item, dict) else None
+			try:
+				if client_id is not None and not dedup.is_valid_client_id(client_id):
+					raise Exception("Invalid client id")
+				chat_id = uuid.UUID(str(item['chat_id']))
+				if f"{chat_id}" not in chat_ids:
+					raise Exception("Not a member of the chat")
+				if not isinstance(item['message'], str):
+					raise Exception("The message is not a string")
+				is_group = bool(item.get('is_group'))
+				group_name = await self.get_chat_name(chat_id)
+			except Exception:
+				# COUNTED BELOW, ONCE FOR THE WHOLE FRAME
+				errors.append({'client_id': client_id, 'error': "Message could not be sent"})
+				continue
+			original = dedup.recent(self.user.id, client_id) if client_id is not None else None
+			if original is not None:
+				acked.append((client_id, original))
+				continue
+			record = Message(chat_id=chat_id, author=self.user, content=item['message'], client_id=client_id)
+			# A CLIENT_ID REPEATED IN THE FRAME IS FOUND IN MEMORY TOO
+			dedup.remember([record])
+			records.append(record)
+			acked.append((client_id, record))
+			events[record.id] = {
+				'type': "send_message",
+				'chat_id': f"{chat_id}",
+				'is_group': is_group,
+				'name': group_name if is_group else self.user.username,
+				'author': self.user.username,
+				'message': item['message'],
+			}
+		if errors:
+			instrumentation.errors_total.inc(len(errors), type="batch")
+
+		def saved_events(saved):
+			return [dict(events[message.id], seq=message.seq) for message in saved]
+
+		# ONE CALLBACK PER CHAT, THE PERSISTER CALLS IT ONCE WITH EVERY MESSAGE OF THE CHAT THAT WAS IN THE SAME FLUSH
+		def chat_deliver(chat_id):
+			async def deliver(saved):
+				await self.deliver(chat_id, saved_events(saved), received, mode)
+			return deliver
+
+		if not records:
+			self.push_batch_ack(acked, errors)
+			return
+		if settings.CHAT_WRITE_BEHIND:
+			callbacks = {}
+			try:
+				futures = await persister.enqueue_many([
+					(record, callbacks.setdefault(record.chat_id, chat_deliver(f"{record.chat_id}")))
+					for record in records
+				])
+			except Exception:
+				logger.exception("Batch of %d messages could not be queued", len(records))
+				self.reject_batch(records, acked, errors)
+				return
+			# THE ACK WAITS FOR THE FLUSH WITHOUT HOLDING UP THE NEXT FRAMES OF THE SOCKET
+			asyncio.ensure_future(self.ack_batch_when_saved(records, futures, acked, errors))
+			return
+
+		try:
+			duplicates = await self.create_messages(records)
+		except Exception:
+			logger.exception("Batch of %d messages could not be saved", len(records))
+			self.reject_batch(records, acked, errors)
+			return
+		chats = {}
+		for message in records:
+			if message.id not in duplicates:
+				chats.setdefault(f"{message.chat_id}", []).append(message)
+		for chat_id, chat_messages in chats.items():
+			await self.deliver(chat_id, saved_events(chat_messages), received, mode)
+		self.push_batch_ack(self.replace_duplicates(acked, duplicates), errors)
+
+	async def ack_batch_when_saved(self, records, futures, acked, errors):
+		results = await asyncio.gather(*futures, return_exceptions=True)
+		failed = [record for record, result in zip(records, results) if isinstance(result, Exception)]
+		duplicates = {record.id: result for record, result in zip(records, results) if not isinstance(result, Exception) and result is not record}
+		if failed:
+			self.reject_batch(failed, acked, errors)
+			return
+		self.push_batch_ack(self.replace_duplicates(acked, duplicates), errors)
+
+	# THE DATABASE ALREADY HAD THESE CLIENT_IDS, THE ORIGINALS ARE REMEMBERED AND ACKED INSTEAD
+	def replace_duplicates(self, acked, duplicates):
+		dedup.remember(duplicates.values())
+		return [(client_id, duplicates.get(message.id, message)) for client_id, message in acked]
+
+	# NOTHING OF THE FAILED RECORDS WAS SAVED, THEIR RETRIES MUST GO THROUGH
+	def reject_batch(self, failed, acked, errors):
+		dedup.forget(failed)
+		instrumentation.errors_total.inc(len(failed), type="batch")
+		failed = {record.id for record in failed}
+		errors = errors + [{'client_id': client_id, 'error': "Message could not be sent"} for client_id, message in acked if message.id in failed]
+		self.push_batch_ack([(client_id, message) for client_id, message in acked if message.id not in failed], errors)
+
+	def push_batch_ack(self, acked, errors):
+		self.push({
+			'type': "ack",
+			'messages': [{
+				'client_id': client_id,
+				'id': f"{message.id}",
+				'chat_id': f"{message.chat_id}",
+				'seq': message.seq,
+			} for client_id, message in acked],
+			'errors': errors,
+		})
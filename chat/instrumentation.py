@@ -0,0 +1,23 @@
+from metrics.registry import registry
+
+# METRICS OF THE WEBSOCKET PATH, EXPORTED BY /metrics/ NEXT TO THE HTTP ONES
+# EVERY UPDATE IS A DICT UPDATE UNDER A LOCK, CHEAP ENOUGH TO LEAVE ON UNDER LOAD
+
+connections = registry.gauge("ws_connections", "Open WebSocket connections in this worker")
+connect_duration = registry.histogram("ws_connect_duration_seconds", "Time to authenticate, subscribe and accept a socket")
+events_total = registry.counter("ws_events_total", "Events handled by the consumer by type", ("type",))
+event_duration = registry.histogram("ws_event_duration_seconds", "Time to handle an event by type", ("type",))
+errors_total = registry.counter("ws_errors_total", "Frames that could not be handled by type", ("type",))
+# FROM THE FRAME ARRIVING TO ITS FAN OUT, WITH WRITE BEHIND IT INCLUDES THE WAIT FOR THE BATCH
+fan_out_latency = registry.histogram("ws_receive_to_fan_out_seconds", "Time from receiving a message to its group_send completing", ("mode",))
+persist_duration = registry.histogram("ws_persist_duration_seconds", "Time to save messages, one message or one write behind batch", ("mode",))
+persist_batch_size = registry.histogram(
+	"ws_persist_batch_size", "Messages per write behind batch",
+	buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+persist_queue_depth = registry.gauge("ws_persist_queue_depth", "Messages waiting in the write behind buffer")
+outbound_queued = registry.gauge("ws_outbound_queued", "Events waiting in the send queues of the sockets of this worker")
+outbound_coalesced = registry.counter("ws_outbound_coalesced_total", "Queued events replaced by a newer one with the same coalesce key")
+outbound_dropped = registry.counter("ws_outbound_dropped_total", "Events dropped because a client fell behind, by policy", ("reason",))
+outbound_disconnects = registry.counter("ws_outbound_disconnects_total", "Sockets closed because their send queue overflowed")
+presence_diffs = registry.counter("ws_presence_diffs_total", "Presence diff events sent to online friends")
@@ -0,0 +1,20 @@
+from django.conf import settings
+
+from api.outbox import dispatcher
+from . import shutdown
+
+
+# ASGI LIFESPAN HANDLER, STARTS THE OUTBOX DISPATCHER AND DRAINS THE WORKER BEFORE IT EXITS, SEE chat/shutdown.py
+# ONLY SERVERS THAT IMPLEMENT THE LIFESPAN PROTOCOL (E.G. UVICORN) SEND THESE EVENTS
+async def lifespan(scope, receive, send):
+	while True:
+		event = await receive()
+		if event["type"] == "lifespan.startup":
+			if settings.OUTBOX_DISPATCH_IN_WORKER:
+				dispatcher.start()
+			shutdown.install()
+			await send({"type": "lifespan.startup.complete"})
+		elif event["type"] == "lifespan.shutdown":
+			await shutdown.drain()
+			await send({"type": "lifespan.shutdown.complete"})
+			return
@@ -0,0 +1,226 @@
+import asyncio
+import json
+import random
+import time
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from users.models import CustomUser
+from api.models import Chat, ChatMember
+
+IN_MEMORY_CHANNEL_LAYERS = {
+	'default': {
+		'BACKEND': 'channels.layers.InMemoryChannelLayer',
+		'CONFIG': {
+			'capacity': 100000,
+		},
+	},
+}
+
+
+# NEAREST RANK PERCENTILE OF AN ALREADY SORTED LIST
+def percentile(values, p):
+	if not values:
+		return None
+	index = max(0, min(len(values) - 1, int(round(p / 100 * len(values))) - 1))
+	return values[index]
+
+# COUNTS THE QUERIES RUN ON A CONNECTION, UNLIKE CONNECTION.QUERIES IT IS NOT CAPPED
+class QueryCounter:
+
+	def __init__(self):
+		self.count = 0
+
+	def __call__(self, execute, sql, params, many, context):
+		self.count += 1
+		return execute(sql, params, many, context)
+
+def summary(values):
+	values = sorted(values)
+	return {
+		"count": len(values),
+		"p50": percentile(values, 50),
+		"p95": percentile(values, 95),
+		"p99": percentile(values, 99),
+		"max": values[-1] if values else None,
+	}
+
+
+class Command(BaseCommand):
+	help = (
+		"Load test of the WebSocket chat path. Runs the ASGI application in process against a throwaway "
+		"SQLite database and the in-memory channel layer, e.g. "
+		"`python manage.py bench_chat --settings=test_chat.bench_settings --sockets 200 --rate 2000`."
+	)
+
+	def add_arguments(self, parser):
+		parser.add_argument('--sockets', type=int, default=50, help="Number of simulated users, one socket each")
+		parser.add_argument('--group-size', type=int, default=10, help="Members per group chat, 0 for no group chats")
+		parser.add_argument('--group-ratio', type=float, default=0.5, help="Fraction of the messages sent to group chats")
+		parser.add_argument('--rate', type=float, default=200, help="Messages per second across all sockets")
+		parser.add_argument('--duration', type=float, default=5, help="Seconds to send for")
+		parser.add_argument('--drain', type=float, default=5, help="Seconds to wait for the last deliveries")
+		parser.add_argument('--seed', type=int, default=0)
+		parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+
+	def handle(self, *args, **options):
+		if connection.vendor != 'sqlite':
+			raise CommandError("The benchmark runs on SQLite, use --settings=test_chat.bench_settings")
+		self.random = random.Random(options['seed'])
+
+		old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+		try:
+			with override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS):
+				users, chats = self.seed(options['sockets'], options['group_size'])
+				# THE CONSUMER RUNS ITS QUERIES ON THIS THREAD THROUGH SYNC_TO_ASYNC
+				self.queries = QueryCounter()
+				with connection.execute_wrapper(self.queries):
+					report = async_to_sync(self.run)(users, chats, options)
+		finally:
+			connection.creation.destroy_test_db(old_name, verbosity=0)
+
+		if options['json']:
+			self.stdout.write(json.dumps(report, indent=2))
+		else:
+			self.print_report(report)
+
+	# CREATES THE USERS, ONE INDIVIDUAL CHAT PER NEIGHBOUR PAIR AND GROUP CHATS OF CONSECUTIVE USERS
+	def seed(self, sockets, group_size):
+		password = make_password(None)
+		users = CustomUser.objects.bulk_create([
+			CustomUser(username=f"bench_user_{i}", password=password) for i in range(sockets)
+		])
+
+		chats = []
+		members = []
+		for i in range(sockets if sockets > 2 else sockets - 1):
+			pair = [users[i], users[(i + 1) % sockets]]
+			chat = Chat(group_chat=False, direct_key=Chat.direct_key_for(*pair))
+			chats.append((chat, pair))
+		if group_size > 1:
+			for start in range(0, sockets, group_size):
+				group = users[start:start + group_size]
+				if len(group) > 1:
+					chats.append((Chat(group_chat=True, name=f"bench_group_{start}"), group))
+
+		Chat.objects.bulk_create([chat for chat, chat_members in chats])
+		for chat, chat_members in chats:
+			members.extend(ChatMember(chat=chat, member=user) for user in chat_members)
+		ChatMember.objects.bulk_create(members)
+		return users, chats
+
+	async def run(self, users, chats, options):
+		# IMPORTED HERE SO THE APPLICATION IS BUILT WITH THE BENCHMARK SETTINGS
+		from test_chat.asgi import application
+		from chat.persister import persister
+
+		user_chats = {user.id: [] for user in users}
+		for chat, chat_members in chats:
+			for user in chat_members:
+				user_chats[user.id].append((chat, len(chat_members)))
+
+		sent = {}
+		latencies = []
+		errors = []
+		connect_times = []
+		communicators = {}
+
+		# OPENS ONE SOCKET PER USER WITH ITS JWT COOKIE
+		for user in users:
+			token = str(RefreshToken.for_user(user).access_token)
+			communicator = WebsocketCommunicator(application, "/ws/chat/1/", headers=[(b"cookie", f"token={token}".encode())])
+			start = time.perf_counter()
+			connected, _ = await communicator.connect()
+			connect_times.append(time.perf_counter() - start)
+			if not connected:
+				raise CommandError(f"{user.username} could not connect")
+			communicators[user.id] = communicator
+
+		# READS THE OUTPUT QUEUE DIRECTLY, RECEIVE_FROM CANCELS THE APPLICATION ON TIMEOUT
+		async def read(communicator):
+			while True:
+				output = await communicator.output_queue.get()
+				if output.get("type") != "websocket.send":
+					continue
+				data = json.loads(output["text"])
+				if data.get("event") == "new_message" and data["content"] in sent:
+					latencies.append(time.perf_counter() - sent[data["content"]])
+				elif data.get("type") == "error":
+					errors.append(data)
+		readers = [asyncio.ensure_future(read(communicator)) for communicator in communicators.values()]
+
+		# SENDS AT A FIXED RATE FROM RANDOM USERS TO ONE OF THEIR CHATS
+		expected = 0
+		interval = 1 / options['rate']
+		count = int(options['rate'] * options['duration'])
+		initial_queries = self.queries.count
+		start = time.perf_counter()
+		for i in range(count):
+			delay = start + i * interval - time.perf_counter()
+			if delay > 0:
+				await asyncio.sleep(delay)
+			user = self.random.choice(users)
+			group = self.random.random() < options['group_ratio']
+			candidates = [entry for entry in user_chats[user.id] if entry[0].group_chat == group] or user_chats[user.id]
+			if not candidates:
+				continue
+			chat, member_count = self.random.choice(candidates)
+			message_id = uuid.uuid4().hex
+			sent[message_id] = time.perf_counter()
+			expected += member_count
+			await communicators[user.id].send_to(text_data=json.dumps({
+				"message": message_id,
+				"chat_id": f"{chat.id}",
+				"is_group": chat.group_chat,
+			}))
+		send_time = time.perf_counter() - start
+
+		deadline = time.perf_counter() + options['drain']
+		while len(latencies) < expected and time.perf_counter() < deadline:
+			await asyncio.sleep(0.01)
+		total_time = time.perf_counter() - start
+		await persister.stop()
+		queries = self.queries.count - initial_queries
+
+		for reader in readers:
+			reader.cancel()
+		for communicator in communicators.values():
+			await communicator.disconnect()
+
+		return {
+			"sockets": len(users),
+			"chats": len(chats),
+			"delivery_mode": settings.CHAT_DELIVERY_MODE,
+			"write_behind": settings.CHAT_WRITE_BEHIND,
+			"messages_sent": len(sent),
+			"send_rate": len(sent) / send_time if send_time else None,
+			"deliveries_expected": expected,
+			"deliveries": len(latencies),
+			"delivery_throughput": len(latencies) / total_time if total_time else None,
+			"errors": len(errors),
+			"connect_latency": summary(connect_times),
+			"send_receive_latency": summary(latencies),
+			"db_queries": queries,
+			"db_queries_per_message": queries / len(sent) if sent else None,
+		}
+
+	def print_report(self, report):
+		for key, value in report.items():
+			if isinstance(value, dict):
+				value = "  ".join(f"{name}={self.format(number, milliseconds=True)}" for name, number in value.items())
+			else:
+				value = self.format(value)
+			self.stdout.write(f"{key:<24}{value}")
+
+	def format(self, value, milliseconds=False):
+		if isinstance(value, float):
+			return f"{value * 1000:.2f}ms" if milliseconds else f"{value:.2f}"
+		return f"{value}"
@@ -0,0 +1,103 @@
+import asyncio
+from collections import deque
+
+from . import instrumentation
+
+DROP_OLDEST = "drop_oldest"
+DISCONNECT = "disconnect"
+
+
+class QueueOverflow(Exception):
+	pass
+
+
+# BOUNDED SEND QUEUE OF ONE SOCKET, DRAINED BY ITS OWN WRITER TASK
+# THE EVENT HANDLERS ONLY ENQUEUE, SO A SLOW CLIENT NEVER HOLDS UP THE CONSUMER (AND ITS CHANNEL LAYER BUFFER)
+# EVENTS WITH A COALESCE KEY REPLACE THE ONE WAITING UNDER THE SAME KEY, ONLY THE NEWEST STATE IS SENT
+# OR, WITH A MERGE FUNCTION, ARE FOLDED INTO IT (E.G. PRESENCE DIFFS, SEE chat/presence.py)
+# WHEN THE QUEUE IS FULL:
+#   DROP_OLDEST DROPS THE OLDEST EVENTS AND QUEUES A RESYNC EVENT SO THE CLIENT CATCHES UP THROUGH THE SYNC ENDPOINT
+#   DISCONNECT RAISES QUEUEOVERFLOW, THE CONSUMER THEN CLOSES THE SOCKET WITH A RESUME HINT
+class OutboundQueue:
+
+	def __init__(self, write, max_size, policy=DROP_OLDEST):
+		self.write = write
+		self.max_size = max_size
+		self.policy = policy
+		self.entries = deque()
+		self.coalesced = {}
+		self.ready = asyncio.Event()
+		self.closing = None
+		self.stopped = False
+		self.task = asyncio.ensure_future(self.run())
+
+	def __len__(self):
+		return len(self.entries)
+
+	# EVENTS FOR A SOCKET THAT IS CLOSING OR GONE ARE DROPPED, NOTHING WOULD WRITE THEM
+	def put(self, event, coalesce=None, merge=None):
+		if self.closing or self.stopped:
+			return
+		if coalesce is not None and coalesce in self.coalesced:
+			entry = self.coalesced[coalesce]
+			entry[1] = merge(entry[1], event) if merge else event
+			instrumentation.outbound_coalesced.inc()
+			return
+		if len(self.entries) >= self.max_size:
+			if self.policy == DISCONNECT:
+				raise QueueOverflow("The client is not reading fast enough")
+			self.drop_oldest()
+		self.append(event, coalesce)
+
+	def append(self, event, coalesce=None):
+		entry = [coalesce, event]
+		self.entries.append(entry)
+		if coalesce is not None:
+			self.coalesced[coalesce] = entry
+		instrumentation.outbound_queued.inc()
+		self.ready.set()
+
+	def popleft(self):
+		coalesce, event = self.entries.popleft()
+		if coalesce is not None:
+			del self.coalesced[coalesce]
+		instrumentation.outbound_queued.dec()
+		return event
+
+	# MAKES ROOM FOR THE NEW EVENT AND FOR THE RESYNC EVENT, WHICH IS ONLY QUEUED ONCE
+	def drop_oldest(self):
+		room = 1 if "resync" in self.coalesced else 2
+		while self.entries and len(self.entries) > self.max_size - room:
+			self.popleft()
+			instrumentation.outbound_dropped.inc(reason=DROP_OLDEST)
+		if "resync" not in self.coalesced:
+			self.append({"event": "resync"}, "resync")
+
+	# DROPS EVERYTHING THAT IS WAITING, SENDS LAST_EVENT AND CALLS ON_CLOSED ONCE IT IS WRITTEN
+	def close(self, last_event, on_closed):
+		instrumentation.outbound_dropped.inc(len(self.entries), reason=DISCONNECT)
+		while self.entries:
+			self.popleft()
+		self.append(last_event)
+		self.closing = on_closed
+
+	async def run(self):
+		while True:
+			await self.ready.wait()
+			while self.entries:
+				try:
+					await self.write(self.popleft())
+				except Exception as e:
+					print(e)
+			self.ready.clear()
+			if self.closing:
+				await self.closing()
+				return
+
+	# STOPS THE WRITER, WHATEVER IS STILL QUEUED IS LOST WITH THE SOCKET
+	def stop(self):
+		self.stopped = True
+		self.task.cancel()
+		instrumentation.outbound_queued.dec(len(self.entries))
+		self.entries.clear()
+		self.coalesced.clear()
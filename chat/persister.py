@@ -0,0 +1,213 @@
+import asyncio
+import time
+from collections import deque, Counter
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+
+from api.models import Chat, ChatMember, Message
+from api.search import index_messages
+from api.dedup import find_duplicates
+from . import instrumentation
+
+
+# A BATCH IS RETRIED ONCE WITHOUT THE CLIENT IDS ANOTHER WORKER SAVED IN THE MEANTIME
+SAVE_ATTEMPTS = 2
+
+
+class PersisterFull(Exception):
+	pass
+
+
+# WRITE BEHIND PIPELINE FOR WEBSOCKET MESSAGES
+# MESSAGES ARE BUFFERED IN MEMORY AND SAVED WITH BULK_CREATE ONCE THE BATCH IS FULL OR THE FLUSH INTERVAL EXPIRES
+# THE SEQUENCE NUMBERS ARE ALLOCATED AT FLUSH TIME, ON_SAVED CALLBACKS RUN AFTERWARDS SO THEY CAN USE THEM
+# THE BUFFER IS BOUNDED, WHEN IT IS FULL ENQUEUE RAISES PERSISTERFULL AND THE SENDER IS TOLD RIGHT AWAY
+class MessagePersister:
+
+	def __init__(self, batch_size, flush_interval, max_queue):
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.max_queue = max_queue
+		self.loop = None
+		self.task = None
+
+	@classmethod
+	def from_settings(cls):
+		return cls(
+			batch_size=settings.CHAT_PERSIST_BATCH_SIZE,
+			flush_interval=settings.CHAT_PERSIST_FLUSH_INTERVAL,
+			max_queue=settings.CHAT_PERSIST_MAX_QUEUE,
+		)
+
+	# CREATES THE BUFFER AND THE FLUSHER TASK ON THE RUNNING EVENT LOOP
+	def start(self):
+		loop = asyncio.get_event_loop()
+		if self.loop is loop and self.task and not self.task.done():
+			return
+		self.loop = loop
+		self.stopping = False
+		self.buffer = deque()
+		self.pending = asyncio.Event()
+		self.full = asyncio.Event()
+		self.task = loop.create_task(self.run())
+
+	def __len__(self):
+		return len(self.buffer) if self.loop else 0
+
+	# ADDS A MESSAGE TO THE BUFFER, REPLY_CHANNEL IS NOTIFIED IF THE MESSAGE CAN NOT BE SAVED
+	# ON_SAVED IS A COROUTINE FUNCTION CALLED WITH THE LIST OF SAVED MESSAGES, SEE RUN_CALLBACKS
+	async def enqueue(self, message, reply_channel=None, on_saved=None):
+		return (await self.enqueue_many([(message, on_saved)], reply_channel))[0]
+
+	# ADDS SEVERAL (MESSAGE, ON_SAVED) PAIRS, ALL OF THEM OR NONE IF THE BUFFER HAS NO ROOM
+	# RETURNS A FUTURE PER MESSAGE, RESOLVED ONCE THE MESSAGE IS SAVED AND ITS ON_SAVED HAS RUN
+	async def enqueue_many(self, entries, reply_channel=None):
+		self.start()
+		if len(self.buffer) + len(entries) > self.max_queue:
+			raise PersisterFull("Too many messages waiting to be saved")
+		futures = []
+		for message, on_saved in entries:
+			future = self.loop.create_future()
+			self.buffer.append((message, reply_channel, on_saved, future))
+			futures.append(future)
+		instrumentation.persist_queue_depth.set(len(self.buffer))
+		self.pending.set()
+		if len(self.buffer) >= self.batch_size:
+			self.full.set()
+		return futures
+
+	async def run(self):
+		while not self.stopping:
+			await self.pending.wait()
+			# GIVES THE BATCH UP TO FLUSH_INTERVAL SECONDS TO FILL UP
+			if not self.stopping and len(self.buffer) < self.batch_size:
+				self.full.clear()
+				try:
+					await asyncio.wait_for(self.full.wait(), self.flush_interval)
+				except asyncio.TimeoutError:
+					pass
+			await self.flush()
+
+	# SAVES ONE BATCH FROM THE HEAD OF THE BUFFER
+	async def flush(self):
+		batch = [self.buffer.popleft() for _ in range(min(len(self.buffer), self.batch_size))]
+		instrumentation.persist_queue_depth.set(len(self.buffer))
+		if not self.buffer:
+			self.pending.clear()
+		if not batch:
+			return
+		start = time.perf_counter()
+		try:
+			duplicates = await sync_to_async(self.save)([message for message, reply_channel, on_saved, future in batch])
+		except Exception as e:
+			print(e)
+			await self.notify_failure(batch, e)
+			return
+		instrumentation.persist_duration.observe(time.perf_counter() - start, mode="write_behind")
+		instrumentation.persist_batch_size.observe(len(batch))
+		# A DUPLICATE IS NOT FANNED OUT AGAIN, ITS FUTURE GETS THE ORIGINAL MESSAGE
+		await self.run_callbacks([entry for entry in batch if entry[0].id not in duplicates])
+		for message, reply_channel, on_saved, future in batch:
+			if not future.done():
+				future.set_result(duplicates.get(message.id, message))
+
+	def save(self, messages):
+		return save_messages(messages)
+
+	# CALLBACKS OF ONE CHAT RUN IN ORDER, THE CHATS CONCURRENTLY
+	# CONSECUTIVE MESSAGES OF A CHAT THAT SHARE THEIR ON_SAVED (A BATCHED FRAME) GET ONE CALL WITH ALL OF THEM
+	async def run_callbacks(self, batch):
+		chats = {}
+		for message, reply_channel, on_saved, future in batch:
+			if on_saved:
+				callbacks = chats.setdefault(message.chat_id, [])
+				if callbacks and callbacks[-1][0] is on_saved:
+					callbacks[-1][1].append(message)
+				else:
+					callbacks.append((on_saved, [message]))
+
+		async def run_chat(callbacks):
+			for on_saved, messages in callbacks:
+				try:
+					await on_saved(messages)
+				except Exception as e:
+					print(e)
+
+		await asyncio.gather(*[run_chat(callbacks) for callbacks in chats.values()])
+
+	async def notify_failure(self, batch, error):
+		channel_layer = get_channel_layer()
+		for message, reply_channel, on_saved, future in batch:
+			if not future.done():
+				future.set_exception(error)
+			if reply_channel:
+				await channel_layer.send(reply_channel, {
+					'type': "message.failed",
+					'chat_id': f"{message.chat_id}",
+					'message': message.content,
+				})
+
+	# SAVES EVERYTHING THAT IS STILL BUFFERED AND STOPS THE FLUSHER TASK
+	async def stop(self):
+		if not self.loop:
+			return
+		self.stopping = True
+		self.pending.set()
+		self.full.set()
+		if self.task:
+			await self.task
+			self.task = None
+		while self.buffer:
+			await self.flush()
+
+	# SAVES WHAT IS STILL BUFFERED WITHOUT THE EVENT LOOP, FOR WHEN THE PROCESS EXITS WITHOUT STOP HAVING RUN
+	# THE MESSAGES ARE SAVED BUT NOT FANNED OUT, THE CLIENTS GET THEM THROUGH REPLAY OR SYNC
+	def save_pending(self):
+		if not self.loop or not self.buffer:
+			return
+		batch = list(self.buffer)
+		self.buffer.clear()
+		self.save([message for message, reply_channel, on_saved, future in batch])
+
+
+# SAVES MESSAGES OF ANY NUMBER OF CHATS IN ONE TRANSACTION, USED BY THE PERSISTER AND BY BATCHED FRAMES WITHOUT WRITE BEHIND
+# ONE SEQUENCE ALLOCATION PER CHAT, ONE BULK INSERT (AND ONE FOR THE SEARCH TERMS), ONE INBOX UPDATE PER CHAT AND ONE UNREAD UPDATE
+# MESSAGES WHOSE CLIENT_ID WAS ALREADY USED BY THEIR AUTHOR ARE LEFT OUT, RETURNS {ID OF THE DUPLICATE: ORIGINAL MESSAGE}
+def save_messages(messages):
+	for attempt in range(SAVE_ATTEMPTS):
+		duplicates = find_duplicates(messages)
+		new = [message for message in messages if message.id not in duplicates]
+		if not new:
+			return duplicates
+		try:
+			insert_messages(new)
+			return duplicates
+		except IntegrityError:
+			# A RETRY SAVED BY ANOTHER WORKER BETWEEN THE CHECK AND THE INSERT, THE NEXT CHECK FINDS IT
+			# SO ONLY THAT MESSAGE IS LEFT OUT AND THE REST OF THE BATCH IS SAVED
+			if attempt == SAVE_ATTEMPTS - 1:
+				raise
+
+# ALL OR NOTHING, THE SEQUENCE NUMBERS OF A FAILED INSERT ARE ROLLED BACK WITH IT SO THE CHATS DO NOT GET GAPS
+def insert_messages(messages):
+	chats = {}
+	for message in messages:
+		chats.setdefault(message.chat_id, []).append(message)
+	with transaction.atomic():
+		# THE CHAT ROWS ARE LOCKED IN THE SAME ORDER BY EVERY WORKER SO TWO FLUSHES CAN NOT DEADLOCK
+		for chat_id in sorted(chats, key=str):
+			first = Chat.allocate_seq(chat_id, len(chats[chat_id]))
+			for i, message in enumerate(chats[chat_id]):
+				message.seq = first + i
+		Message.objects.bulk_create(messages)
+		index_messages(messages)
+		for chat_messages in chats.values():
+			Chat.record_message(chat_messages[-1])
+		ChatMember.add_unread_counts(Counter((message.chat_id, message.author_id) for message in messages))
+
+
+# ONE PERSISTER PER WORKER PROCESS
+persister = MessagePersister.from_settings()
@@ -0,0 +1,273 @@
+import asyncio
+import time
+
+from django.conf import settings
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+
+from api.models import Friend
+from . import instrumentation
+
+# PRESENCE OF THE USERS, ONLINE WHILE AT LEAST ONE OF THEIR SOCKETS (DEVICES) IS CONNECTED
+# EVERY SOCKET IS A DEVICE OF THE STORE WITH AN EXPIRY, THE WORKER THAT OWNS IT REFRESHES IT EVERY PRESENCE_INTERVAL
+# SO THE SOCKETS OF A WORKER THAT DIED GO OFFLINE AFTER PRESENCE_TTL SECONDS
+# THE CHANGES ARE NOT SENT WHEN THEY HAPPEN, EACH WORKER COALESCES THEM AND ONCE PER INTERVAL SENDS EVERY ONLINE FRIEND
+# A SINGLE PRESENCE.DIFF EVENT WITH THE FRIENDS THAT CAME ONLINE AND WENT OFFLINE
+
+
+# ONE WORKER ONLY, EVERY WORKER HAS ITS OWN
+class MemoryPresenceStore:
+
+	def __init__(self, ttl):
+		self.ttl = ttl
+		# USER ID -> {DEVICE: EXPIRY}
+		self.devices = {}
+
+	# THE METHODS RETURN WHETHER THE USER CAME ONLINE / WENT OFFLINE
+	async def add(self, user_id, device):
+		devices = self.devices.setdefault(user_id, {})
+		online = bool(self.live(devices))
+		devices[device] = time.time() + self.ttl
+		return not online
+
+	async def remove(self, user_id, device):
+		devices = self.devices.get(user_id, {})
+		if devices.pop(device, None) is None:
+			return False
+		if self.live(devices):
+			return False
+		self.devices.pop(user_id, None)
+		return True
+
+	async def refresh(self, devices):
+		expiry = time.time() + self.ttl
+		for user_id, device in devices:
+			self.devices.setdefault(user_id, {})[device] = expiry
+
+	# NUMBER OF LIVE DEVICES OF EACH USER, USERS THAT ARE OFFLINE ARE LEFT OUT
+	async def online(self, user_ids):
+		counts = {user_id: len(self.live(self.devices.get(user_id, {}))) for user_id in user_ids}
+		return {user_id: count for user_id, count in counts.items() if count}
+
+	# DROPS THE EXPIRED DEVICES, RETURNS THE USERS THAT WENT OFFLINE WITH THEM
+	async def expire(self):
+		offline = []
+		for user_id, devices in list(self.devices.items()):
+			if not self.live(devices):
+				del self.devices[user_id]
+				offline.append(user_id)
+		return offline
+
+	def live(self, devices):
+		now = time.time()
+		for device, expiry in list(devices.items()):
+			if expiry <= now:
+				del devices[device]
+		return devices
+
+
+# SHARED BY EVERY WORKER, ONE SORTED SET PER USER WITH ITS DEVICES SCORED BY THEIR EXPIRY
+# PRESENCE:EXPIRY HOLDS EVERY ONLINE USER SCORED BY THE EXPIRY OF ITS NEWEST DEVICE, SO THE DEAD ONES ARE FOUND WITHOUT A SCAN
+# USES AIOREDIS 1.X, THE VERSION REQUIRED BY CHANNELS_REDIS
+class RedisPresenceStore:
+	EXPIRY_KEY = "presence:expiry"
+
+	def __init__(self, url, ttl):
+		self.url = url
+		self.ttl = ttl
+		self.redis = None
+
+	def user_key(self, user_id):
+		return f"presence:user:{user_id}"
+
+	async def connect(self):
+		if self.redis is None:
+			import aioredis
+			self.redis = await aioredis.create_redis_pool(self.url)
+		return self.redis
+
+	async def add(self, user_id, device):
+		redis = await self.connect()
+		now = time.time()
+		key = self.user_key(user_id)
+		transaction = redis.multi_exec()
+		transaction.zremrangebyscore(key, max=now)
+		transaction.zcard(key)
+		transaction.zadd(key, now + self.ttl, device)
+		transaction.expire(key, int(self.ttl) + 1)
+		transaction.zadd(self.EXPIRY_KEY, now + self.ttl, user_id)
+		removed, count, added, expire, indexed = await transaction.execute()
+		return count == 0
+
+	async def remove(self, user_id, device):
+		redis = await self.connect()
+		key = self.user_key(user_id)
+		transaction = redis.multi_exec()
+		transaction.zrem(key, device)
+		transaction.zremrangebyscore(key, max=time.time())
+		transaction.zcard(key)
+		removed, expired, count = await transaction.execute()
+		if not removed or count:
+			return False
+		# ONLY THE WORKER THAT TAKES THE USER OUT OF THE EXPIRY SET ANNOUNCES IT
+		return bool(await redis.zrem(self.EXPIRY_KEY, user_id))
+
+	async def refresh(self, devices):
+		if not devices:
+			return
+		redis = await self.connect()
+		expiry = time.time() + self.ttl
+		pipeline = redis.pipeline()
+		for user_id, device in devices:
+			pipeline.zadd(self.user_key(user_id), expiry, device)
+			pipeline.expire(self.user_key(user_id), int(self.ttl) + 1)
+			pipeline.zadd(self.EXPIRY_KEY, expiry, user_id)
+		await pipeline.execute()
+
+	async def online(self, user_ids):
+		user_ids = list(user_ids)
+		if not user_ids:
+			return {}
+		redis = await self.connect()
+		pipeline = redis.pipeline()
+		now = time.time()
+		for user_id in user_ids:
+			pipeline.zcount(self.user_key(user_id), min=now)
+		counts = await pipeline.execute()
+		return {user_id: count for user_id, count in zip(user_ids, counts) if count}
+
+	async def expire(self):
+		redis = await self.connect()
+		now = time.time()
+		offline = []
+		for user_id in await redis.zrangebyscore(self.EXPIRY_KEY, max=now, encoding="utf-8"):
+			if await self.online([user_id]):
+				continue
+			if await redis.zrem(self.EXPIRY_KEY, user_id):
+				offline.append(user_id)
+		return offline
+
+
+def get_store():
+	if settings.PRESENCE_REDIS_URL:
+		return RedisPresenceStore(settings.PRESENCE_REDIS_URL, settings.PRESENCE_TTL)
+	return MemoryPresenceStore(settings.PRESENCE_TTL)
+
+
+class PresenceService:
+
+	def __init__(self, store, interval):
+		self.store = store
+		self.interval = interval
+		self.loop = None
+		self.task = None
+
+	@classmethod
+	def from_settings(cls):
+		return cls(store=get_store(), interval=settings.PRESENCE_INTERVAL)
+
+	# CREATES THE STATE AND THE TICK TASK ON THE RUNNING EVENT LOOP
+	def start(self):
+		loop = asyncio.get_event_loop()
+		if self.loop is loop and self.task and not self.task.done():
+			return
+		self.loop = loop
+		self.stopping = False
+		# SOCKETS OF THIS WORKER, CHANNEL NAME -> USER ID
+		self.sockets = {}
+		# USER ID -> TRUE (ONLINE) OR FALSE (OFFLINE), THE LAST CHANGE OF THE INTERVAL WINS
+		self.changes = {}
+		self.stopped = asyncio.Event()
+		self.task = loop.create_task(self.run())
+
+	async def connect(self, user_id, channel_name):
+		self.start()
+		user_id = f"{user_id}"
+		self.sockets[channel_name] = user_id
+		if await self.store.add(user_id, channel_name):
+			self.changes[user_id] = True
+
+	async def disconnect(self, user_id, channel_name):
+		if self.loop is None:
+			return
+		user_id = f"{user_id}"
+		self.sockets.pop(channel_name, None)
+		if await self.store.remove(user_id, channel_name):
+			self.changes[user_id] = False
+
+	# FRIENDS OF THE USER THAT ARE ONLINE NOW, SENT TO A SOCKET WHEN IT CONNECTS
+	async def online_friends(self, user_id):
+		friends = await sync_to_async(friend_names)(user_id)
+		online = await self.store.online(friends)
+		return sorted(friends[friend_id] for friend_id in online)
+
+	async def run(self):
+		while not self.stopping:
+			try:
+				await asyncio.wait_for(self.stopped.wait(), self.interval)
+			except asyncio.TimeoutError:
+				pass
+			try:
+				await self.tick()
+			except Exception as e:
+				print(e)
+
+	# REFRESHES THE SOCKETS OF THE WORKER, COLLECTS THE USERS WHOSE SOCKETS EXPIRED AND SENDS THE CHANGES
+	async def tick(self):
+		await self.store.refresh([(user_id, channel_name) for channel_name, user_id in self.sockets.items()])
+		for user_id in await self.store.expire():
+			self.changes[user_id] = False
+		await self.flush()
+
+	# ONE QUERY FOR THE FRIENDS OF EVERY CHANGED USER, ONE STORE LOOKUP FOR WHICH OF THEM ARE ONLINE
+	# AND ONE EVENT PER ONLINE FRIEND, HOWEVER MANY OF ITS FRIENDS CHANGED
+	async def flush(self):
+		changes, self.changes = self.changes, {}
+		if not changes:
+			return
+		rows = await sync_to_async(friendships_of)(list(changes))
+		online = await self.store.online({owner_id for owner_id, friend_id, name in rows})
+		diffs = {}
+		for owner_id, friend_id, name in rows:
+			if owner_id in online:
+				diff = diffs.setdefault(owner_id, {"online": [], "offline": []})
+				diff["online" if changes[friend_id] else "offline"].append(name)
+		channel_layer = get_channel_layer()
+		for owner_id, diff in diffs.items():
+			await channel_layer.group_send(owner_id, dict(diff, type="presence.diff"))
+		instrumentation.presence_diffs.inc(len(diffs))
+
+	# STOPS THE TICK TASK, TAKES THE SOCKETS OF THE WORKER OUT OF THE STORE AND SENDS THE PENDING CHANGES
+	async def stop(self):
+		if not self.loop:
+			return
+		self.stopping = True
+		self.stopped.set()
+		if self.task:
+			await self.task
+			self.task = None
+		sockets, self.sockets = self.sockets, {}
+		for channel_name, user_id in sockets.items():
+			if await self.store.remove(user_id, channel_name):
+				self.changes[user_id] = False
+		await self.flush()
+
+
+# FOLDS A PRESENCE EVENT INTO THE ONE STILL WAITING IN THE SEND QUEUE OF A SOCKET, THE NEWER STATE OF A FRIEND WINS
+def merge_diffs(waiting, event):
+	online = (set(waiting["online"]) - set(event["offline"])) | set(event["online"])
+	offline = (set(waiting["offline"]) - set(event["online"])) | set(event["offline"])
+	return dict(waiting, online=sorted(online), offline=sorted(offline))
+
+# FRIEND ID -> USERNAME OF THE FRIENDS OF A USER, IDS AS STRINGS
+def friend_names(user_id):
+	return {f"{friend_id}": name for friend_id, name in Friend.objects.filter(friends_list=user_id).values_list('friend', 'friend__username')}
+
+# (OWNER ID, FRIEND ID, FRIEND USERNAME) OF EVERY FRIENDS LIST THAT HAS ONE OF THE USERS, IDS AS STRINGS
+def friendships_of(user_ids):
+	rows = Friend.objects.filter(friend__in=user_ids).values_list('friends_list', 'friend', 'friend__username')
+	return [(f"{owner_id}", f"{friend_id}", name) for owner_id, friend_id, name in rows]
+
+
+# ONE SERVICE PER WORKER PROCESS
+presence = PresenceService.from_settings()
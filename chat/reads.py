@@ -0,0 +1,93 @@
+import asyncio
+
+from django.conf import settings
+from django.db import transaction
+from asgiref.sync import sync_to_async
+
+from api.models import ChatMember
+
+
+# COALESCES THE READ CURSORS SENT BY THE CLIENTS
+# A CLIENT SCROLLING THROUGH A CHAT SENDS MANY READ EVENTS, ONLY THE HIGHEST SEQ PER (USER, CHAT) IS KEPT
+# AND THE PENDING CURSORS ARE WRITTEN TOGETHER ONCE PER FLUSH INTERVAL
+class ReadCursorFlusher:
+
+	def __init__(self, flush_interval):
+		self.flush_interval = flush_interval
+		self.loop = None
+		self.task = None
+
+	@classmethod
+	def from_settings(cls):
+		return cls(flush_interval=settings.CHAT_READ_FLUSH_INTERVAL)
+
+	# CREATES THE PENDING CURSORS AND THE FLUSHER TASK ON THE RUNNING EVENT LOOP
+	def start(self):
+		loop = asyncio.get_event_loop()
+		if self.loop is loop and self.task and not self.task.done():
+			return
+		self.loop = loop
+		self.stopping = False
+		self.cursors = {}
+		self.pending = asyncio.Event()
+		self.stopped = asyncio.Event()
+		self.task = loop.create_task(self.run())
+
+	def __len__(self):
+		return len(self.cursors) if self.loop else 0
+
+	def mark_read(self, user_id, chat_id, seq):
+		self.start()
+		key = (user_id, chat_id)
+		if seq > self.cursors.get(key, 0):
+			self.cursors[key] = seq
+			self.pending.set()
+
+	async def run(self):
+		while not self.stopping:
+			await self.pending.wait()
+			# WAITS OUT THE INTERVAL SO THE CURSORS OF A SCROLL END UP IN ONE WRITE, STOP CUTS IT SHORT
+			try:
+				await asyncio.wait_for(self.stopped.wait(), self.flush_interval)
+			except asyncio.TimeoutError:
+				pass
+			await self.flush()
+
+	async def flush(self):
+		cursors, self.cursors = self.cursors, {}
+		self.pending.clear()
+		if not cursors:
+			return
+		try:
+			await sync_to_async(self.save)(cursors)
+		except Exception as e:
+			print(e)
+
+	# ONE UPDATE PER CURSOR, CURSORS THAT DO NOT MOVE FORWARD DO NOT CHANGE THE ROW
+	def save(self, cursors):
+		with transaction.atomic():
+			for user_id, chat_id in sorted(cursors, key=str):
+				ChatMember.mark_read(chat_id, user_id, cursors[(user_id, chat_id)])
+
+	# WRITES THE PENDING CURSORS AND STOPS THE FLUSHER TASK
+	async def stop(self):
+		if not self.loop:
+			return
+		self.stopping = True
+		self.pending.set()
+		self.stopped.set()
+		if self.task:
+			await self.task
+			self.task = None
+		await self.flush()
+
+	# WRITES THE PENDING CURSORS WITHOUT THE EVENT LOOP, FOR WHEN THE PROCESS EXITS WITHOUT STOP HAVING RUN
+	def save_pending(self):
+		if not self.loop or not self.cursors:
+			return
+		cursors, self.cursors = self.cursors, {}
+		self.save(cursors)
+
+
+# ONE FLUSHER PER WORKER PROCESS
+read_cursors = ReadCursorFlusher.from_settings()
@@ -0,0 +1,91 @@
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+
+# BOUNDED IN MEMORY HISTORY OF THE RECENT EVENTS OF EACH KEY, THE KEYS ARE EVICTED LEAST RECENTLY USED FIRST
+# EVERY KEY KEEPS ITS LAST SIZE EVENTS IN SEQ ORDER AND THE SEQ AFTER WHICH NONE OF ITS EVENTS WAS MISSED
+# IT IS ONLY USED FROM THE EVENT LOOP OF THE WORKER, SO THERE IS NO LOCKING
+class ReplayBuffer:
+
+	def __init__(self, size, max_keys):
+		self.size = size
+		self.max_keys = max_keys
+		self.entries = OrderedDict()
+
+	# COMPLETE_SINCE IS THE SEQ AFTER WHICH THE CALLER KNOWS NO EVENT OF THE KEY WAS MISSED
+	def record(self, key, seq, event, complete_since):
+		entry = self.entries.get(key)
+		if entry is None:
+			entry = self.entries[key] = [complete_since, deque(maxlen=self.size)]
+			while len(self.entries) > self.max_keys:
+				self.entries.popitem(last=False)
+		else:
+			self.entries.move_to_end(key)
+		events = entry[1]
+		if events:
+			# ALREADY RECORDED, E.G. BY ANOTHER SOCKET OF THE WORKER
+			if seq <= events[-1][0]:
+				return
+			# SOMETHING WAS MISSED BETWEEN THE NEWEST EVENT AND THIS ONE
+			if complete_since > events[-1][0]:
+				entry[0] = complete_since
+		# A FULL BUFFER DROPS ITS OLDEST EVENT, THE HISTORY IS ONLY COMPLETE AFTER IT
+		if len(events) == self.size:
+			entry[0] = max(entry[0], events[0][0])
+		events.append((seq, event))
+
+	# EVENTS OF A KEY AFTER SEQ, NONE IF SOME OF THEM MAY BE MISSING
+	def since(self, key, seq):
+		entry = self.entries.get(key)
+		if entry is None or entry[0] > seq:
+			return None
+		return [event for event_seq, event in entry[1] if event_seq > seq]
+
+	def forget(self, key):
+		self.entries.pop(key, None)
+
+	def clear(self):
+		self.entries.clear()
+
+
+# MESSAGES FANNED OUT OR RECEIVED BY THIS WORKER, PER CHAT, THE SEQ IS THE MESSAGE SEQ
+chat_events = ReplayBuffer(settings.CHAT_REPLAY_BUFFER_SIZE, settings.CHAT_REPLAY_MAX_CHATS)
+# FRIEND REQUEST EVENTS RECEIVED BY THE SOCKETS OF THIS WORKER, PER USER, THE SEQ IS THE PUBLISH TIME IN MICROSECONDS
+user_events = ReplayBuffer(settings.USER_REPLAY_BUFFER_SIZE, settings.USER_REPLAY_MAX_USERS)
+# USER ID -> [NUMBER OF SOCKETS OF THE USER ON THIS WORKER, SEQ AFTER WHICH NONE OF ITS EVENTS WAS MISSED]
+# EVERY DISPATCHER SENDS THE EVENTS OF A USER TO ITS GROUP, SO NONE OF THEM IS MISSED WHILE A SOCKET IS SUBSCRIBED
+watched_users = {}
+
+# THE USER EVENTS THAT ARE SENT TO THE CLIENT AND THEREFORE REPLAYED
+REPLAYED_USER_EVENTS = {"friend.request", "request.accepted"}
+
+def record_chat_event(event):
+	chat_events.record(event["chat_id"], event["seq"], event, event["seq"] - 1)
+
+# CALLED ONCE A SOCKET IS SUBSCRIBED TO THE GROUP OF ITS USER, SEQ IS THE CURRENT EVENT SEQ
+def watch_user(user_id, seq):
+	entry = watched_users.get(user_id)
+	if entry is None:
+		watched_users[user_id] = [1, seq]
+	else:
+		entry[0] += 1
+
+# ONCE THE LAST SOCKET OF THE USER IS GONE THE EVENTS OF THE USER ARE NO LONGER SEEN, SO ITS HISTORY IS DROPPED
+def unwatch_user(user_id):
+	entry = watched_users.get(user_id)
+	if entry is None:
+		return
+	entry[0] -= 1
+	if entry[0] <= 0:
+		del watched_users[user_id]
+		user_events.forget(user_id)
+
+# CALLED BY THE SOCKETS WHEN A USER EVENT ARRIVES, WHICHEVER WORKER DISPATCHED IT
+# NOTHING IS MISSED AFTER THE NEWEST RECORDED EVENT, SO A HISTORY EVICTED IN BETWEEN STARTS AGAIN COMPLETE FROM THERE
+def record_user_event(user_id, event):
+	entry = watched_users.get(user_id)
+	if entry is None or event.get("type") not in REPLAYED_USER_EVENTS or "seq" not in event:
+		return
+	user_events.record(user_id, event["seq"], event, entry[1])
+	entry[1] = max(entry[1], event["seq"])
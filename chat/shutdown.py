@@ -0,0 +1,46 @@
+import asyncio
+import atexit
+import sys
+
+from api.outbox import dispatcher
+from .persister import persister
+from .reads import read_cursors
+from .presence import presence
+
+# WORKER SHUTDOWN, THE BUFFERED MESSAGES AND READ CURSORS MUST BE SAVED AND THE PRESENCE OF THE SOCKETS CLEARED
+# UVICORN SENDS LIFESPAN.SHUTDOWN (chat/lifespan.py), DAPHNE DOES NOT, IT STOPS ITS TWISTED REACTOR ON SIGTERM
+# SO THE DRAIN ALSO RUNS AS A "BEFORE SHUTDOWN" TRIGGER OF THE REACTOR, WHICH WAITS FOR IT WHILE THE LOOP IS STILL RUNNING
+# AND AS A LAST RESORT AN ATEXIT HOOK SAVES WHATEVER IS LEFT SYNCHRONOUSLY, WITHOUT THE FAN OUT
+
+installed = False
+
+
+async def drain():
+	await persister.stop()
+	await read_cursors.stop()
+	await presence.stop()
+	await dispatcher.stop()
+
+# RUNS WHEN THE EVENT LOOP IS GONE, A FAILURE IS PRINTED SO THE OTHER BUFFERS ARE STILL SAVED
+def save_pending():
+	for buffer in (persister, read_cursors):
+		try:
+			buffer.save_pending()
+		except Exception as e:
+			print(e)
+
+def drain_before_reactor_shutdown():
+	from twisted.internet.defer import Deferred
+	return Deferred.fromFuture(asyncio.ensure_future(drain()))
+
+# CALLED FROM THE WORKER ONCE IT SERVES ITS FIRST SOCKET (OR ITS LIFESPAN STARTUP), INSTALLING TWICE DOES NOTHING
+def install():
+	global installed
+	if installed:
+		return
+	installed = True
+	atexit.register(save_pending)
+	# ONLY WHEN THE SERVER ALREADY INSTALLED A REACTOR, IMPORTING IT HERE WOULD INSTALL THE DEFAULT ONE
+	reactor = sys.modules.get("twisted.internet.reactor")
+	if reactor is not None:
+		reactor.addSystemEventTrigger("before", "shutdown", drain_before_reactor_shutdown)
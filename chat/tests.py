@@ -0,0 +1,457 @@
+from django.db import transaction
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from asgiref.sync import sync_to_async
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from users.models import CustomUser
+from api.models import Chat, ChatMember, Message, OutboxEvent, Friend, FriendsList
+from api.outbox import OutboxDispatcher, publish, event_seq
+from api.sync import encode_sync_cursor
+from api.dedup import recent_messages, find_duplicates
+from test_chat.asgi import application
+from .persister import persister, save_messages
+from .reads import read_cursors
+from . import instrumentation, shutdown
+from .outbound import OutboundQueue, QueueOverflow, DISCONNECT
+from .replay import chat_events, user_events
+from .presence import presence, merge_diffs
+
+import asyncio
+import json
+import sys
+from datetime import timedelta
+from unittest import mock
+
+IN_MEMORY_CHANNEL_LAYERS = {
+	'default': {
+		'BACKEND': 'channels.layers.InMemoryChannelLayer',
+	},
+}
+
+# Create your tests here.
+# THE OUTBOX IS DRAINED EXPLICITLY, SO THE SOCKETS DO NOT START THE DISPATCHER OF THE WORKER
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, OUTBOX_DISPATCH_IN_WORKER=False)
+class ChatConsumerTest(TransactionTestCase):
+	def setUp(self):
+		self.test_user = CustomUser(username="test_user")
+		self.test_user.set_password("12345678")
+		self.test_user.save()
+		self.test_user_token = str(RefreshToken.for_user(self.test_user).access_token)
+
+		self.friend_user = CustomUser(username="friend_user")
+		self.friend_user.set_password("12345678")
+		self.friend_user.save()
+		self.friend_user_token = str(RefreshToken.for_user(self.friend_user).access_token)
+
+		self.outsider_user = CustomUser(username="outsider_user")
+		self.outsider_user.set_password("12345678")
+		self.outsider_user.save()
+		self.outsider_user_token = str(RefreshToken.for_user(self.outsider_user).access_token)
+
+		self.chat = Chat.objects.create(group_chat=False)
+		self.chat.add_member(ChatMember(member=self.test_user))
+		self.chat.add_member(ChatMember(member=self.friend_user))
+
+	def communicator(self, token, path="/ws/chat/1/"):
+		return WebsocketCommunicator(application, path, headers=[(b"cookie", f"token={token}".encode())])
+
+	async def test_message_is_fanned_out_and_saved_in_batch(self):
+		connections = instrumentation.connections.get() + 2
+		sent = instrumentation.events_total.get(type="send_message")
+		fanned_out = instrumentation.fan_out_latency.get(mode="write_behind")["count"]
+		sender = self.communicator(self.test_user_token)
+		receiver = self.communicator(self.friend_user_token)
+		connected, _ = await sender.connect()
+		self.assertTrue(connected)
+		connected, _ = await receiver.connect()
+		self.assertTrue(connected)
+
+		await sender.send_to(text_data=json.dumps({"message": "hola", "chat_id": f"{self.chat.id}", "is_group": False}))
+		response = json.loads(await receiver.receive_from())
+		self.assertEqual(response["event"], "new_message")
+		self.assertEqual(response["content"], "hola")
+
+		# FLUSHES THE WRITE BEHIND BUFFER
+		await persister.stop()
+		self.assertEqual(await sync_to_async(Message.objects.filter(chat=self.chat).count)(), 1)
+		self.assertEqual(instrumentation.connections.get(), connections)
+		self.assertEqual(instrumentation.events_total.get(type="send_message"), sent + 2)
+		self.assertEqual(instrumentation.fan_out_latency.get(mode="write_behind")["count"], fanned_out + 1)
+		chat = await sync_to_async(Chat.objects.get)(id=self.chat.id)
+		self.assertEqual(chat.last_message_preview, "hola")
+
+		await sender.disconnect()
+		await receiver.disconnect()
+
+	async def test_message_to_unexisting_chat(self):
+		sender = self.communicator(self.test_user_token)
+		await sender.connect()
+		await sender.send_to(text_data=json.dumps({"message": "hola", "chat_id": "not-a-chat", "is_group": False}))
+		response = json.loads(await sender.receive_from())
+		self.assertEqual(response["type"], "error")
+		await sender.disconnect()
+
+	async def test_message_from_non_member_is_rejected(self):
+		outsider = self.communicator(self.outsider_user_token)
+		await outsider.connect()
+		await outsider.send_to(text_data=json.dumps({"message": "hola", "chat_id": f"{self.chat.id}", "is_group": False}))
+		response = json.loads(await outsider.receive_from())
+		self.assertEqual(response["type"], "error")
+		await persister.stop()
+		self.assertEqual(await sync_to_async(Message.objects.filter(chat=self.chat).count)(), 0)
+		await outsider.disconnect()
+
+	async def test_message_delivered_through_user_groups(self):
+		with self.settings(CHAT_DELIVERY_MODE='user_groups'):
+			sender = self.communicator(self.test_user_token)
+			receiver = self.communicator(self.friend_user_token)
+			await sender.connect()
+			await receiver.connect()
+
+			await sender.send_to(text_data=json.dumps({"message": "hola", "chat_id": f"{self.chat.id}", "is_group": False}))
+			for communicator in (sender, receiver):
+				response = json.loads(await communicator.receive_from())
+				self.assertEqual(response["event"], "new_message")
+				self.assertEqual(response["chat_id"], f"{self.chat.id}")
+
+			await persister.stop()
+			await sender.disconnect()
+			await receiver.disconnect()
+
+	async def test_outbox_events_are_sent_after_commit(self):
+		channel_layer = get_channel_layer()
+		channel = await channel_layer.new_channel()
+		await channel_layer.group_add(f"{self.friend_user.id}", channel)
+
+		def write():
+			with transaction.atomic():
+				publish([self.friend_user.id], {"type": "new.chat", "chat_id": "committed"})
+			# A ROLLED BACK CHANGE DOES NOT LEAVE ITS EVENT BEHIND
+			with transaction.atomic():
+				publish([self.friend_user.id], {"type": "new.chat", "chat_id": "rolled-back"})
+				transaction.set_rollback(True)
+		await sync_to_async(write)()
+
+		await OutboxDispatcher.from_settings().drain()
+		event = await channel_layer.receive(channel)
+		self.assertEqual(event["chat_id"], "committed")
+		self.assertEqual(await sync_to_async(OutboxEvent.objects.count)(), 0)
+
+	def test_outbox_keeps_the_order_of_each_group(self):
+		first = OutboxEvent.objects.create(groups=["a"], event={"type": "new.chat", "chat_id": "1"})
+		second = OutboxEvent.objects.create(groups=["a", "b"], event={"type": "new.chat", "chat_id": "2"})
+		third = OutboxEvent.objects.create(groups=["b"], event={"type": "new.chat", "chat_id": "3"})
+		other = OutboxEvent.objects.create(groups=["c"], event={"type": "new.chat", "chat_id": "4"})
+
+		# THE FIRST EVENT IS BEING SENT BY ANOTHER DISPATCHER (OR WAITS FOR ITS RETRY), THE NEWER EVENTS OF ITS GROUPS WAIT
+		OutboxEvent.objects.filter(id=first.id).update(locked_until=timezone.now() + timedelta(seconds=30))
+		dispatcher = OutboxDispatcher.from_settings()
+		self.assertEqual([id for id, groups, event in dispatcher.claim()], [other.id])
+
+		# ONCE ITS LOCK EXPIRES THE GROUPS ARE SENT IN ORDER
+		OutboxEvent.objects.filter(id=first.id).update(locked_until=timezone.now() - timedelta(seconds=1))
+		self.assertEqual([id for id, groups, event in dispatcher.claim()], [first.id, second.id, third.id])
+
+	async def test_user_events_dispatched_by_another_worker_are_replayed(self):
+		first = self.communicator(self.friend_user_token)
+		await first.connect()
+		seen = event_seq()
+
+		# ANY WORKER MAY DISPATCH THE EVENT, THE SOCKETS OF THIS ONE RECORD IT WHEN IT ARRIVES
+		await sync_to_async(publish)([self.friend_user.id], {"type": "request.accepted", "name": "test_user"})
+		await OutboxDispatcher.from_settings().drain()
+		self.assertEqual(json.loads(await first.receive_from())["event"], "friend_request_accepted")
+
+		second = self.communicator(self.friend_user_token, f"/ws/chat/1/?user_seq={seen}")
+		await second.connect()
+		replayed = json.loads(await second.receive_from())
+		self.assertEqual((replayed["event"], replayed["name"]), ("friend_request_accepted", "test_user"))
+		await first.disconnect()
+		await second.disconnect()
+
+		# WITHOUT A SOCKET OF THE USER THE WORKER DOES NOT KNOW WHAT IT MISSED, THE DATABASE IS READ INSTEAD
+		self.assertIsNone(user_events.since(f"{self.friend_user.id}", seen))
+		third = self.communicator(self.friend_user_token, f"/ws/chat/1/?user_seq={seen}")
+		await third.connect()
+		self.assertTrue(await third.receive_nothing())
+		await third.disconnect()
+
+	async def test_missed_messages_are_replayed_on_reconnect(self):
+		sender = self.communicator(self.test_user_token)
+		await sender.connect()
+		for content in ("uno", "dos", "tres"):
+			await sender.send_to(text_data=json.dumps({"message": content, "chat_id": f"{self.chat.id}", "is_group": False}))
+			# THE SENDER IS A MEMBER TOO, ITS COPY MEANS THE MESSAGE IS SAVED
+			await sender.receive_from()
+
+		# THE GAP AFTER SEQ 1 IS IN THE BUFFER OF THE WORKER
+		path = f"/ws/chat/1/?cursor={encode_sync_cursor({f'{self.chat.id}': 1}, None)}"
+		receiver = self.communicator(self.friend_user_token, path)
+		await receiver.connect()
+		replayed = [json.loads(await receiver.receive_from()) for _ in range(2)]
+		self.assertEqual([(event["seq"], event["content"]) for event in replayed], [(2, "dos"), (3, "tres")])
+		await receiver.disconnect()
+
+		# ONCE THE BUFFER IS GONE THE GAP IS READ FROM THE DATABASE
+		chat_events.clear()
+		receiver = self.communicator(self.friend_user_token, path)
+		await receiver.connect()
+		replayed = [json.loads(await receiver.receive_from()) for _ in range(2)]
+		self.assertEqual([(event["seq"], event["content"]) for event in replayed], [(2, "dos"), (3, "tres")])
+		self.assertTrue(await receiver.receive_nothing())
+
+		await persister.stop()
+		await receiver.disconnect()
+		await sender.disconnect()
+
+	async def test_read_cursor_updates_unread_count(self):
+		sender = self.communicator(self.test_user_token)
+		reader = self.communicator(self.friend_user_token)
+		await sender.connect()
+		await reader.connect()
+		for content in ("uno", "dos", "tres"):
+			await sender.send_to(text_data=json.dumps({"message": content, "chat_id": f"{self.chat.id}", "is_group": False}))
+			await reader.receive_from()
+		await persister.stop()
+
+		unread = sync_to_async(lambda user: ChatMember.objects.get(chat=self.chat, member=user).unread_count)
+		self.assertEqual(await unread(self.friend_user), 3)
+		self.assertEqual(await unread(self.test_user), 0)
+
+		# ONLY THE HIGHEST CURSOR IS WRITTEN, AN OLDER ONE DOES NOT MOVE IT BACK
+		for seq in (1, 2, 1):
+			await reader.send_to(text_data=json.dumps({"type": "read", "chat_id": f"{self.chat.id}", "seq": seq}))
+		self.assertTrue(await reader.receive_nothing())
+		await read_cursors.stop()
+		self.assertEqual(await unread(self.friend_user), 1)
+
+		await reader.disconnect()
+		await sender.disconnect()
+
+	async def test_batch_frame_is_saved_fanned_out_and_acked_once(self):
+		other_chat = await sync_to_async(Chat.objects.create)(group_chat=False)
+		sender = self.communicator(self.test_user_token)
+		receiver = self.communicator(self.friend_user_token)
+		await sender.connect()
+		await receiver.connect()
+		errors = instrumentation.errors_total.get(type="batch")
+
+		# A REJECTED MESSAGE IS ONLY COUNTED, NOTHING IS PRINTED FOR IT
+		with mock.patch("builtins.print") as printed:
+			await sender.send_to(text_data=json.dumps({"type": "batch", "messages": [
+				{"client_id": "a", "chat_id": f"{self.chat.id}", "message": "uno", "is_group": False},
+				{"client_id": "b", "chat_id": f"{other_chat.id}", "message": "dos", "is_group": False},
+				{"client_id": "c", "chat_id": f"{self.chat.id}", "message": "tres", "is_group": False},
+			]}))
+			received = [json.loads(await receiver.receive_from()) for _ in range(2)]
+			# THE SENDER GETS ITS OWN COPIES AND THE ACK, IN ANY ORDER
+			frames = [json.loads(await sender.receive_from()) for _ in range(3)]
+		printed.assert_not_called()
+		self.assertEqual(instrumentation.errors_total.get(type="batch"), errors + 1)
+		self.assertEqual([(event["seq"], event["content"]) for event in received], [(1, "uno"), (2, "tres")])
+
+		ack = [frame for frame in frames if frame.get("type") == "ack"][0]
+		self.assertEqual([(message["client_id"], message["seq"]) for message in ack["messages"]], [("a", 1), ("c", 2)])
+		self.assertEqual([error["client_id"] for error in ack["errors"]], ["b"])
+		saved = await sync_to_async(lambda: {f"{id}" for id in Message.objects.filter(chat=self.chat).values_list('id', flat=True)})()
+		self.assertEqual({message["id"] for message in ack["messages"]}, saved)
+
+		await persister.stop()
+		await sender.disconnect()
+		await receiver.disconnect()
+
+	async def test_message_retry_is_acked_with_the_original(self):
+		sender = self.communicator(self.test_user_token)
+		receiver = self.communicator(self.friend_user_token)
+		await sender.connect()
+		await receiver.connect()
+		frame = json.dumps({"client_id": "retry-1", "message": "hola", "chat_id": f"{self.chat.id}", "is_group": False})
+
+		await sender.send_to(text_data=frame)
+		frames = [json.loads(await sender.receive_from()) for _ in range(2)]
+		original = [frame for frame in frames if frame.get("type") == "ack"][0]["messages"][0]
+		await receiver.receive_from()
+
+		# THE RETRY IS ONLY ACKED, ONCE FROM MEMORY AND ONCE WHEN THE FLUSH FINDS IT IN THE DATABASE
+		for clear in (False, True):
+			if clear:
+				recent_messages.clear()
+			await sender.send_to(text_data=frame)
+			ack = json.loads(await sender.receive_from())
+			self.assertEqual((ack["type"], ack["messages"]), ("ack", [original]))
+		self.assertTrue(await receiver.receive_nothing())
+
+		await persister.stop()
+		self.assertEqual(await sync_to_async(Message.objects.filter(chat=self.chat).count)(), 1)
+		await sender.disconnect()
+		await receiver.disconnect()
+
+	def test_duplicate_saved_by_another_worker_does_not_fail_the_batch(self):
+		original = Message.objects.create(chat=self.chat, author=self.test_user, content="hola", seq=Chat.allocate_seq(self.chat.id), client_id="retry-1")
+		retry = Message(chat=self.chat, author=self.test_user, content="hola", client_id="retry-1")
+		other = Message(chat=self.chat, author=self.friend_user, content="otro")
+		# THE FIRST CHECK RAN BEFORE THE OTHER WORKER COMMITTED THE ORIGINAL, THE INSERT HITS THE CONSTRAINT
+		with mock.patch("chat.persister.find_duplicates", side_effect=[{}, find_duplicates([retry, other])]):
+			duplicates = save_messages([retry, other])
+		self.assertEqual({id: message.id for id, message in duplicates.items()}, {retry.id: original.id})
+		self.assertEqual(list(Message.objects.filter(chat=self.chat).order_by('seq').values_list('id', 'seq')), [(original.id, 1), (other.id, 2)])
+		self.assertEqual(Chat.objects.get(id=self.chat.id).last_seq, 2)
+
+	async def test_presence_diffs_reach_online_friends_once_per_interval(self):
+		def befriend():
+			for owner, friend in ((self.test_user, self.friend_user), (self.friend_user, self.test_user)):
+				friends_list, created = FriendsList.objects.get_or_create(owner=owner)
+				Friend.objects.create(friends_list=friends_list, friend=friend)
+		await sync_to_async(befriend)()
+
+		friend = self.communicator(self.friend_user_token)
+		await friend.connect()
+		await presence.flush()
+		phone = self.communicator(self.test_user_token)
+		laptop = self.communicator(self.test_user_token)
+		await phone.connect()
+		await laptop.connect()
+		for device in (phone, laptop):
+			self.assertEqual(json.loads(await device.receive_from()), {"event": "presence", "online": ["friend_user"], "offline": []})
+
+		# TWO DEVICES COMING ONLINE ARE ONE CHANGE, AND ONE DEVICE LEAVING IS NONE
+		await laptop.disconnect()
+		await presence.flush()
+		self.assertEqual(json.loads(await friend.receive_from()), {"event": "presence", "online": ["test_user"], "offline": []})
+		self.assertTrue(await friend.receive_nothing())
+
+		await phone.disconnect()
+		await presence.flush()
+		self.assertEqual(json.loads(await friend.receive_from()), {"event": "presence", "online": [], "offline": ["test_user"]})
+
+		await presence.stop()
+		await friend.disconnect()
+
+	# SENDS A MESSAGE THAT STAYS IN THE WRITE BEHIND BUFFER
+	async def buffer_message(self, sender, content):
+		await sender.send_to(text_data=json.dumps({"message": content, "chat_id": f"{self.chat.id}", "is_group": False}))
+		while not len(persister):
+			await asyncio.sleep(0.01)
+
+	async def test_reactor_shutdown_drains_the_buffers(self):
+		triggers = []
+		class Reactor:
+			def addSystemEventTrigger(self, phase, event, trigger):
+				triggers.append((phase, event, trigger))
+		with mock.patch.dict(sys.modules, {"twisted.internet.reactor": Reactor()}), mock.patch.object(shutdown, "installed", False), \
+			 mock.patch("atexit.register"):
+			shutdown.install()
+		self.assertEqual([(phase, event) for phase, event, trigger in triggers], [("before", "shutdown")])
+
+		sender = self.communicator(self.test_user_token)
+		await sender.connect()
+		with mock.patch.object(persister, "flush_interval", 60):
+			await self.buffer_message(sender, "hola")
+			# THE REACTOR WAITS FOR THE DEFERRED BEFORE IT STOPS THE LOOP
+			await triggers[0][2]().asFuture(asyncio.get_event_loop())
+		self.assertEqual(await sync_to_async(Message.objects.filter(chat=self.chat).count)(), 1)
+		await sender.disconnect()
+
+	async def test_exit_hook_saves_the_buffers_without_the_loop(self):
+		sender = self.communicator(self.test_user_token)
+		await sender.connect()
+		with mock.patch.object(persister, "flush_interval", 60), mock.patch.object(read_cursors, "flush_interval", 60):
+			await self.buffer_message(sender, "uno")
+			read_cursors.mark_read(self.friend_user.id, self.chat.id, 1)
+			await sync_to_async(shutdown.save_pending)()
+			self.assertEqual(len(persister), 0)
+
+		member = await sync_to_async(ChatMember.objects.get)(chat=self.chat, member=self.friend_user)
+		self.assertEqual((member.last_read_seq, member.unread_count), (1, 0))
+		await persister.stop()
+		await read_cursors.stop()
+		await sender.disconnect()
+
+
+# A CLIENT THAT ONLY READS WHEN THE TEST LETS IT
+class SlowClient:
+
+	def __init__(self):
+		self.written = []
+		self.gate = asyncio.Event()
+
+	async def write(self, event):
+		await self.gate.wait()
+		self.written.append(event)
+
+	async def drain(self, queue):
+		self.gate.set()
+		while len(queue) or queue.ready.is_set():
+			await asyncio.sleep(0)
+
+
+class OutboundQueueTest(SimpleTestCase):
+	async def test_coalesced_events_keep_their_place(self):
+		client = SlowClient()
+		queue = OutboundQueue(client.write, max_size=4)
+		# THE WRITER TAKES THE FIRST EVENT AND WAITS ON THE CLIENT WITH IT
+		queue.put({"n": 0})
+		await asyncio.sleep(0)
+		queue.put({"presence": "online"}, coalesce="presence")
+		queue.put({"n": 1})
+		queue.put({"presence": "away"}, coalesce="presence")
+		await client.drain(queue)
+		self.assertEqual(client.written, [{"n": 0}, {"presence": "away"}, {"n": 1}])
+		queue.stop()
+
+	async def test_presence_diffs_waiting_for_a_slow_client_are_merged(self):
+		client = SlowClient()
+		queue = OutboundQueue(client.write, max_size=4)
+		queue.put({"n": 0})
+		await asyncio.sleep(0)
+		for online, offline in ((["ana", "bob"], []), ([], ["bob"]), (["cid"], ["ana"])):
+			queue.put({"event": "presence", "online": online, "offline": offline}, "presence", merge_diffs)
+		await client.drain(queue)
+		self.assertEqual(client.written, [{"n": 0}, {"event": "presence", "online": ["cid"], "offline": ["ana", "bob"]}])
+		queue.stop()
+
+	async def test_slow_client_drops_oldest_and_resyncs(self):
+		client = SlowClient()
+		queue = OutboundQueue(client.write, max_size=4)
+		queue.put({"n": 0})
+		await asyncio.sleep(0)
+		for n in range(1, 7):
+			queue.put({"n": n})
+		self.assertEqual(len(queue), 4)
+		await client.drain(queue)
+		self.assertEqual(client.written, [{"n": 0}, {"n": 4}, {"event": "resync"}, {"n": 5}, {"n": 6}])
+		queue.stop()
+
+	async def test_disconnect_policy_sends_the_resume_hint_last(self):
+		client = SlowClient()
+		closed = asyncio.Event()
+		async def on_closed():
+			closed.set()
+
+		queue = OutboundQueue(client.write, max_size=2, policy=DISCONNECT)
+		queue.put({"n": 0})
+		await asyncio.sleep(0)
+		queue.put({"n": 1})
+		queue.put({"n": 2})
+		with self.assertRaises(QueueOverflow):
+			queue.put({"n": 3})
+		queue.close({"event": "resume"}, on_closed)
+		queue.put({"n": 4})
+
+		await client.drain(queue)
+		await asyncio.wait_for(closed.wait(), 1)
+		self.assertEqual(client.written, [{"n": 0}, {"event": "resume"}])
+
+	async def test_stopped_queue_drops_late_events(self):
+		queued = instrumentation.outbound_queued.get()
+		queue = OutboundQueue(SlowClient().write, max_size=10)
+		queue.put({"n": 0})
+		queue.stop()
+		self.assertEqual(instrumentation.outbound_queued.get(), queued)
+		# A GROUP EVENT OR A PERSISTER CALLBACK ARRIVING AFTER THE DISCONNECT
+		queue.put({"n": 1})
+		self.assertEqual(len(queue), 0)
+		self.assertEqual(instrumentation.outbound_queued.get(), queued)
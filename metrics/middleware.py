@@ -0,0 +1,75 @@
+import heapq
+import logging
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+from .registry import registry
+
+logger = logging.getLogger(__name__)
+
+requests_total = registry.counter("http_requests_total", "HTTP requests by URL name, method and status", ("view", "method", "status"))
+request_duration = registry.histogram("http_request_duration_seconds", "HTTP request latency by URL name", ("view",))
+db_queries = registry.histogram(
+	"http_request_db_queries", "SQL queries per HTTP request by URL name", ("view",),
+	buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55, 89),
+)
+db_time_total = registry.counter("http_request_db_seconds_total", "Time spent in SQL queries by URL name", ("view",))
+
+
+# TIMES EVERY QUERY OF THE REQUEST AND KEEPS THE SLOWEST ONES FOR THE SLOW REQUEST LOG
+class QueryTimer:
+
+	def __init__(self, keep):
+		self.keep = keep
+		self.count = 0
+		self.time = 0.0
+		self.slowest = []
+
+	def __call__(self, execute, sql, params, many, context):
+		start = time.perf_counter()
+		try:
+			return execute(sql, params, many, context)
+		finally:
+			duration = time.perf_counter() - start
+			self.count += 1
+			self.time += duration
+			if len(self.slowest) < self.keep:
+				heapq.heappush(self.slowest, (duration, self.count, sql))
+			elif self.keep and duration > self.slowest[0][0]:
+				heapq.heapreplace(self.slowest, (duration, self.count, sql))
+
+
+# RECORDS THE COUNT, LATENCY, SQL QUERIES AND SQL TIME OF EVERY REQUEST UNDER THE NAME OF ITS URL
+# REQUESTS SLOWER THAN METRICS_SLOW_REQUEST SECONDS ARE LOGGED WITH THEIR SLOWEST QUERIES
+# WITH METRICS_ENABLED OFF DJANGO DROPS THE MIDDLEWARE FROM THE CHAIN, SO IT COSTS NOTHING
+class MetricsMiddleware:
+
+	def __init__(self, get_response):
+		if not settings.METRICS_ENABLED:
+			raise MiddlewareNotUsed()
+		self.get_response = get_response
+
+	def __call__(self, request):
+		timer = QueryTimer(settings.METRICS_SLOW_QUERIES)
+		start = time.perf_counter()
+		with connection.execute_wrapper(timer):
+			response = self.get_response(request)
+		duration = time.perf_counter() - start
+
+		match = getattr(request, "resolver_match", None)
+		view = (match.url_name or match.view_name) if match else "unresolved"
+		requests_total.inc(view=view, method=request.method, status=response.status_code)
+		request_duration.observe(duration, view=view)
+		db_queries.observe(timer.count, view=view)
+		db_time_total.inc(timer.time, view=view)
+
+		if duration >= settings.METRICS_SLOW_REQUEST:
+			queries = "\n".join(f"  {query_time * 1000:.1f}ms {sql}" for query_time, i, sql in sorted(timer.slowest, reverse=True))
+			logger.warning(
+				"Slow request %s %s (%s) %.1fms, %s queries in %.1fms\n%s",
+				request.method, request.path, view, duration * 1000, timer.count, timer.time * 1000, queries,
+			)
+		return response
@@ -0,0 +1,163 @@
+import math
+import threading
+
+# IN PROCESS METRICS REGISTRY WITH COUNTERS, GAUGES AND HISTOGRAMS, RENDERED IN THE PROMETHEUS TEXT FORMAT
+# EVERY WORKER PROCESS HAS ITS OWN REGISTRY, SO EACH WORKER IS SCRAPED (OR ITS METRICS SUMMED) ON ITS OWN
+# UPDATES NEVER DO I/O, SO THEY ARE SAFE TO CALL FROM THE VIEWS AND FROM THE CONSUMER
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def escape(value):
+	return f"{value}".replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(names, values, extra=()):
+	pairs = list(zip(names, values)) + list(extra)
+	if not pairs:
+		return ""
+	return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+def format_value(value):
+	if value == math.inf:
+		return "+Inf"
+	return repr(float(value)) if isinstance(value, float) else f"{value}"
+
+
+class Metric:
+	kind = None
+
+	def __init__(self, name, help, labels=()):
+		self.name = name
+		self.help = help
+		self.labels = tuple(labels)
+		self.values = {}
+		self.lock = threading.Lock()
+
+	def key(self, labels):
+		if set(labels) != set(self.labels):
+			raise ValueError(f"{self.name} takes the labels {self.labels}")
+		return tuple(f"{labels[name]}" for name in self.labels)
+
+	def samples(self):
+		with self.lock:
+			return [(self.name, format_labels(self.labels, key), value) for key, value in sorted(self.values.items())]
+
+	def render(self):
+		lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+		lines.extend(f"{name}{labels} {format_value(value)}" for name, labels, value in self.samples())
+		return "\n".join(lines)
+
+	def clear(self):
+		with self.lock:
+			self.values.clear()
+
+
+class Counter(Metric):
+	kind = "counter"
+
+	def inc(self, value=1, **labels):
+		key = self.key(labels)
+		with self.lock:
+			self.values[key] = self.values.get(key, 0) + value
+
+	def get(self, **labels):
+		return self.values.get(self.key(labels), 0)
+
+
+class Gauge(Metric):
+	kind = "gauge"
+
+	def set(self, value, **labels):
+		key = self.key(labels)
+		with self.lock:
+			self.values[key] = value
+
+	def inc(self, value=1, **labels):
+		key = self.key(labels)
+		with self.lock:
+			self.values[key] = self.values.get(key, 0) + value
+
+	def dec(self, value=1, **labels):
+		self.inc(-value, **labels)
+
+	def get(self, **labels):
+		return self.values.get(self.key(labels), 0)
+
+
+# EACH LABEL SET KEEPS [BUCKET COUNTS, SUM, COUNT], THE BUCKET COUNTS ARE CUMULATIVE WHEN RENDERED
+class Histogram(Metric):
+	kind = "histogram"
+
+	def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+		super().__init__(name, help, labels)
+		self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+	def observe(self, value, **labels):
+		key = self.key(labels)
+		with self.lock:
+			entry = self.values.get(key)
+			if entry is None:
+				entry = self.values[key] = [[0] * len(self.buckets), 0, 0]
+			for i, bound in enumerate(self.buckets):
+				if value <= bound:
+					entry[0][i] += 1
+					break
+			entry[1] += value
+			entry[2] += 1
+
+	def get(self, **labels):
+		entry = self.values.get(self.key(labels))
+		return {"sum": entry[1], "count": entry[2]} if entry else {"sum": 0, "count": 0}
+
+	def samples(self):
+		samples = []
+		with self.lock:
+			for key, (counts, total, count) in sorted(self.values.items()):
+				cumulative = 0
+				for bound, bucket_count in zip(self.buckets, counts):
+					cumulative += bucket_count
+					samples.append((f"{self.name}_bucket", format_labels(self.labels, key, [("le", format_value(bound))]), cumulative))
+				samples.append((f"{self.name}_sum", format_labels(self.labels, key), total))
+				samples.append((f"{self.name}_count", format_labels(self.labels, key), count))
+		return samples
+
+
+# METRICS ARE CREATED ON FIRST USE, ASKING AGAIN FOR THE SAME NAME RETURNS THE SAME METRIC
+class Registry:
+
+	def __init__(self):
+		self.metrics = {}
+		self.lock = threading.Lock()
+
+	def get_or_create(self, cls, name, help, labels=(), **kwargs):
+		with self.lock:
+			metric = self.metrics.get(name)
+			if metric is None:
+				metric = self.metrics[name] = cls(name, help, labels, **kwargs)
+			elif not isinstance(metric, cls) or metric.labels != tuple(labels):
+				raise ValueError(f"{name} is already registered as a different metric")
+			return metric
+
+	def counter(self, name, help, labels=()):
+		return self.get_or_create(Counter, name, help, labels)
+
+	def gauge(self, name, help, labels=()):
+		return self.get_or_create(Gauge, name, help, labels)
+
+	def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+		return self.get_or_create(Histogram, name, help, labels, buckets=buckets)
+
+	def render(self):
+		with self.lock:
+			metrics = list(self.metrics.values())
+		return "\n".join(metric.render() for metric in sorted(metrics, key=lambda metric: metric.name)) + "\n"
+
+	def clear(self):
+		with self.lock:
+			metrics = list(self.metrics.values())
+		for metric in metrics:
+			metric.clear()
+
+
+# ONE REGISTRY PER WORKER PROCESS
+registry = Registry()
@@ -0,0 +1,57 @@
+from django.core.exceptions import MiddlewareNotUsed
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from users.models import CustomUser
+from .middleware import MetricsMiddleware, requests_total, db_queries
+from .registry import Registry
+
+# Create your tests here.
+class RegistryTest(TestCase):
+	def test_prometheus_text(self):
+		registry = Registry()
+		registry.counter("events_total", "Events", ("type",)).inc(type='new "message"')
+		registry.gauge("connections", "Open sockets").set(3)
+		histogram = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1))
+		histogram.observe(0.05)
+		histogram.observe(0.5)
+
+		text = registry.render()
+		self.assertIn('events_total{type="new \\"message\\""} 1', text)
+		self.assertIn("# TYPE connections gauge\nconnections 3", text)
+		self.assertIn('latency_seconds_bucket{le="0.1"} 1', text)
+		self.assertIn('latency_seconds_bucket{le="+Inf"} 2', text)
+		self.assertIn("latency_seconds_count 2", text)
+		with self.assertRaises(ValueError):
+			registry.gauge("events_total", "Events", ("type",))
+
+
+class MetricsMiddlewareTest(TestCase):
+	@override_settings(METRICS_TOKEN="", ENVIRONMENT="development")
+	def test_requests_are_recorded_per_url_name(self):
+		user = CustomUser.objects.create(username="test_user")
+		token = str(RefreshToken.for_user(user).access_token)
+		requests = requests_total.get(view="friend_request_list", method="GET", status=200)
+		queries = db_queries.get(view="friend_request_list")
+
+		self.client.get(reverse("friend_request_list"), HTTP_AUTHORIZATION = f"JWT {token}", secure=True)
+		self.assertEqual(requests_total.get(view="friend_request_list", method="GET", status=200), requests + 1)
+		self.assertGreater(db_queries.get(view="friend_request_list")["sum"], queries["sum"])
+
+		response = self.client.get(reverse("metrics"), secure=True)
+		self.assertContains(response, 'http_requests_total{view="friend_request_list",method="GET",status="200"}')
+
+	@override_settings(METRICS_ENABLED=False)
+	def test_disabled_middleware_is_not_used(self):
+		with self.assertRaises(MiddlewareNotUsed):
+			MetricsMiddleware(lambda request: None)
+
+	@override_settings(METRICS_TOKEN="", ENVIRONMENT="production")
+	def test_endpoint_is_disabled_in_production_without_token(self):
+		self.assertEqual(self.client.get(reverse("metrics"), secure=True).status_code, 404)
+
+	@override_settings(METRICS_TOKEN="secret")
+	def test_endpoint_token(self):
+		self.assertEqual(self.client.get(reverse("metrics"), secure=True).status_code, 403)
+		self.assertEqual(self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer secret", secure=True).status_code, 200)
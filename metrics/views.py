@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+
+from .registry import registry
+
+# Create your views here.
+
+# PROMETHEUS SCRAPE ENDPOINT, WITH METRICS_TOKEN SET THE SCRAPER SENDS IT AS "Authorization: Bearer <token>"
+# IN PRODUCTION THE ENDPOINT DOES NOT EXIST UNTIL A TOKEN IS SET, IT EXPOSES PATHS, CONNECTION COUNTS AND DATABASE TIMINGS
+def metrics_view(request):
+	if not settings.METRICS_TOKEN and settings.ENVIRONMENT == 'production':
+		raise Http404("Metrics are disabled without METRICS_TOKEN")
+	if settings.METRICS_TOKEN:
+		authorization = request.headers.get("Authorization", "")
+		if not constant_time_compare(authorization, f"Bearer {settings.METRICS_TOKEN}"):
+			return HttpResponseForbidden()
+	return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -15,6 +15,7 @@ from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 import chat.routing
+from chat.lifespan import lifespan
 
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_chat.settings')
@@ -26,4 +27,5 @@ application = ProtocolTypeRouter({
 			chat.routing.websocket_urlpatterns,
 		)
 	),
+	'lifespan': lifespan,
 })
@@ -0,0 +1,45 @@
+"""
+Settings for the offline benchmarks.
+
+Same as the project settings but with SQLite, the in-memory channel layer and in-process caches, so
+`python manage.py bench_chat --settings=test_chat.bench_settings` runs without Postgres or Redis.
+"""
+
+from .settings import *
+
+if not SECRET_KEY:
+	SECRET_KEY = 'offline-benchmark-secret-key'
+	SIMPLE_JWT = dict(SIMPLE_JWT, SIGNING_KEY=SECRET_KEY)
+
+DATABASES = {
+	'default': {
+		'ENGINE': 'django.db.backends.sqlite3',
+		'NAME': BASE_DIR / 'bench.sqlite3',
+	}
+}
+
+CHANNEL_LAYERS = {
+	'default': {
+		'BACKEND': 'channels.layers.InMemoryChannelLayer',
+		'CONFIG': {
+			'capacity': 100000,
+		},
+	},
+}
+
+# ONE PROCESS, NOTHING TO SHARE
+CACHES = {
+	'default': {
+		'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+	},
+	'membership': {
+		'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+		'LOCATION': 'membership',
+	},
+	'roster': {
+		'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+		'LOCATION': 'roster',
+	},
+}
+
+PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
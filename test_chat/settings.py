@@ -51,6 +51,23 @@ REST_FRAMEWORK = {
     ],
 }
 
+# MESSAGE HISTORY PAGINATION, DEFAULT AND MAXIMUM NUMBER OF MESSAGES PER PAGE
+MESSAGE_PAGE_SIZE = 50
+MESSAGE_MAX_PAGE_SIZE = 200
+
+# DELTA SYNC, MAXIMUM MESSAGES (AND FRIEND REQUESTS) PER RESPONSE AND CHATS CAUGHT UP PER RESPONSE
+SYNC_PAGE_SIZE = 200
+SYNC_MAX_PAGE_SIZE = 1000
+SYNC_MAX_CHATS = 100
+
+# MESSAGE SEARCH, DEFAULT AND MAXIMUM NUMBER OF RESULTS PER PAGE AND MAXIMUM NUMBER OF TERMS PER QUERY
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+SEARCH_MAX_TERMS = 8
+
+# USERNAME TYPEAHEAD, MAXIMUM NUMBER OF USERS RETURNED PER PREFIX
+USER_SEARCH_LIMIT = 10
+
 # JWT CONFIGURATION
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=50),
@@ -87,9 +104,11 @@ INSTALLED_APPS = [
 	'users.apps.UsersConfig',
 	'api.apps.ApiConfig',
 	'chat.apps.ChatConfig',
+	'metrics.apps.MetricsConfig',
 ]
 
 MIDDLEWARE = [
+	'metrics.middleware.MetricsMiddleware',
 	'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -205,5 +224,112 @@ CHANNEL_LAYERS = {
 
 CHANNELS_WS_PROTOCOLS = ["access_token"]
 
+# WEBSOCKET MESSAGE PERSISTENCE, WITH WRITE BEHIND MESSAGES ARE FANNED OUT FIRST AND SAVED IN BATCHES
+CHAT_WRITE_BEHIND = True
+CHAT_PERSIST_BATCH_SIZE = 500
+CHAT_PERSIST_FLUSH_INTERVAL = 0.05
+CHAT_PERSIST_MAX_QUEUE = 20000
+CHAT_NAME_CACHE_SIZE = 10000
+# MOST MESSAGES A {"type": "batch"} FRAME CAN CARRY
+CHAT_BATCH_MAX_MESSAGES = 500
+
+# IDEMPOTENT MESSAGES, THE MESSAGES SENT WITH A CLIENT_ID ARE KEPT IN MEMORY FOR MESSAGE_DEDUP_TTL SECONDS
+# SO A RETRY IS ANSWERED WITH THE ORIGINAL MESSAGE WITHOUT A QUERY, SEE api/dedup.py
+MESSAGE_DEDUP_TTL = 120
+MESSAGE_DEDUP_SIZE = 100000
+
+# PRESENCE, SEE chat/presence.py
+# EVERY PRESENCE_INTERVAL SECONDS A WORKER REFRESHES ITS SOCKETS AND SENDS THE PRESENCE CHANGES TO THE ONLINE FRIENDS
+# A SOCKET THAT IS NOT REFRESHED FOR PRESENCE_TTL SECONDS (ITS WORKER DIED) IS OFFLINE
+# PRESENCE_REDIS_URL SHARES THE STORE BETWEEN WORKERS, WITHOUT IT EACH WORKER ONLY KNOWS ITS OWN SOCKETS
+PRESENCE_INTERVAL = 5.0
+PRESENCE_TTL = 30
+PRESENCE_REDIS_URL = os.environ.get('PRESENCE_REDIS_URL', default='')
+
+# PER SOCKET SEND QUEUE, SEE chat/outbound.py
+# WHEN A CLIENT FALLS CHAT_OUTBOUND_QUEUE_SIZE EVENTS BEHIND
+# 'drop_oldest' DROPS THE OLDEST EVENTS AND TELLS IT TO RESYNC, 'disconnect' CLOSES THE SOCKET WITH A RESUME CURSOR
+CHAT_OUTBOUND_QUEUE_SIZE = 1000
+CHAT_OUTBOUND_POLICY = 'drop_oldest'
+
+# REAL TIME DELIVERY MODE
+# 'chat_groups' SUBSCRIBES EVERY SOCKET TO THE GROUP OF EACH OF ITS CHATS
+# 'user_groups' ONLY SUBSCRIBES TO THE USER GROUP AND MESSAGES ARE SENT TO THE GROUP OF EACH MEMBER
+CHAT_DELIVERY_MODE = os.environ.get('CHAT_DELIVERY_MODE', default='chat_groups')
+
+# MISSED EVENT REPLAY ON RECONNECT, SEE chat/replay.py
+# RECENT MESSAGES ARE KEPT PER CHAT AND FRIEND REQUEST EVENTS PER USER, OLDER GAPS ARE READ FROM THE DATABASE
+# A GAP OF MORE THAN CHAT_REPLAY_MAX_MESSAGES TELLS THE CLIENT TO CALL THE SYNC ENDPOINT INSTEAD
+CHAT_REPLAY_BUFFER_SIZE = 100
+CHAT_REPLAY_MAX_CHATS = 10000
+CHAT_REPLAY_MAX_MESSAGES = 500
+USER_REPLAY_BUFFER_SIZE = 50
+USER_REPLAY_MAX_USERS = 10000
+
+# READ CURSORS SENT OVER THE WEBSOCKET, SEE chat/reads.py
+# ONLY THE HIGHEST SEQ PER (USER, CHAT) IS KEPT AND WRITTEN ONCE PER FLUSH INTERVAL
+CHAT_READ_FLUSH_INTERVAL = 2.0
+
+# MEMBERSHIP CACHE (USER -> CHATS AND CHAT -> MEMBERS) USED BY ISCHATMEMBER AND THE CONSUMER
+# AN IN PROCESS LRU TIER IN FRONT OF THE 'membership' CACHE, WHICH LIVES IN REDIS SO AN INVALIDATION REACHES EVERY WORKER
+# THE IN PROCESS TIER OF THE OTHER WORKERS KEEPS AN OLD MEMBERSHIP FOR AT MOST CHAT_MEMBERSHIP_LOCAL_TTL SECONDS
+CHAT_MEMBERSHIP_CACHE = 'membership'
+CHAT_MEMBERSHIP_TTL = 300
+CHAT_MEMBERSHIP_LOCAL_SIZE = 10000
+CHAT_MEMBERSHIP_LOCAL_TTL = 10
+
+# OUTBOX OF REAL TIME EVENTS, SEE api/outbox.py
+# WITH OUTBOX_DISPATCH_IN_WORKER EVERY ASGI WORKER DISPATCHES, OTHERWISE RUN `manage.py dispatch_outbox`
+OUTBOX_DISPATCH_IN_WORKER = True
+OUTBOX_BATCH_SIZE = 500
+OUTBOX_POLL_INTERVAL = 1.0
+OUTBOX_LOCK_TIMEOUT = 30
+
+# FRIEND ROSTERS ARE CACHED UNDER A PER USER VERSION IN THE CACHE NAMED BY FRIEND_ROSTER_CACHE, SEE api/roster.py
+# THE VERSION IS BUMPED BY THE WORKER THAT CHANGES THE ROSTER, SO THAT CACHE IS SHARED (REDIS)
+# A PER PROCESS CACHE WOULD KEEP ANSWERING 304 FOR ROSTERS CHANGED ON ANOTHER WORKER
+FRIEND_ROSTER_CACHE = 'roster'
+FRIEND_ROSTER_TTL = 60 * 60
+
+# CACHES SHARED BY EVERY WORKER, IN THE REDIS OF THE CHANNEL LAYER (ANOTHER DATABASE)
+CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL', default='redis://redis:6379/1')
+
+CACHES = {
+	'default': {
+		'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+	},
+	# MEMBERSHIP IS AN AUTHORIZATION CHECK, IT MUST NEVER BE A PER PROCESS CACHE
+	'membership': {
+		'BACKEND': 'django_redis.cache.RedisCache',
+		'LOCATION': CACHE_REDIS_URL,
+	},
+	# SEE FRIEND_ROSTER_CACHE
+	'roster': {
+		'BACKEND': 'django_redis.cache.RedisCache',
+		'LOCATION': CACHE_REDIS_URL,
+	},
+}
+
 MEDIA_ROOT =  os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
+
+# REQUEST METRICS, SEE metrics/middleware.py, SCRAPED FROM /metrics/ WITH METRICS_TOKEN (REQUIRED IN PRODUCTION)
+# REQUESTS SLOWER THAN METRICS_SLOW_REQUEST SECONDS ARE LOGGED WITH THEIR METRICS_SLOW_QUERIES SLOWEST QUERIES
+METRICS_ENABLED = int(os.environ.get('METRICS_ENABLED', default=1))
+METRICS_SLOW_REQUEST = 0.5
+METRICS_SLOW_QUERIES = 5
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', default='')
+
+# MEDIA SERVING, SEE users/views.py
+# FILES ARE STREAMED IN MEDIA_CHUNK_SIZE CHUNKS, CONTENT ADDRESSED FILES ARE CACHED FOREVER AND THE REST FOR MEDIA_CACHE_MAX_AGE SECONDS
+# SET MEDIA_ACCEL_REDIRECT TO THE INTERNAL LOCATION OF THE FRONT PROXY (E.G. '/protected-media/') TO LET IT SEND THE FILES
+MEDIA_CHUNK_SIZE = 64 * 1024
+MEDIA_CACHE_MAX_AGE = 3600
+MEDIA_ACCEL_REDIRECT = os.environ.get('MEDIA_ACCEL_REDIRECT', default='')
+
+# PROFILE PICTURE THUMBNAILS, SEE users/avatars.py
+# SQUARE WEBP SIZES IN PIXELS, LIST VIEWS AND TOKENS USE 'small'
+# THUMBNAILS ARE RENDERED BY A POOL OF PROFILE_PICTURE_WORKERS PROCESSES, 0 RENDERS THEM IN THE REQUEST
+PROFILE_PICTURE_SIZES = {"small": 64, "medium": 256}
+PROFILE_PICTURE_QUALITY = 80
+PROFILE_PICTURE_WORKERS = 2
@@ -14,12 +14,16 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, re_path, include
 from django.conf import settings
-from django.conf.urls.static import static
+from users.views import serve_media
+from metrics.views import metrics_view
+import re
 
 urlpatterns = [
     path('admin/', admin.site.urls),
 	path('api/', include('api.urls')),
+	path('metrics/', metrics_view, name='metrics'),
+	re_path(r'^%s(?P<path>.+)$' % re.escape(settings.MEDIA_URL.lstrip('/')), serve_media, name='media'),
 	path('', include('chat.urls')),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+]
@@ -0,0 +1,94 @@
+import hashlib
+import io
+import os
+import posixpath
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection
+from PIL import Image, ImageOps
+
+# PROFILE PICTURE PIPELINE
+# THE UPLOAD IS STORED UNDER THE SHA256 OF ITS CONTENT, SO THE SAME PICTURE UPLOADED TWICE IS STORED ONCE
+# A SQUARE WEBP THUMBNAIL PER PROFILE_PICTURE_SIZES IS RENDERED IN A PROCESS POOL, PILLOW NEVER RUNS ON THE REQUEST THREAD
+# ONCE THEY ARE STORED CUSTOMUSER.PROFILE_PICTURE_THUMBNAILS IS SET AND THE SIZE URLS REPLACE THE ORIGINAL
+
+UPLOAD_TO = "profilepics"
+HASH_CHUNK_SIZE = 64 * 1024
+
+pool = None
+
+
+# profilepics/<HASH>.png -> profilepics/<HASH>_small.webp
+def thumbnail_name(name, size):
+	return f"{os.path.splitext(name)[0]}_{size}.webp"
+
+def thumbnail_names(name):
+	return [thumbnail_name(name, size) for size in settings.PROFILE_PICTURE_SIZES]
+
+def thumbnails_exist(name):
+	return all(default_storage.exists(thumbnail) for thumbnail in thumbnail_names(name))
+
+# STORES AN UPLOADED PICTURE UNDER ITS CONTENT HASH AND RETURNS THE STORED NAME, AN EXISTING COPY IS REUSED
+def store(upload):
+	digest = hashlib.sha256()
+	for chunk in upload.chunks(HASH_CHUNK_SIZE):
+		digest.update(chunk)
+	extension = os.path.splitext(upload.name)[1].lower()
+	name = posixpath.join(UPLOAD_TO, f"{digest.hexdigest()}{extension}")
+	if not default_storage.exists(name):
+		upload.seek(0)
+		name = default_storage.save(name, upload)
+	return name
+
+# RUNS IN THE WORKER PROCESSES, RETURNS THE WEBP BYTES OF EVERY SIZE
+def render_thumbnails(data, sizes, quality):
+	image = Image.open(io.BytesIO(data))
+	image = ImageOps.exif_transpose(image)
+	image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+	thumbnails = {}
+	for size, side in sizes.items():
+		output = io.BytesIO()
+		ImageOps.fit(image, (side, side), Image.LANCZOS).save(output, "WEBP", quality=quality)
+		thumbnails[size] = output.getvalue()
+	return thumbnails
+
+def get_pool():
+	global pool
+	if pool is None:
+		pool = ProcessPoolExecutor(max_workers=settings.PROFILE_PICTURE_WORKERS)
+	return pool
+
+# STORES THE RENDERED THUMBNAILS AND MARKS THEM READY FOR EVERY USER WITH THAT PICTURE
+def save_thumbnails(name, thumbnails, on_ready=None):
+	from .models import CustomUser
+	for size, data in thumbnails.items():
+		thumbnail = thumbnail_name(name, size)
+		if not default_storage.exists(thumbnail):
+			default_storage.save(thumbnail, ContentFile(data))
+	CustomUser.objects.filter(profile_picture=name).update(profile_picture_thumbnails=True)
+	if on_ready:
+		on_ready()
+
+# RENDERS THE THUMBNAILS OF A STORED PICTURE, ON_READY IS CALLED ONCE THEY ARE SAVED
+# WITH PROFILE_PICTURE_WORKERS = 0 THEY ARE RENDERED RIGHT AWAY ON THE CALLING THREAD
+def generate_thumbnails(name, on_ready=None):
+	with default_storage.open(name) as picture:
+		data = picture.read()
+	args = (data, settings.PROFILE_PICTURE_SIZES, settings.PROFILE_PICTURE_QUALITY)
+	if not settings.PROFILE_PICTURE_WORKERS:
+		save_thumbnails(name, render_thumbnails(*args), on_ready)
+		return
+
+	# THE CALLBACK RUNS ON A THREAD OF THE POOL, ITS DATABASE CONNECTION IS CLOSED WHEN IT IS DONE
+	def done(future):
+		try:
+			save_thumbnails(name, future.result(), on_ready)
+		except Exception as e:
+			print(e)
+		finally:
+			connection.close()
+
+	get_pool().submit(render_thumbnails, *args).add_done_callback(done)
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.7 on 2026-10-18 16:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_customuser_profile_picture'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='profile_picture_thumbnails',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 import uuid
@@ -7,3 +8,21 @@ import uuid
 class CustomUser(AbstractUser):
 	id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
 	profile_picture = models.ImageField(upload_to='profilepics/', blank=True, default=None)
+	# SET ONCE THE THUMBNAILS OF THE CURRENT PROFILE PICTURE ARE STORED, SEE users/avatars.py
+	profile_picture_thumbnails = models.BooleanField(default=False)
+
+	# URL OF THE PROFILE PICTURE AT ONE OF THE PROFILE_PICTURE_SIZES, THE ORIGINAL UNTIL THE THUMBNAILS ARE READY
+	def profile_picture_url(self, size=None):
+		if not self.profile_picture:
+			return ""
+		if size and self.profile_picture_thumbnails:
+			# IMPORTED HERE BECAUSE THE PIPELINE IMPORTS PILLOW AND THE STORAGE
+			from .avatars import thumbnail_name
+			return self.profile_picture.storage.url(thumbnail_name(self.profile_picture.name, size))
+		return self.profile_picture.url
+
+	# URLS OF THE ORIGINAL AND EVERY SIZE
+	def profile_picture_urls(self):
+		urls = {size: self.profile_picture_url(size) for size in settings.PROFILE_PICTURE_SIZES}
+		urls["original"] = self.profile_picture_url()
+		return urls
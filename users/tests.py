@@ -1,3 +1,57 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
+
+import os
+import tempfile
 
 # Create your tests here.
+MEDIA_ROOT = tempfile.mkdtemp()
+PICTURE_HASH = "a" * 64
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, MEDIA_ACCEL_REDIRECT='')
+class MediaServingTest(TestCase):
+	def setUp(self):
+		os.makedirs(os.path.join(MEDIA_ROOT, "profilepics"), exist_ok=True)
+		self.content = bytes(range(256)) * 4
+		self.path = f"profilepics/{PICTURE_HASH}_small.webp"
+		with open(os.path.join(MEDIA_ROOT, self.path), "wb") as file:
+			file.write(self.content)
+
+	def get(self, path, **headers):
+		return self.client.get(f"/media/{path}", secure=True, **headers)
+
+	def test_content_addressed_file_is_immutable_and_revalidated(self):
+		response = self.get(self.path)
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(b"".join(response.streaming_content), self.content)
+		self.assertEqual(response["ETag"], f'"{PICTURE_HASH}_small"')
+		self.assertIn("immutable", response["Cache-Control"])
+
+		response = self.get(self.path, HTTP_IF_NONE_MATCH=f'"{PICTURE_HASH}_small"')
+		self.assertEqual(response.status_code, 304)
+
+	def test_range_requests(self):
+		response = self.get(self.path, HTTP_RANGE="bytes=10-19")
+		self.assertEqual(response.status_code, 206)
+		self.assertEqual(response["Content-Range"], f"bytes 10-19/{len(self.content)}")
+		self.assertEqual(b"".join(response.streaming_content), self.content[10:20])
+
+		response = self.get(self.path, HTTP_RANGE="bytes=-5")
+		self.assertEqual(b"".join(response.streaming_content), self.content[-5:])
+
+		response = self.get(self.path, HTTP_RANGE=f"bytes={len(self.content)}-")
+		self.assertEqual(response.status_code, 416)
+
+		# A RANGE OVER AN OLD VERSION OF THE FILE GETS THE WHOLE NEW ONE
+		response = self.get(self.path, HTTP_RANGE="bytes=10-19", HTTP_IF_RANGE='"old"')
+		self.assertEqual(response.status_code, 200)
+
+	def test_paths_outside_media_root_are_not_served(self):
+		self.assertEqual(self.get("../settings.py").status_code, 404)
+		self.assertEqual(self.get("profilepics/missing.png").status_code, 404)
+
+	@override_settings(MEDIA_ACCEL_REDIRECT='/protected-media/')
+	def test_accel_redirect(self):
+		response = self.get(self.path)
+		self.assertEqual(response["X-Accel-Redirect"], f"/protected-media/{self.path}")
+		self.assertEqual(response.content, b"")
@@ -1,3 +1,124 @@
-from django.shortcuts import render
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse, FileResponse
+from django.utils._os import safe_join
+from django.utils.http import http_date
+from django.views.decorators.http import require_safe
 
 # Create your views here.
+
+# NAMES WRITTEN BY users/avatars.py, THE SHA256 OF THE CONTENT WITH AN OPTIONAL SIZE SUFFIX
+CONTENT_ADDRESSED = re.compile(r"^(?P<hash>[0-9a-f]{64}(_\w+)?)\.\w+$")
+RANGE = re.compile(r"^bytes=(?P<start>\d*)-(?P<end>\d*)$")
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+# STRONG ETAG, A CONTENT ADDRESSED FILE IS NAMED AFTER ITS HASH SO EVERY SERVER GIVES IT THE SAME ETAG
+def media_etag(name, stat):
+	match = CONTENT_ADDRESSED.match(os.path.basename(name))
+	if match:
+		return f'"{match.group("hash")}"'
+	return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+# A CONTENT ADDRESSED FILE NEVER CHANGES, ANY OTHER ONE IS CACHED FOR MEDIA_CACHE_MAX_AGE AND REVALIDATED WITH ITS ETAG
+def media_cache_control(name):
+	if CONTENT_ADDRESSED.match(os.path.basename(name)):
+		return IMMUTABLE
+	return f"public, max-age={settings.MEDIA_CACHE_MAX_AGE}"
+
+def etag_matches(header, etag):
+	return header.strip() == "*" or etag in [tag.strip() for tag in header.split(",")]
+
+# PARSES A SINGLE "bytes=START-END" RANGE INTO (START, END) WITH END INCLUSIVE
+# NONE MEANS THE WHOLE FILE IS SENT (NO RANGE, SEVERAL RANGES OR A MALFORMED HEADER), VALUEERROR THAT IT CAN NOT BE SATISFIED
+def parse_range(header, size):
+	match = RANGE.match(header.strip())
+	if not match:
+		return None
+	start, end = match.group("start"), match.group("end")
+	if not start:
+		if not end:
+			return None
+		# "bytes=-N" IS THE LAST N BYTES
+		start, end = max(0, size - int(end)), size - 1
+	else:
+		start, end = int(start), min(int(end), size - 1) if end else size - 1
+	if start >= size or start > end:
+		raise ValueError("Range not satisfiable")
+	return start, end
+
+# READS [START, END] IN CHUNKS, THE FILE IS NEVER LOADED WHOLE
+def read_range(path, start, end, chunk_size):
+	with open(path, "rb") as file:
+		file.seek(start)
+		remaining = end - start + 1
+		while remaining > 0:
+			chunk = file.read(min(chunk_size, remaining))
+			if not chunk:
+				return
+			remaining -= len(chunk)
+			yield chunk
+
+# SERVES THE FILES OF MEDIA_ROOT UNDER MEDIA_URL
+# THE BODY IS STREAMED IN MEDIA_CHUNK_SIZE CHUNKS, A SINGLE RANGE IS ANSWERED WITH 206 AND IF-NONE-MATCH WITH 304
+# WITH MEDIA_ACCEL_REDIRECT SET THE BODY IS LEFT TO THE FRONT PROXY (NGINX INTERNAL LOCATION), ONLY THE HEADERS COME FROM HERE
+@require_safe
+def serve_media(request, path):
+	try:
+		full_path = safe_join(settings.MEDIA_ROOT, path)
+	except SuspiciousFileOperation:
+		raise Http404("File not found")
+	try:
+		stat = os.stat(full_path)
+	except OSError:
+		raise Http404("File not found")
+	if not os.path.isfile(full_path):
+		raise Http404("File not found")
+
+	etag = media_etag(path, stat)
+	headers = {
+		"ETag": etag,
+		"Cache-Control": media_cache_control(path),
+		"Last-Modified": http_date(stat.st_mtime),
+		"Accept-Ranges": "bytes",
+	}
+	if etag_matches(request.headers.get("If-None-Match", ""), etag):
+		response = HttpResponseNotModified()
+		for name, value in headers.items():
+			response[name] = value
+		return response
+
+	content_type = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+
+	if settings.MEDIA_ACCEL_REDIRECT:
+		response = HttpResponse(content_type=content_type)
+		response["X-Accel-Redirect"] = settings.MEDIA_ACCEL_REDIRECT + path
+	else:
+		# IF-RANGE WITH ANOTHER ETAG MEANS THE CLIENT HOLDS AN OLD VERSION, IT GETS THE WHOLE FILE
+		byte_range = None
+		if "Range" in request.headers and request.headers.get("If-Range", etag) == etag:
+			try:
+				byte_range = parse_range(request.headers["Range"], stat.st_size)
+			except ValueError:
+				response = HttpResponse(status=416)
+				response["Content-Range"] = f"bytes */{stat.st_size}"
+				return response
+
+		if request.method == "HEAD":
+			response = HttpResponse(content_type=content_type)
+			response["Content-Length"] = stat.st_size
+		elif byte_range:
+			start, end = byte_range
+			response = StreamingHttpResponse(read_range(full_path, start, end, settings.MEDIA_CHUNK_SIZE), status=206, content_type=content_type)
+			response["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+			response["Content-Length"] = end - start + 1
+		else:
+			response = FileResponse(open(full_path, "rb"), content_type=content_type)
+			response.block_size = settings.MEDIA_CHUNK_SIZE
+	for name, value in headers.items():
+		response[name] = value
+	return response